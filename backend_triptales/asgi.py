@@ -4,6 +4,7 @@ from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from triptales.routing import websocket_urlpatterns
+from triptales.chat_buffer import lifespan
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend_triptales.settings')
 
@@ -14,4 +15,5 @@ application = ProtocolTypeRouter({
             websocket_urlpatterns
         )
     ),
+    "lifespan": lifespan,
 })
\ No newline at end of file
@@ -169,11 +169,48 @@ SIMPLE_JWT = {
 ASGI_APPLICATION = 'backend_triptales.asgi.application'
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
-        # Per produzione, è meglio usare Redis:
+        # Condiviso tra più worker ASGI sulla stessa macchina tramite socket Unix
+        # (vedi triptales/channel_layer.py); il broker parte col primo worker
+        # oppure a parte con `python manage.py channel_broker`.
+        'BACKEND': 'triptales.channel_layer.UnixSocketChannelLayer',
+        'CONFIG': {
+            'path': os.environ.get('CHANNELS_SOCKET', '/tmp/triptales-channels.sock'),
+        },
+        # Per più macchine, è meglio usare Redis:
         # 'BACKEND': 'channels_redis.core.RedisChannelLayer',
         # 'CONFIG': {
         #     "hosts": [('127.0.0.1', 6379)],
         # },
     },
-}
\ No newline at end of file
+}
+# Salvataggio write-behind dei messaggi chat (vedi triptales/chat_buffer.py)
+CHAT_FLUSH_INTERVAL = 0.5  # secondi
+CHAT_FLUSH_SIZE = 100  # messaggi
+
+# Cache condivisa tra i processi worker (membership dei gruppi, ...)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, '.cache'),
+    }
+}
+MEMBERSHIP_CACHE_TTL = 300  # secondi
+
+# Coda dei job in background (vedi triptales/jobs.py, `python manage.py run_jobs`)
+JOB_LEASE_SECONDS = 300  # dopo questo tempo un job preso da un worker bloccato torna disponibile
+JOB_MAX_ATTEMPTS = 5
+
+# Giorni di bucket DailyScore conservati per le classifiche su finestre di date
+DAILY_SCORE_RETENTION_DAYS = 400
+
+# Upload a blocchi dei video (vedi triptales/upload_service.py)
+UPLOAD_SESSION_DIR = os.path.join(BASE_DIR, 'upload_sessions')  # file parziali, fuori da MEDIA_ROOT
+UPLOAD_MAX_SIZE = 1024 * 1024 * 1024  # byte per file
+UPLOAD_CHUNK_MAX_SIZE = 8 * 1024 * 1024  # byte per richiesta PUT
+UPLOAD_SESSION_TTL_HOURS = 24  # sessioni senza blocchi da più tempo vengono eliminate
+
+# Upload handler che calcolano lo SHA-256 dei file per la deduplicazione (vedi triptales/blob_service.py)
+FILE_UPLOAD_HANDLERS = [
+    'triptales.upload_handlers.HashingMemoryFileUploadHandler',
+    'triptales.upload_handlers.HashingTemporaryFileUploadHandler',
+]
@@ -0,0 +1,444 @@
+# triptales/activity_service.py
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest, TruncDate
+from django.utils import timezone
+
+from .models import (Gruppo, DiaryPost, Like, Comment, PostMedia, UserLocation, UserStats, GroupScore, GroupMembership,
+                     DailyScore)
+
+# Peso di ogni contatore nel punteggio della classifica
+SCORE_WEIGHTS = {'posts_count': 1, 'likes_received': 2, 'comments_count': 1}
+
+DAILY_SCORE_RETENTION_DAYS = getattr(settings, 'DAILY_SCORE_RETENTION_DAYS', 400)
+
+
+def count_subquery(model, field):
+    """COUNT delle righe di model collegate a OuterRef('pk') tramite field (0 se nessuna)."""
+    counts = model.objects.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(
+        total=Count('pk')
+    ).values('total')
+    return Coalesce(Subquery(counts, output_field=IntegerField()), Value(0))
+
+
+def retention_start():
+    """Primo giorno per cui si conservano i bucket DailyScore."""
+    return timezone.localdate() - timedelta(days=DAILY_SCORE_RETENTION_DAYS - 1)
+
+
+def counter_updates(deltas):
+    """Espressioni F() per applicare gli incrementi senza scendere sotto zero (colonne unsigned su MySQL)."""
+    return {
+        field: Greatest(F(field), -delta) + delta if delta < 0 else F(field) + delta
+        for field, delta in deltas.items() if delta
+    }
+
+
+def with_score(deltas):
+    """Aggiunge agli incrementi la variazione del punteggio della classifica."""
+    score = sum(SCORE_WEIGHTS[field] * delta for field, delta in deltas.items() if field in SCORE_WEIGHTS)
+    return {**deltas, 'score': score} if score else deltas
+
+
+def score_of(counters):
+    """Punteggio della classifica dai contatori di UserStats, GroupScore o DailyScore."""
+    return sum(weight * getattr(counters, field) for field, weight in SCORE_WEIGHTS.items())
+
+
+def media_counters(media):
+    """Contatori di UserStats (dell'autore del post) a cui contribuisce un media."""
+    counters = set()
+    if media.media_type == 'image':
+        counters.add('photos_count')
+    if media.ocr_text:
+        counters.add('ocr_count')
+    if media.detected_objects is not None:
+        counters.add('detections_count')
+    if media.caption:
+        counters.add('captions_count')
+    return counters
+
+
+class ActivityService:
+    """
+    Mantiene aggiornati i contatori denormalizzati (dei post, UserStats
+    degli utenti e GroupScore della classifica dei gruppi) quando avvengono
+    le attività. Va chiamato dentro la stessa transazione della scrittura.
+    """
+
+    @staticmethod
+    def like_added(post):
+        DiaryPost.objects.filter(pk=post.pk).update(likes_count=F('likes_count') + 1)
+        ActivityService.update_scores(post.author_id, post.group_id, likes_received=1)
+
+    @staticmethod
+    def like_removed(post, like):
+        DiaryPost.objects.filter(pk=post.pk, likes_count__gt=0).update(likes_count=F('likes_count') - 1)
+        ActivityService.update_scores(
+            post.author_id, post.group_id, day=timezone.localdate(like.created_at), likes_received=-1
+        )
+
+    @staticmethod
+    def comment_added(comment):
+        DiaryPost.objects.filter(pk=comment.post_id).update(comments_count=F('comments_count') + 1)
+        ActivityService.update_scores(comment.author_id, comment.post.group_id, comments_count=1)
+
+    @staticmethod
+    def comment_removed(comment):
+        DiaryPost.objects.filter(pk=comment.post_id, comments_count__gt=0).update(
+            comments_count=F('comments_count') - 1
+        )
+        ActivityService.update_scores(
+            comment.author_id, comment.post.group_id, day=timezone.localdate(comment.created_at), comments_count=-1
+        )
+
+    @staticmethod
+    def post_created(post):
+        Gruppo.objects.filter(pk=post.group_id).update(post_count=F('post_count') + 1)
+        ActivityService.group_active(post.group_id, post.created_at)
+        ActivityService.update_scores(post.author_id, post.group_id, posts_count=1)
+        ActivityService.location_added(post.author_id, post.location_name)
+
+    @staticmethod
+    def post_updated(post, previous_location):
+        if post.location_name != previous_location:
+            ActivityService.location_removed(post.author_id, previous_location)
+            ActivityService.location_added(post.author_id, post.location_name)
+
+    @staticmethod
+    def post_removed(post):
+        """Da chiamare prima di cancellare il post: toglie anche i suoi media, like e commenti."""
+        media = PostMedia.objects.filter(post=post).aggregate(
+            photos_count=Count('pk', filter=Q(media_type='image')),
+            ocr_count=Count('pk', filter=Q(ocr_text__gt='')),
+            detections_count=Count('pk', filter=Q(detected_objects__isnull=False)),
+            captions_count=Count('pk', filter=Q(caption__gt=''))
+        )
+        ActivityService.update_stats(post.author_id, **{field: -total for field, total in media.items()})
+        Gruppo.objects.filter(pk=post.group_id).update(**counter_updates({'post_count': -1}))
+        ActivityService.update_scores(
+            post.author_id, post.group_id, day=timezone.localdate(post.created_at), posts_count=-1
+        )
+        ActivityService.location_removed(post.author_id, post.location_name)
+
+        # Like e commenti vanno tolti dai bucket dei giorni in cui sono stati fatti
+        likes = Like.objects.filter(post=post).annotate(day=TruncDate('created_at')).order_by().values('day')
+        for row in likes.annotate(total=Count('pk')):
+            ActivityService.update_scores(post.author_id, post.group_id, day=row['day'], likes_received=-row['total'])
+
+        comments = Comment.objects.filter(post=post).annotate(day=TruncDate('created_at')).order_by().values(
+            'author', 'day'
+        )
+        for row in comments.annotate(total=Count('pk')):
+            ActivityService.update_scores(row['author'], post.group_id, day=row['day'], comments_count=-row['total'])
+
+    @staticmethod
+    def messages_sent(messages):
+        """Aggiorna l'ultima attività dei gruppi dei messaggi chat appena salvati."""
+        last_sent = {}
+        for message in messages:
+            if message.group_id not in last_sent or message.created_at > last_sent[message.group_id]:
+                last_sent[message.group_id] = message.created_at
+        for group_id, sent_at in last_sent.items():
+            ActivityService.group_active(group_id, sent_at)
+
+    @staticmethod
+    def group_active(group_id, when):
+        """Porta avanti last_activity_at del gruppo (mai indietro, anche con scritture concorrenti)."""
+        Gruppo.objects.filter(pk=group_id, last_activity_at__lt=when).update(last_activity_at=when)
+
+    @staticmethod
+    def media_added(media):
+        ActivityService.update_stats(media.post.author_id, **dict.fromkeys(media_counters(media), 1))
+
+    @staticmethod
+    def media_updated(media, previous_counters):
+        """previous_counters: media_counters(media) calcolato prima della modifica."""
+        current = media_counters(media)
+        deltas = dict.fromkeys(current - previous_counters, 1)
+        deltas.update(dict.fromkeys(previous_counters - current, -1))
+        ActivityService.update_stats(media.post.author_id, **deltas)
+
+    @staticmethod
+    def media_removed(media):
+        ActivityService.update_stats(media.post.author_id, **dict.fromkeys(media_counters(media), -1))
+
+    @staticmethod
+    def location_added(user_id, name):
+        if not name:
+            return
+        if UserLocation.objects.filter(user_id=user_id, name=name).update(posts_count=F('posts_count') + 1):
+            return
+        try:
+            with transaction.atomic():
+                UserLocation.objects.create(user_id=user_id, name=name)
+        except IntegrityError:
+            # Creato nel frattempo da un'altra richiesta
+            UserLocation.objects.filter(user_id=user_id, name=name).update(posts_count=F('posts_count') + 1)
+            return
+        ActivityService.update_stats(user_id, locations_count=1)
+
+    @staticmethod
+    def location_removed(user_id, name):
+        if not name:
+            return
+        locations = UserLocation.objects.filter(user_id=user_id, name=name)
+        if locations.filter(posts_count__gt=1).update(posts_count=F('posts_count') - 1):
+            return
+        if locations.delete()[0]:
+            ActivityService.update_stats(user_id, locations_count=-1)
+
+    @staticmethod
+    def update_scores(user_id, group_id, day=None, **deltas):
+        """
+        Applica gli incrementi dei contatori della classifica: globale, del
+        gruppo e del bucket giornaliero (day dell'attività, default oggi).
+        """
+        ActivityService.update_stats(user_id, **deltas)
+        updates = counter_updates(with_score(deltas))
+        if not updates:
+            return
+
+        if not GroupScore.objects.filter(group_id=group_id, user_id=user_id).update(**updates):
+            is_member = GroupMembership.objects.filter(group_id=group_id, user_id=user_id).exists()
+            GroupScore.objects.bulk_create(
+                [GroupScore(group_id=group_id, user_id=user_id, is_member=is_member)], ignore_conflicts=True
+            )
+            GroupScore.objects.filter(group_id=group_id, user_id=user_id).update(**updates)
+
+        day = day or timezone.localdate()
+        if day < retention_start():
+            return
+        bucket = DailyScore.objects.filter(user_id=user_id, group_id=group_id, day=day)
+        if not bucket.update(**updates):
+            DailyScore.objects.bulk_create(
+                [DailyScore(user_id=user_id, group_id=group_id, day=day)], ignore_conflicts=True
+            )
+            bucket.update(**updates)
+
+    @staticmethod
+    def update_stats(user_id, **deltas):
+        """Applica gli incrementi (anche negativi) ai contatori UserStats dell'utente."""
+        updates = counter_updates(with_score(deltas))
+        if not updates:
+            return
+        if not UserStats.objects.filter(pk=user_id).update(**updates):
+            UserStats.objects.bulk_create([UserStats(user_id=user_id)], ignore_conflicts=True)
+            UserStats.objects.filter(pk=user_id).update(**updates)
+
+    @staticmethod
+    def compute_user_stats(user_ids):
+        """
+        Ricalcola dai dati reali i contatori UserStats degli utenti indicati,
+        con query aggregate raggruppate per autore. Restituisce
+        {user_id: UserStats} non salvati (solo per gli utenti con attività).
+        """
+        stats = {}
+
+        def get(user_id):
+            if user_id not in stats:
+                stats[user_id] = UserStats(user_id=user_id)
+            return stats[user_id]
+
+        posts = DiaryPost.objects.filter(author_id__in=user_ids).order_by().values('author')
+        for row in posts.annotate(total=Count('pk')):
+            get(row['author']).posts_count = row['total']
+
+        locations = posts.exclude(location_name__isnull=True).exclude(location_name='').annotate(
+            total=Count('location_name', distinct=True)
+        )
+        for row in locations:
+            get(row['author']).locations_count = row['total']
+
+        media = PostMedia.objects.filter(post__author_id__in=user_ids).order_by().values('post__author').annotate(
+            photos=Count('pk', filter=Q(media_type='image')),
+            ocr=Count('pk', filter=Q(ocr_text__gt='')),
+            detections=Count('pk', filter=Q(detected_objects__isnull=False)),
+            captions=Count('pk', filter=Q(caption__gt=''))
+        )
+        for row in media:
+            user_stats = get(row['post__author'])
+            user_stats.photos_count = row['photos']
+            user_stats.ocr_count = row['ocr']
+            user_stats.detections_count = row['detections']
+            user_stats.captions_count = row['captions']
+
+        likes = Like.objects.filter(post__author_id__in=user_ids).order_by().values('post__author')
+        for row in likes.annotate(total=Count('pk')):
+            get(row['post__author']).likes_received = row['total']
+
+        comments = Comment.objects.filter(author_id__in=user_ids).order_by().values('author')
+        for row in comments.annotate(total=Count('pk')):
+            get(row['author']).comments_count = row['total']
+
+        for user_stats in stats.values():
+            user_stats.score = score_of(user_stats)
+        return stats
+
+    @staticmethod
+    def compute_group_scores(user_ids):
+        """Come compute_user_stats per GroupScore: {(group_id, user_id): GroupScore} non salvati."""
+        scores = {}
+
+        def get(group_id, user_id):
+            if (group_id, user_id) not in scores:
+                scores[group_id, user_id] = GroupScore(group_id=group_id, user_id=user_id, is_member=False)
+            return scores[group_id, user_id]
+
+        for group_id, user_id in GroupMembership.objects.filter(user_id__in=user_ids).values_list('group', 'user'):
+            get(group_id, user_id).is_member = True
+
+        posts = DiaryPost.objects.filter(author_id__in=user_ids).order_by().values('group', 'author')
+        for row in posts.annotate(total=Count('pk')):
+            get(row['group'], row['author']).posts_count = row['total']
+
+        likes = Like.objects.filter(post__author_id__in=user_ids).order_by().values('post__group', 'post__author')
+        for row in likes.annotate(total=Count('pk')):
+            get(row['post__group'], row['post__author']).likes_received = row['total']
+
+        comments = Comment.objects.filter(author_id__in=user_ids).order_by().values('post__group', 'author')
+        for row in comments.annotate(total=Count('pk')):
+            get(row['post__group'], row['author']).comments_count = row['total']
+
+        for score in scores.values():
+            score.score = score_of(score)
+        return scores
+
+    @staticmethod
+    def compute_daily_scores(user_ids):
+        """
+        Come compute_group_scores per i bucket DailyScore entro la retention:
+        {(group_id, user_id, day): DailyScore} non salvati.
+        """
+        scores = {}
+        since = retention_start()
+        sources = [
+            (DiaryPost.objects.filter(author_id__in=user_ids), 'group', 'author', 'posts_count'),
+            (Like.objects.filter(post__author_id__in=user_ids), 'post__group', 'post__author', 'likes_received'),
+            (Comment.objects.filter(author_id__in=user_ids), 'post__group', 'author', 'comments_count'),
+        ]
+        for queryset, group_field, user_field, counter in sources:
+            rows = queryset.annotate(day=TruncDate('created_at')).filter(day__gte=since).order_by().values(
+                group_field, user_field, 'day'
+            ).annotate(total=Count('pk'))
+            for row in rows:
+                key = (row[group_field], row[user_field], row['day'])
+                if key not in scores:
+                    scores[key] = DailyScore(group_id=key[0], user_id=key[1], day=key[2])
+                setattr(scores[key], counter, row['total'])
+
+        for score in scores.values():
+            score.score = score_of(score)
+        return scores
+
+    @staticmethod
+    def reconcile_user_counters(user_ids, dry_run=False):
+        """
+        Riallinea UserStats, GroupScore, DailyScore (entro la retention) e
+        UserLocation degli utenti indicati ai dati reali. Restituisce quante
+        righe erano sbagliate per ciascuno.
+        """
+        drifted = {'stats': 0, 'group_scores': 0, 'daily_scores': 0, 'locations': 0}
+
+        # UserStats: una riga per utente, anche senza attività
+        expected = ActivityService.compute_user_stats(user_ids)
+        current = UserStats.objects.in_bulk(user_ids)
+        stats_fields = [field.name for field in UserStats._meta.concrete_fields if not field.primary_key]
+        to_create, to_update = [], []
+        for user_id in user_ids:
+            user_stats = expected.get(user_id) or UserStats(user_id=user_id)
+            if user_id not in current:
+                to_create.append(user_stats)
+            elif any(getattr(current[user_id], field) != getattr(user_stats, field) for field in stats_fields):
+                to_update.append(user_stats)
+        drifted['stats'] = len(to_create) + len(to_update)
+        if not dry_run:
+            UserStats.objects.bulk_create(to_create, ignore_conflicts=True)
+            UserStats.objects.bulk_update(to_update, stats_fields, batch_size=500)
+
+        # GroupScore: le righe senza attività restano (per is_member) ma azzerate
+        expected = ActivityService.compute_group_scores(user_ids)
+        score_fields = ['is_member', 'posts_count', 'likes_received', 'comments_count', 'score']
+        to_update = []
+        for score in GroupScore.objects.filter(user_id__in=user_ids):
+            target = expected.pop((score.group_id, score.user_id), None) or GroupScore(is_member=False)
+            if any(getattr(score, field) != getattr(target, field) for field in score_fields):
+                for field in score_fields:
+                    setattr(score, field, getattr(target, field))
+                to_update.append(score)
+        drifted['group_scores'] = len(to_update) + len(expected)
+        if not dry_run:
+            GroupScore.objects.bulk_update(to_update, score_fields, batch_size=500)
+            GroupScore.objects.bulk_create(expected.values(), ignore_conflicts=True)
+
+        # DailyScore: i bucket senza più attività vengono cancellati, quelli oltre la retention li toglie il prune
+        expected = ActivityService.compute_daily_scores(user_ids)
+        daily_fields = ['posts_count', 'likes_received', 'comments_count', 'score']
+        to_update, to_delete = [], []
+        for score in DailyScore.objects.filter(user_id__in=user_ids, day__gte=retention_start()):
+            target = expected.pop((score.group_id, score.user_id, score.day), None)
+            if target is None:
+                to_delete.append(score.pk)
+            elif any(getattr(score, field) != getattr(target, field) for field in daily_fields):
+                for field in daily_fields:
+                    setattr(score, field, getattr(target, field))
+                to_update.append(score)
+        drifted['daily_scores'] = len(to_update) + len(to_delete) + len(expected)
+        if not dry_run:
+            DailyScore.objects.filter(pk__in=to_delete).delete()
+            DailyScore.objects.bulk_update(to_update, daily_fields, batch_size=500)
+            DailyScore.objects.bulk_create(expected.values(), ignore_conflicts=True, batch_size=500)
+
+        # UserLocation: un luogo per (utente, nome) con il numero di post
+        expected = {
+            (row['author'], row['location_name']): row['total']
+            for row in DiaryPost.objects.filter(author_id__in=user_ids).exclude(location_name__isnull=True)
+            .exclude(location_name='').order_by().values('author', 'location_name').annotate(total=Count('pk'))
+        }
+        to_update, to_delete = [], []
+        for location in UserLocation.objects.filter(user_id__in=user_ids):
+            posts_count = expected.pop((location.user_id, location.name), None)
+            if posts_count is None:
+                to_delete.append(location.pk)
+            elif location.posts_count != posts_count:
+                location.posts_count = posts_count
+                to_update.append(location)
+        drifted['locations'] = len(to_update) + len(to_delete) + len(expected)
+        if not dry_run:
+            UserLocation.objects.filter(pk__in=to_delete).delete()
+            UserLocation.objects.bulk_update(to_update, ['posts_count'], batch_size=500)
+            UserLocation.objects.bulk_create([
+                UserLocation(user_id=user_id, name=name, posts_count=posts_count)
+                for (user_id, name), posts_count in expected.items()
+            ], ignore_conflicts=True)
+
+        return drifted
+
+    @staticmethod
+    def prune_daily_scores():
+        """Cancella i bucket DailyScore oltre la retention; restituisce quanti ne ha tolti."""
+        return DailyScore.objects.filter(day__lt=retention_start()).delete()[0]
+
+    @staticmethod
+    def reconcile_post_counters(dry_run=False):
+        """
+        Riallinea likes_count e comments_count ai conteggi reali di Like e
+        Comment. Restituisce il numero di post con contatori sbagliati.
+        """
+        drifted = DiaryPost.objects.annotate(
+            actual_likes=count_subquery(Like, 'post'),
+            actual_comments=count_subquery(Comment, 'post')
+        ).filter(
+            ~Q(likes_count=F('actual_likes')) | ~Q(comments_count=F('actual_comments'))
+        )
+        drifted_count = drifted.count()
+
+        if drifted_count and not dry_run:
+            DiaryPost.objects.filter(pk__in=drifted.values('pk')).update(
+                likes_count=count_subquery(Like, 'post'),
+                comments_count=count_subquery(Comment, 'post')
+            )
+        return drifted_count
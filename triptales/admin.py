@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Utente, Gruppo, GroupMembership, DiaryPost, PostMedia, Comment, Like, Badge, UserBadge
+from .models import Utente, Gruppo, GroupMembership, DiaryPost, PostMedia, Comment, Like, Badge, UserBadge, ChatMessage, UserStats, Job, GroupScore
 
 # Registra i modelli nell'admin
 admin.site.register(Utente)
@@ -10,4 +10,8 @@ admin.site.register(PostMedia)
 admin.site.register(Comment)
 admin.site.register(Like)
 admin.site.register(Badge)
-admin.site.register(UserBadge)
\ No newline at end of file
+admin.site.register(UserBadge)
+admin.site.register(ChatMessage)
+admin.site.register(UserStats)
+admin.site.register(Job)
+admin.site.register(GroupScore)
@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class TodoConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'triptales'
+
+    def ready(self):
+        # Registra i receiver dei segnali (invalidazione cache membership)
+        from . import signals
+        # Ricrea i trigger full-text eliminati dalle migration che ricostruiscono le tabelle (SQLite)
+        post_migrate.connect(signals.search_indexes_migrated, sender=self)
+        # Registra i task del worker in background
+        from . import tasks  # noqa: F401
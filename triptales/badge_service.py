@@ -1,197 +1,135 @@
 # Nuovo file: triptales/badge_service.py
-from .models import Badge, UserBadge, Utente, DiaryPost, PostMedia
-from django.db.models import Count, Q, Sum
+import logging
 
+from django.core.cache import cache
+from django.db.models import BooleanField, Case, Exists, ExpressionWrapper, IntegerField, OuterRef, Q, Value, When
 
-class BadgeService:
-    """Servizio per gestire l'assegnazione di badge agli utenti."""
+from .jobs import enqueue
+from .models import Badge, UserBadge, UserStats
 
-    @staticmethod
-    def check_all_badges(user):
-        """Verifica tutti i possibili badge per un utente."""
-        BadgeService.check_explorer_badge(user)
-        BadgeService.check_translator_badge(user)
-        BadgeService.check_observer_badge(user)
-        BadgeService.check_photographer_badge(user)
-        BadgeService.check_social_badge(user)
+logger = logging.getLogger(__name__)
 
-    @staticmethod
-    def check_explorer_badge(user):
-        """Verifica se l'utente merita il badge 'Esploratore'."""
-        # Assegna questo badge se l'utente ha creato post in 5+ luoghi diversi
-        distinct_locations = DiaryPost.objects.filter(
-            author=user,
-            location_name__isnull=False
-        ).values('location_name').distinct().count()
-
-        if distinct_locations >= 5:
-            explorer_badge = Badge.objects.get_or_create(
-                name="Esploratore",
-                defaults={
-                    'description': 'Hai visitato 5 o più luoghi diversi!',
-                    'icon_url': 'badge_icons/explorer.png',
-                    'criteria': {'locations': 5}
-                }
-            )[0]
-
-            UserBadge.objects.get_or_create(user=user, badge=explorer_badge)
+RULES_CACHE_KEY = 'triptales:badge_rules'
+RULES_CACHE_TTL = 3600
+
+
+def _used(field):
+    return Case(When(**{f'{field}__gt': 0}, then=Value(1)), default=Value(0), output_field=IntegerField())
+
+
+# Chiavi ammesse in Badge.criteria -> campo (o annotazione) di UserStats confrontato con la soglia
+CRITERIA_FIELDS = {
+    'posts': 'posts_count',
+    'locations': 'locations_count',
+    'photos': 'photos_count',
+    'translations': 'ocr_count',
+    'object_detections': 'detections_count',
+    'captions': 'captions_count',
+    'likes': 'likes_received',
+    'ml_features': 'ml_features',
+}
+
+# Criteri calcolati dai contatori: funzionalità ML Kit usate almeno una volta (OCR, oggetti, caption)
+CRITERIA_ANNOTATIONS = {
+    'ml_features': _used('ocr_count') + _used('detections_count') + _used('captions_count'),
+}
 
-    @staticmethod
-    def check_translator_badge(user):
-        """Verifica se l'utente merita il badge 'Traduttore'."""
-        # Assegna questo badge se l'utente ha utilizzato OCR + traduzione in 3+ post
-        ocr_count = PostMedia.objects.filter(
-            post__author=user,
-            ocr_text__isnull=False,
-            ocr_text__gt=''
-        ).count()
-
-        if ocr_count >= 3:
-            translator_badge = Badge.objects.get_or_create(
-                name="Traduttore",
-                defaults={
-                    'description': 'Hai tradotto testo in 3 o più post!',
-                    'icon_url': 'badge_icons/translator.png',
-                    'criteria': {'translations': 3}
-                }
-            )[0]
-
-            UserBadge.objects.get_or_create(user=user, badge=translator_badge)
+
+def stats_values(stats):
+    """Valori di UserStats confrontati con le soglie, come CRITERIA_FIELDS (senza query)."""
+    values = {field: getattr(stats, field) for field in CRITERIA_FIELDS.values() if field not in CRITERIA_ANNOTATIONS}
+    values['ml_features'] = sum(1 for count in (stats.ocr_count, stats.detections_count, stats.captions_count) if count)
+    return values
+
+
+def rule_reached(values, conditions):
+    return all(values.get(field, 0) >= threshold for field, threshold in conditions)
+
+
+def compile_rules():
+    """
+    Traduce Badge.criteria (es. {'photos': 20}) in una lista di
+    (badge_id, ((campo, soglia), ...)). I badge senza criteri validi
+    non vengono assegnati automaticamente.
+    """
+    rules = []
+    for badge_id, name, criteria in Badge.objects.values_list('id', 'name', 'criteria'):
+        if not isinstance(criteria, dict) or not criteria:
+            continue
+        try:
+            conditions = tuple(sorted((CRITERIA_FIELDS[key], int(threshold)) for key, threshold in criteria.items()))
+        except (KeyError, TypeError, ValueError):
+            logger.warning("Badge '%s' ignorato: criteri non validi %s", name, criteria)
+            continue
+        rules.append((badge_id, conditions))
+    return rules
+
+
+class BadgeService:
+    """Servizio per gestire l'assegnazione di badge agli utenti."""
 
     @staticmethod
-    def check_observer_badge(user):
-        """Verifica se l'utente merita il badge 'Osservatore'."""
-        # Assegna questo badge se l'utente ha riconosciuto oggetti in 10+ post
-        object_detection_count = PostMedia.objects.filter(
-            post__author=user,
-            detected_objects__isnull=False
-        ).count()
-
-        if object_detection_count >= 10:
-            observer_badge = Badge.objects.get_or_create(
-                name="Osservatore",
-                defaults={
-                    'description': 'Hai riconosciuto oggetti in 10 o più post!',
-                    'icon_url': 'badge_icons/observer.png',
-                    'criteria': {'object_detections': 10}
-                }
-            )[0]
-
-            UserBadge.objects.get_or_create(user=user, badge=observer_badge)
+    def get_rules():
+        """Regole compilate da Badge.criteria, dalla cache condivisa o dal database."""
+        rules = cache.get(RULES_CACHE_KEY)
+        if rules is None:
+            rules = compile_rules()
+            cache.set(RULES_CACHE_KEY, rules, RULES_CACHE_TTL)
+        return rules
 
     @staticmethod
-    def check_photographer_badge(user):
-        """Verifica se l'utente merita il badge 'Fotografo'."""
-        # Assegna questo badge se l'utente ha caricato 20+ foto
-        photo_count = PostMedia.objects.filter(
-            post__author=user,
-            media_type='image'
-        ).count()
-
-        if photo_count >= 20:
-            photographer_badge = Badge.objects.get_or_create(
-                name="Fotografo",
-                defaults={
-                    'description': 'Hai caricato 20 o più foto!',
-                    'icon_url': 'badge_icons/photographer.png',
-                    'criteria': {'photos': 20}
-                }
-            )[0]
-
-            UserBadge.objects.get_or_create(user=user, badge=photographer_badge)
+    def invalidate_rules():
+        """Da chiamare quando cambiano i Badge."""
+        cache.delete(RULES_CACHE_KEY)
 
     @staticmethod
-    def check_social_badge(user):
-        """Verifica se l'utente merita il badge 'Social'."""
-        # Assegna questo badge se l'utente ha ricevuto 15+ like
-        like_count = user.posts.annotate(like_count=Count('likes')).aggregate(
-            total_likes=Sum('like_count')
-        )['total_likes'] or 0
-
-        if like_count >= 15:
-            social_badge = Badge.objects.get_or_create(
-                name="Social",
-                defaults={
-                    'description': 'I tuoi post hanno ricevuto 15 o più like!',
-                    'icon_url': 'badge_icons/social.png',
-                    'criteria': {'likes': 15}
-                }
-            )[0]
-
-            UserBadge.objects.get_or_create(user=user, badge=social_badge)
+    def earned_badges(user_ids):
+        """
+        Valuta tutte le regole per un gruppo di utenti con una sola query su
+        UserStats. Restituisce {user_id: [badge_id, ...]} con i soli badge
+        raggiunti e non ancora assegnati.
+        """
+        rules = BadgeService.get_rules()
+        if not rules or not user_ids:
+            return {}
+
+        fields = {field for _, conditions in rules for field, _ in conditions}
+        queryset = UserStats.objects.filter(pk__in=user_ids).annotate(**{
+            name: expression for name, expression in CRITERIA_ANNOTATIONS.items() if name in fields
+        })
+
+        checks = {}
+        for badge_id, conditions in rules:
+            reached = Q(**{f'{field}__gte': threshold for field, threshold in conditions})
+            owned = Exists(UserBadge.objects.filter(user=OuterRef('pk'), badge_id=badge_id))
+            checks[f'badge_{badge_id}'] = ExpressionWrapper(reached & ~owned, output_field=BooleanField())
+
+        earned = {}
+        for row in queryset.annotate(**checks).values('pk', *checks):
+            badge_ids = [badge_id for badge_id, _ in rules if row[f'badge_{badge_id}']]
+            if badge_ids:
+                earned[row['pk']] = badge_ids
+        return earned
 
     @staticmethod
-    def check_ai_explorer_badge(user):
-        """Verifica se l'utente merita il badge 'AI Explorer'."""
-        # Badge per chi usa tutte le funzionalità ML Kit
-        ml_features_used = 0
-
-        # Controlla OCR usage
-        if PostMedia.objects.filter(
-                post__author=user,
-                ocr_text__isnull=False,
-                ocr_text__gt=''
-        ).exists():
-            ml_features_used += 1
-
-        # Controlla Object Detection usage
-        if PostMedia.objects.filter(
-                post__author=user,
-                detected_objects__isnull=False
-        ).exists():
-            ml_features_used += 1
-
-        # Controlla Caption generation usage
-        if PostMedia.objects.filter(
-                post__author=user,
-                caption__isnull=False,
-                caption__gt=''
-        ).exists():
-            ml_features_used += 1
-
-        if ml_features_used >= 3:  # Ha usato tutte e 3 le funzionalità
-            ai_explorer_badge = Badge.objects.get_or_create(
-                name="AI Explorer",
-                defaults={
-                    'description': 'Hai sfruttato tutte le funzionalità AI: OCR, riconoscimento oggetti e caption intelligenti!',
-                    'icon_url': 'badge_icons/ai_explorer.png',
-                    'criteria': {'ml_features': 3}
-                }
-            )[0]
-
-            UserBadge.objects.get_or_create(user=user, badge=ai_explorer_badge)
+    def award_badges(user_ids):
+        """Assegna i badge raggiunti agli utenti indicati; restituisce {user_id: [badge_id, ...]}."""
+        earned = BadgeService.earned_badges(user_ids)
+        UserBadge.objects.bulk_create(
+            [UserBadge(user_id=user_id, badge_id=badge_id) for user_id, badge_ids in earned.items() for badge_id in badge_ids],
+            ignore_conflicts=True
+        )
+        return earned
 
     @staticmethod
-    def check_polyglot_badge(user):
-        """Verifica se l'utente merita il badge 'Polyglot'."""
-        # Badge per chi usa spesso la traduzione
-        translation_count = PostMedia.objects.filter(
-            post__author=user,
-            ocr_text__isnull=False,
-            ocr_text__gt=''
-        ).count()
-
-        if translation_count >= 10:
-            polyglot_badge = Badge.objects.get_or_create(
-                name="Polyglot",
-                defaults={
-                    'description': 'Maestro delle lingue! Hai tradotto testo in 10+ foto diverse.',
-                    'icon_url': 'badge_icons/polyglot.png',
-                    'criteria': {'translations': 10}
-                }
-            )[0]
-
-            UserBadge.objects.get_or_create(user=user, badge=polyglot_badge)
-
-    # Aggiorna il metodo check_all_badges
+    def schedule_check(user_id):
+        """
+        Accoda la verifica dei badge per il worker in background; le
+        richieste per lo stesso utente ancora in attesa vengono accorpate.
+        """
+        enqueue('award_badges', {'user_id': user_id}, dedupe_key=f'award_badges:{user_id}')
+
     @staticmethod
     def check_all_badges(user):
-        """Verifica tutti i possibili badge per un utente."""
-        BadgeService.check_explorer_badge(user)
-        BadgeService.check_translator_badge(user)
-        BadgeService.check_observer_badge(user)
-        BadgeService.check_photographer_badge(user)
-        BadgeService.check_social_badge(user)
-        # NUOVI badge ML Kit
-        BadgeService.check_ai_explorer_badge(user)
-        BadgeService.check_polyglot_badge(user)
\ No newline at end of file
+        """Verifica tutti i possibili badge per un utente; restituisce gli id dei badge appena assegnati."""
+        return BadgeService.award_badges([user.pk]).get(user.pk, [])
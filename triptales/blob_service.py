@@ -0,0 +1,127 @@
+# triptales/blob_service.py
+"""
+Deduplicazione dei file dei media per contenuto.
+
+Ogni file caricato è salvato una sola volta in post_media/<ab>/<cd>/<sha256>.<ext>
+(MediaBlob); i PostMedia con gli stessi byte puntano allo stesso blob e
+ref_count conta quanti sono. Il file viene cancellato quando l'ultimo
+PostMedia che lo usa è eliminato. Lo SHA-256 degli upload multipart è
+calcolato mentre arrivano i dati (vedi upload_handlers).
+"""
+import hashlib
+import os
+
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .activity_service import counter_updates
+from .models import MediaBlob, PostMedia
+
+BLOB_DIR = 'post_media'
+
+
+def file_sha256(file):
+    """SHA-256 di un File Django, letto a blocchi."""
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def blob_name(sha256, filename):
+    """Percorso nello storage: due livelli di cartelle dalle prime cifre dell'hash."""
+    extension = os.path.splitext(filename or '')[1].lower()[:10]
+    return f'{BLOB_DIR}/{sha256[:2]}/{sha256[2:4]}/{sha256}{extension}'
+
+
+class BlobService:
+    """Salvataggio dei file dei PostMedia per contenuto, con conteggio dei riferimenti."""
+
+    @staticmethod
+    def store(file, filename):
+        """
+        Restituisce il MediaBlob con il contenuto di file, salvandolo nello
+        storage solo se non esiste già, e ne incrementa ref_count.
+        """
+        sha256 = getattr(file, 'sha256', None) or file_sha256(file)
+        with transaction.atomic():
+            blob = MediaBlob.objects.select_for_update().filter(sha256=sha256).first()
+            if blob is None:
+                max_length = PostMedia._meta.get_field('media_url').max_length
+                name = default_storage.save(blob_name(sha256, filename), file, max_length=max_length)
+                try:
+                    with transaction.atomic():
+                        return MediaBlob.objects.create(sha256=sha256, file=name, size=file.size, ref_count=1)
+                except IntegrityError:
+                    # Stesso contenuto caricato in contemporanea: vince il blob già creato
+                    default_storage.delete(name)
+                    blob = MediaBlob.objects.select_for_update().get(sha256=sha256)
+
+            MediaBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+            return blob
+
+    @staticmethod
+    def attach(media):
+        """
+        Se media ha un file nuovo (non ancora salvato), lo salva come blob e
+        ci fa puntare media_url. Chiamato prima di ogni salvataggio di
+        PostMedia (vedi signals); il blob sostituito si libera dopo con
+        release_replaced.
+        """
+        if not media.media_url or media.media_url._committed:
+            return
+
+        previous_blob_id = None
+        if media.pk is not None:
+            previous_blob_id = PostMedia.objects.filter(pk=media.pk).values_list('blob_id', flat=True).first()
+
+        upload = media.media_url.file
+        blob = BlobService.store(upload, media.media_url.name)
+        media.blob = blob
+        media.media_url.name = blob.file.name
+        media.media_url._committed = True
+
+        if previous_blob_id and previous_blob_id != blob.pk:
+            media._replaced_blob_id = previous_blob_id
+
+    @staticmethod
+    def release_replaced(media):
+        """Dopo il salvataggio, libera il blob del file che attach ha sostituito."""
+        blob_id = media.__dict__.pop('_replaced_blob_id', None)
+        if blob_id:
+            BlobService.release(blob_id)
+
+    @staticmethod
+    def release(blob_id):
+        """Toglie un riferimento al blob; senza più PostMedia il blob e il file vengono eliminati."""
+        MediaBlob.objects.filter(pk=blob_id).update(**counter_updates({'ref_count': -1}))
+        unused = MediaBlob.objects.filter(pk=blob_id, ref_count=0, media__isnull=True).first()
+        if unused is not None:
+            name = unused.file.name
+            unused.delete()
+            transaction.on_commit(lambda: default_storage.delete(name))
+
+    @staticmethod
+    def adopt(media, sha256, size):
+        """
+        Collega al blob del suo contenuto un PostMedia caricato prima della
+        deduplicazione. Il primo file con un certo contenuto diventa il blob
+        restando dov'è (gli URL già distribuiti continuano a funzionare), i
+        duplicati puntano a quello. Restituisce True se il file del media è
+        un duplicato ormai inutilizzato e viene cancellato.
+        """
+        name = media.media_url.name
+        with transaction.atomic():
+            blob = MediaBlob.objects.select_for_update().filter(sha256=sha256).first()
+            if blob is None:
+                blob = MediaBlob.objects.create(sha256=sha256, file=name, size=size)
+
+            if not PostMedia.objects.filter(pk=media.pk, blob__isnull=True).update(blob=blob, media_url=blob.file.name):
+                return False
+            MediaBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+
+            if name == blob.file.name or PostMedia.objects.filter(media_url=name).exists():
+                return False
+            transaction.on_commit(lambda: default_storage.delete(name))
+            return True
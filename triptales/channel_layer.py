@@ -0,0 +1,511 @@
+# triptales/channel_layer.py
+"""
+Channel layer multi-processo per più worker ASGI sulla stessa macchina.
+
+I worker si collegano a un broker tramite un socket Unix locale; il broker
+instrada i messaggi verso il processo proprietario del canale e fa il
+fan-out dei gruppi. Il broker può girare come processo dedicato
+(`python manage.py channel_broker`) oppure viene avviato automaticamente in
+un thread del primo worker che non riesce a collegarsi: un lock su file
+garantisce che ce ne sia uno solo, e se il processo che lo ospita termina
+un altro worker lo riavvia alla riconnessione.
+
+I messaggi viaggiano come JSON: il contenuto deve essere serializzabile
+(niente bytes).
+"""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from collections import deque
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = os.path.join(tempfile.gettempdir(), 'triptales-channels.sock')
+
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# Oltre questa quantità di dati in uscita un client è considerato lento e i messaggi per lui scartati
+MAX_CLIENT_BUFFER = 8 * 1024 * 1024
+STREAM_LIMIT = 2 ** 20
+
+
+def encode_frame(data):
+    payload = json.dumps(data, separators=(',', ':')).encode()
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+async def read_frame(reader):
+    """
+    Legge un frame (lunghezza a 4 byte + JSON); None a connessione chiusa.
+    Un frame troppo grande o non valido rende lo stream inutilizzabile e
+    viene trattato come una disconnessione.
+    """
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+        (length,) = FRAME_HEADER.unpack(header)
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame too large: {length} bytes")
+        return json.loads(await reader.readexactly(length))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    except ValueError as exc:
+        logger.warning("Frame non valido, connessione chiusa: %s", exc)
+        return None
+
+
+def channel_owner(channel):
+    """Client proprietario di un canale specifico ("prefisso.<client>!suffisso")."""
+    return channel[:channel.index('!')].rsplit('.', 1)[-1]
+
+
+class ChannelBroker:
+    """Instrada messaggi e fan-out dei gruppi tra i processi collegati al socket."""
+
+    def __init__(self, path=DEFAULT_SOCKET_PATH, group_expiry=86400, capacity=100):
+        self.path = path
+        self.group_expiry = group_expiry
+        self.capacity = capacity
+        self.clients = {}  # client_id -> StreamWriter
+        self.groups = {}  # gruppo -> {canale: scadenza}
+        self.listeners = {}  # canale non specifico -> deque di client in ascolto
+        self.backlog = {}  # canale non specifico -> deque di messaggi senza ascoltatori
+
+    def run(self, ready=None):
+        """Esegue il broker nel thread corrente con un proprio event loop."""
+        asyncio.run(self.serve(ready))
+
+    async def serve(self, ready=None):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._handle_client, path=self.path, limit=STREAM_LIMIT)
+        os.chmod(self.path, 0o600)
+        if ready is not None:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_client(self, reader, writer):
+        client_id = None
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                op = frame.get('op')
+                if op == 'hello':
+                    client_id = frame['client']
+                    self.clients[client_id] = writer
+                elif op == 'send':
+                    self._send(frame['channel'], frame['message'])
+                elif op == 'group_send':
+                    self._group_send(frame['group'], frame['message'])
+                elif op == 'group_add':
+                    self.groups.setdefault(frame['group'], {})[frame['channel']] = time.time() + self.group_expiry
+                elif op == 'group_discard':
+                    self._group_discard(frame['group'], frame['channel'])
+                elif op == 'listen':
+                    self._listen(frame['channel'], client_id)
+                elif op == 'unlisten':
+                    self._unlisten(frame['channel'], client_id)
+                elif op == 'flush':
+                    self.groups.clear()
+                    self.backlog.clear()
+        finally:
+            if client_id is not None and self.clients.get(client_id) is writer:
+                self._forget_client(client_id)
+            writer.close()
+
+    def _deliver(self, client_id, channels, message):
+        writer = self.clients.get(client_id)
+        if writer is None or writer.is_closing():
+            return False
+        if writer.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+            return False
+        writer.write(encode_frame({'op': 'deliver', 'channels': channels, 'message': message}))
+        return True
+
+    def _send(self, channel, message):
+        if '!' in channel:
+            self._deliver(channel_owner(channel), [channel], message)
+            return
+
+        # Canale normale: consegna a un ascoltatore a turno, altrimenti in attesa
+        listeners = self.listeners.get(channel)
+        while listeners:
+            client_id = listeners[0]
+            listeners.rotate(-1)
+            if self._deliver(client_id, [channel], message):
+                return
+            if client_id not in self.clients:
+                listeners.remove(client_id)
+        backlog = self.backlog.setdefault(channel, deque())
+        if len(backlog) < self.capacity:
+            backlog.append(message)
+
+    def _group_send(self, group, message):
+        members = self.groups.get(group)
+        if not members:
+            return
+
+        now = time.time()
+        by_client = {}
+        for channel, expires_at in list(members.items()):
+            if expires_at < now:
+                del members[channel]
+                continue
+            if '!' in channel:
+                by_client.setdefault(channel_owner(channel), []).append(channel)
+            else:
+                self._send(channel, message)
+
+        # Un solo frame per processo, con tutti i suoi canali nel gruppo
+        for client_id, channels in by_client.items():
+            self._deliver(client_id, channels, message)
+
+    def _group_discard(self, group, channel):
+        members = self.groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del self.groups[group]
+
+    def _listen(self, channel, client_id):
+        listeners = self.listeners.setdefault(channel, deque())
+        if client_id not in listeners:
+            listeners.append(client_id)
+        backlog = self.backlog.pop(channel, None)
+        while backlog:
+            self._send(channel, backlog.popleft())
+
+    def _unlisten(self, channel, client_id):
+        listeners = self.listeners.get(channel)
+        if listeners is not None and client_id in listeners:
+            listeners.remove(client_id)
+            if not listeners:
+                del self.listeners[channel]
+
+    def _forget_client(self, client_id):
+        del self.clients[client_id]
+        marker = f'.{client_id}!'
+        for group in list(self.groups):
+            members = self.groups[group]
+            for channel in [channel for channel in members if marker in channel]:
+                del members[channel]
+            if not members:
+                del self.groups[group]
+        for listeners in self.listeners.values():
+            if client_id in listeners:
+                listeners.remove(client_id)
+
+
+_local_brokers = {}
+_local_brokers_lock = threading.Lock()
+
+
+def acquire_broker_lock(path):
+    """Prova a diventare l'unico broker per path; restituisce il file di lock o None."""
+    lock_file = open(f'{path}.lock', 'a+')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def start_local_broker(path, **options):
+    """
+    Avvia il broker in un thread daemon di questo processo se nessun altro
+    processo lo sta già eseguendo. Il lock resta acquisito finché il
+    processo vive.
+    """
+    with _local_brokers_lock:
+        if path in _local_brokers:
+            return True
+        lock_file = acquire_broker_lock(path)
+        if lock_file is None:
+            return False
+
+        broker = ChannelBroker(path, **options)
+        ready = threading.Event()
+        thread = threading.Thread(target=broker.run, args=(ready,), name='channel-broker', daemon=True)
+        thread.start()
+        ready.wait(5)
+        _local_brokers[path] = (broker, lock_file, thread)
+        return True
+
+
+class BrokerConnection:
+    """Connessione al broker legata a un event loop, con le code dei suoi canali."""
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.client_id = uuid.uuid4().hex
+        self.writer = None
+        self.queues = {}
+        self.groups = {}  # gruppo -> canali, rinviati al broker dopo una riconnessione
+        self.listening = set()
+        self.receiving = {}  # canale -> receive() in attesa
+        self._next_collect = 0
+        self._connect_lock = asyncio.Lock()
+        self._reconnecting = False
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def ensure_connected(self):
+        if self.connected:
+            return
+        async with self._connect_lock:
+            if self.connected:
+                return
+            reader, writer = await self.layer.open_connection()
+            frames = [{'op': 'hello', 'client': self.client_id}]
+            for group, channels in self.groups.items():
+                frames.extend({'op': 'group_add', 'group': group, 'channel': channel} for channel in channels)
+            frames.extend({'op': 'listen', 'channel': channel} for channel in self.listening)
+            writer.write(b''.join(encode_frame(frame) for frame in frames))
+            await writer.drain()
+            self.writer = writer
+            asyncio.get_running_loop().create_task(self._read_loop(reader, writer))
+
+    async def request(self, frame):
+        data = encode_frame(frame)
+        for attempt in (1, 2):
+            await self.ensure_connected()
+            try:
+                self.writer.write(data)
+                await self.writer.drain()
+                return
+            except ConnectionError:
+                self.writer = None
+                if attempt == 2:
+                    raise
+
+    def queue(self, channel):
+        queue = self.queues.get(channel)
+        if queue is None:
+            queue = self.queues[channel] = asyncio.Queue()
+        return queue
+
+    def put(self, channel, message):
+        self.collect_stale()
+        queue = self.queue(channel)
+        if queue.qsize() >= self.layer.get_capacity(channel):
+            return False
+        queue.put_nowait((time.time() + self.layer.expiry, message))
+        return True
+
+    def start_receiving(self, channel):
+        self.receiving[channel] = self.receiving.get(channel, 0) + 1
+        return self.queue(channel)
+
+    def stop_receiving(self, channel, cancelled=False):
+        """
+        Fine di un receive(): senza altri in attesa la coda vuota viene
+        eliminata. Se il receive è stato annullato (consumer chiuso) il
+        broker smette anche di inviare a questo processo i messaggi del
+        canale normale.
+        """
+        remaining = self.receiving.pop(channel, 1) - 1
+        if remaining:
+            self.receiving[channel] = remaining
+            return
+        self.drop_queue(channel, force=cancelled and '!' in channel)
+        if cancelled and channel in self.listening:
+            self.listening.discard(channel)
+            if self.connected:
+                self.writer.write(encode_frame({'op': 'unlisten', 'channel': channel}))
+
+    def drop_queue(self, channel, force=False):
+        """Elimina la coda del canale se vuota (o comunque, con force) e nessuno la sta leggendo."""
+        queue = self.queues.get(channel)
+        if queue is not None and channel not in self.receiving and (force or queue.empty()):
+            del self.queues[channel]
+
+    def collect_stale(self):
+        """
+        Come InMemoryChannelLayer: al massimo una volta ogni expiry scarta i
+        messaggi scaduti ed elimina le code rimaste vuote (es. messaggi
+        arrivati per un canale già chiuso).
+        """
+        now = time.time()
+        if now < self._next_collect:
+            return
+        self._next_collect = now + self.layer.expiry
+        for channel, queue in list(self.queues.items()):
+            while not queue.empty() and queue._queue[0][0] < now:
+                queue.get_nowait()
+            self.drop_queue(channel)
+
+    async def _read_loop(self, reader, writer):
+        while True:
+            frame = await read_frame(reader)
+            if frame is None:
+                break
+            if frame.get('op') == 'deliver':
+                for channel in frame['channels']:
+                    self.put(channel, frame['message'])
+
+        if self.writer is writer:
+            self.writer = None
+        writer.close()
+        # Chi sta aspettando in receive() dipende da questa connessione: riconnettiti
+        if self.receiving or self.groups or self.listening:
+            await self._reconnect()
+
+    async def _reconnect(self):
+        if self._reconnecting:
+            return
+        self._reconnecting = True
+        delay = 0.05
+        try:
+            while not self.connected:
+                try:
+                    await self.ensure_connected()
+                except OSError:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 2)
+        finally:
+            self._reconnecting = False
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    """Channel layer condiviso tra processi tramite il broker su socket Unix."""
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path=DEFAULT_SOCKET_PATH, expiry=60, group_expiry=86400, capacity=100,
+                 channel_capacity=None, connect_timeout=5, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.path = path
+        self.group_expiry = group_expiry
+        self.connect_timeout = connect_timeout
+        self._connections = weakref.WeakKeyDictionary()  # event loop -> BrokerConnection
+
+    async def open_connection(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.connect_timeout
+        while True:
+            try:
+                return await asyncio.open_unix_connection(self.path, limit=STREAM_LIMIT)
+            except (FileNotFoundError, ConnectionRefusedError):
+                # Nessun broker in ascolto: prova a diventarlo, altrimenti attendi chi lo sta avviando
+                started = start_local_broker(self.path, group_expiry=self.group_expiry, capacity=self.capacity)
+                if loop.time() > deadline:
+                    raise
+                if not started:
+                    await asyncio.sleep(0.05)
+
+    async def connection(self):
+        loop = asyncio.get_running_loop()
+        connection = self._connections.get(loop)
+        if connection is None:
+            connection = self._connections[loop] = BrokerConnection(self)
+        await connection.ensure_connected()
+        return connection
+
+    def _local_connection(self, channel):
+        """Connessione di questo event loop proprietaria del canale, se esiste."""
+        connection = self._connections.get(asyncio.get_running_loop())
+        if connection is not None and '!' in channel and channel_owner(channel) == connection.client_id:
+            return connection
+        return None
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert "__asgi_channel__" not in message
+
+        local = self._local_connection(channel)
+        if local is not None:
+            if not local.put(channel, message):
+                raise ChannelFull(channel)
+            return
+
+        connection = await self.connection()
+        await connection.request({'op': 'send', 'channel': channel, 'message': message})
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        connection = await self.connection()
+
+        if '!' not in channel and channel not in connection.listening:
+            connection.listening.add(channel)
+            await connection.request({'op': 'listen', 'channel': channel})
+
+        queue = connection.start_receiving(channel)
+        cancelled = False
+        try:
+            while True:
+                expires_at, message = await queue.get()
+                if expires_at >= time.time():
+                    return message
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            connection.stop_receiving(channel, cancelled)
+
+    async def new_channel(self, prefix='specific'):
+        connection = await self.connection()
+        return f'{prefix}.{connection.client_id}!{uuid.uuid4().hex}'
+
+    async def flush(self):
+        connection = await self.connection()
+        for other in list(self._connections.values()):
+            other.queues.clear()
+            other.groups.clear()
+            other.listening.clear()
+            other.receiving.clear()
+        await connection.request({'op': 'flush'})
+
+    async def close(self):
+        connection = self._connections.pop(asyncio.get_running_loop(), None)
+        if connection is not None and connection.writer is not None:
+            connection.queues.clear()
+            connection.groups.clear()
+            connection.writer.close()
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        connection = await self.connection()
+        connection.groups.setdefault(group, set()).add(channel)
+        await connection.request({'op': 'group_add', 'group': group, 'channel': channel})
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        connection = await self.connection()
+        channels = connection.groups.get(group)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del connection.groups[group]
+        if not any(channel in channels for channels in connection.groups.values()):
+            connection.drop_queue(channel)
+        await connection.request({'op': 'group_discard', 'group': group, 'channel': channel})
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        connection = await self.connection()
+        await connection.request({'op': 'group_send', 'group': group, 'message': message})
@@ -0,0 +1,108 @@
+# triptales/chat_buffer.py
+import asyncio
+import atexit
+import logging
+import threading
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from .activity_service import ActivityService
+from .models import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+
+class ChatMessageBuffer:
+    """
+    Buffer write-behind dei messaggi chat di questo processo. I consumer
+    aggiungono i messaggi dopo averli già inoltrati al gruppo; il buffer li
+    salva con bulk_create ogni flush_interval secondi o appena ne ha
+    flush_size, un batch alla volta e nell'ordine di arrivo.
+    """
+
+    def __init__(self, flush_interval=0.5, flush_size=100):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.pending = []
+        # pending è condiviso tra event loop e flush_sync (atexit)
+        self._pending_lock = threading.Lock()
+        self._flush_lock = None
+        self._timer = None
+
+    def add(self, message):
+        """Accoda un ChatMessage non salvato e programma il flush."""
+        with self._pending_lock:
+            self.pending.append(message)
+            size = len(self.pending)
+
+        loop = asyncio.get_running_loop()
+        if size >= self.flush_size:
+            loop.create_task(self.flush())
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval, lambda: loop.create_task(self.flush()))
+
+    async def flush(self):
+        """Salva tutti i messaggi in attesa; i batch vengono scritti in sequenza."""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+
+        async with self._flush_lock:
+            batch = self._take_pending()
+            if batch:
+                await database_sync_to_async(self._write)(batch)
+
+    def flush_sync(self):
+        """Flush sincrono per lo spegnimento del processo, fuori dall'event loop."""
+        batch = self._take_pending()
+        if batch:
+            self._write(batch)
+
+    def _take_pending(self):
+        with self._pending_lock:
+            batch, self.pending = self.pending, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    @staticmethod
+    def _write(batch):
+        try:
+            with transaction.atomic():
+                ChatMessage.objects.bulk_create(batch)
+            saved = batch
+        except Exception:
+            # Un messaggio non valido (es. gruppo eliminato) non deve far perdere il batch
+            logger.exception("Salvataggio del batch di %d messaggi chat fallito, riprovo uno alla volta", len(batch))
+            saved = []
+            for message in batch:
+                try:
+                    message.pk = None
+                    with transaction.atomic():
+                        message.save()
+                    saved.append(message)
+                except Exception:
+                    logger.exception("Messaggio chat del gruppo %s perso", message.group_id)
+        ActivityService.messages_sent(saved)
+
+
+chat_buffer = ChatMessageBuffer(
+    flush_interval=getattr(settings, 'CHAT_FLUSH_INTERVAL', 0.5),
+    flush_size=getattr(settings, 'CHAT_FLUSH_SIZE', 100)
+)
+
+atexit.register(chat_buffer.flush_sync)
+
+
+async def lifespan(scope, receive, send):
+    """Applicazione ASGI lifespan: salva i messaggi in attesa allo shutdown del worker."""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await chat_buffer.flush()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
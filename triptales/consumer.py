@@ -3,7 +3,9 @@ import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.utils import timezone
-from .models import Gruppo, DiaryPost, Utente
+from .models import ChatMessage
+from .chat_buffer import chat_buffer
+from . import membership_cache
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
@@ -16,7 +18,16 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
 
-        user_in_group = await self.is_user_in_group(self.scope['user'], self.group_id)
+        # Utente e gruppo restano gli stessi per tutta la connessione
+        try:
+            self.group_id = int(self.group_id)
+        except ValueError:
+            await self.close()
+            return
+        self.user_id = self.scope['user'].id
+        self.username = self.scope['user'].username
+
+        user_in_group = await self.is_user_in_group(self.user_id, self.group_id)
         if not user_in_group:
             await self.close()
             return
@@ -36,19 +47,20 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
+        # Salva i messaggi ancora in attesa nel buffer
+        await chat_buffer.flush()
+
     async def receive(self, text_data):
         text_data_json = json.loads(text_data)
         message_type = text_data_json.get('type', 'message')
 
         if message_type == 'message':
             message = text_data_json.get('message', '')
-            user_id = self.scope['user'].id
-            username = self.scope['user'].username
-
-            # Salva il messaggio nel database
-            await self.save_message(user_id, message)
+            user_id = self.user_id
+            username = self.username
+            timestamp = timezone.now()
 
-            # Invia il messaggio al gruppo
+            # Invia subito il messaggio al gruppo
             await self.channel_layer.group_send(
                 self.room_group_name,
                 {
@@ -56,10 +68,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     'message': message,
                     'user_id': user_id,
                     'username': username,
-                    'timestamp': timezone.now().isoformat()
+                    'timestamp': timestamp.isoformat()
                 }
             )
 
+            # Il salvataggio nel database avviene in batch (write-behind)
+            chat_buffer.add(ChatMessage(
+                group_id=self.group_id,
+                author_id=user_id,
+                content=message,
+                created_at=timestamp
+            ))
+
         elif message_type == 'image':
             # Gestione delle immagini verrà implementata separatamente
             pass
@@ -75,23 +95,6 @@ class ChatConsumer(AsyncWebsocketConsumer):
         }))
 
     @database_sync_to_async
-    def is_user_in_group(self, user, group_id):
-        try:
-            return user.memberships.filter(group__id=group_id).exists()
-        except:
-            return False
-
-    @database_sync_to_async
-    def save_message(self, user_id, message):
-        try:
-            user = Utente.objects.get(id=user_id)
-            group = Gruppo.objects.get(id=self.group_id)
-            DiaryPost.objects.create(
-                group=group,
-                author=user,
-                title="Chat message",
-                content=message,
-                created_at=timezone.now()
-            )
-        except Exception as e:
-            print(f"Error saving message: {e}")
\ No newline at end of file
+    def is_user_in_group(self, user_id, group_id):
+        # Cache condivisa con TTL, invalidata dai segnali su GroupMembership
+        return membership_cache.is_member(user_id, group_id)
@@ -0,0 +1,133 @@
+# triptales/exif_service.py
+"""
+Coordinate GPS e data di scatto dai metadati EXIF delle foto.
+
+Image.open legge solo l'intestazione del file e getexif() non decodifica i
+pixel: l'estrazione costa una lettura dei primi KB anche per foto grandi.
+"""
+import math
+from datetime import datetime
+
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from PIL import ExifTags, Image, UnidentifiedImageError
+
+from .geo_service import geo_cell_for
+from .models import DiaryPost
+
+EXIF_DATETIME_FORMAT = '%Y:%m:%d %H:%M:%S'
+
+GPS_LATITUDE_REF = 1
+GPS_LATITUDE = 2
+GPS_LONGITUDE_REF = 3
+GPS_LONGITUDE = 4
+DATETIME = 0x0132
+DATETIME_ORIGINAL = 0x9003
+OFFSET_TIME_ORIGINAL = 0x9011
+
+
+def _degrees(dms, ref):
+    """(gradi, minuti, secondi) EXIF -> gradi decimali, negativi a sud e a ovest."""
+    try:
+        degrees, minutes, seconds = (float(value) for value in dms)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    value = degrees + minutes / 60 + seconds / 3600
+    if not math.isfinite(value):
+        return None
+    return -value if ref in ('S', 'W') else value
+
+
+def _captured_at(value, offset=None):
+    """Data EXIF ('2024:07:14 18:22:05') come datetime aware; None se non valida."""
+    if not isinstance(value, str):
+        return None
+    value = value.strip('\x00 ')
+    offset = offset.strip('\x00 ') if isinstance(offset, str) else ''
+    try:
+        if offset:
+            return datetime.strptime(f'{value} {offset}', f'{EXIF_DATETIME_FORMAT} %z')
+        # Senza offset l'ora è quella locale della fotocamera: si assume il fuso del server
+        return timezone.make_aware(datetime.strptime(value, EXIF_DATETIME_FORMAT))
+    except ValueError:
+        return None
+
+
+def read_exif(file):
+    """
+    Coordinate e data di scatto da un file immagine (aperto o percorso):
+    dict con latitude/longitude e captured_at, solo per i valori presenti.
+    """
+    try:
+        with Image.open(file) as image:
+            exif = image.getexif()
+            gps = exif.get_ifd(ExifTags.IFD.GPSInfo)
+            details = exif.get_ifd(ExifTags.IFD.Exif)
+    except (OSError, UnidentifiedImageError, SyntaxError, ValueError, Image.DecompressionBombError):
+        return {}
+
+    data = {}
+    latitude = _degrees(gps.get(GPS_LATITUDE), gps.get(GPS_LATITUDE_REF))
+    longitude = _degrees(gps.get(GPS_LONGITUDE), gps.get(GPS_LONGITUDE_REF))
+    # 0,0 è il valore scritto da alcuni telefoni senza fix GPS
+    if latitude is not None and longitude is not None and (latitude, longitude) != (0.0, 0.0) \
+            and -90 <= latitude <= 90 and -180 <= longitude <= 180:
+        data['latitude'], data['longitude'] = latitude, longitude
+
+    captured_at = _captured_at(details.get(DATETIME_ORIGINAL), details.get(OFFSET_TIME_ORIGINAL)) \
+        or _captured_at(exif.get(DATETIME))
+    if captured_at is not None:
+        data['captured_at'] = captured_at
+    return data
+
+
+def read_stored_exif(name):
+    """Come read_exif per un file nello storage; usato dai thread del backfill, non tocca il database."""
+    try:
+        with default_storage.open(name, 'rb') as file:
+            return read_exif(file)
+    except OSError:
+        return {}
+
+
+class ExifService:
+    """Geotag automatico dei PostMedia dai metadati delle foto."""
+
+    @staticmethod
+    def apply(media, data):
+        """
+        Completa coordinate e data di scatto del media con i valori EXIF in
+        data, senza sovrascrivere quelli inviati dal client. Restituisce i
+        campi modificati.
+        """
+        changed = []
+        if media.latitude is None and media.longitude is None and 'latitude' in data:
+            media.latitude, media.longitude = data['latitude'], data['longitude']
+            media.geo_cell = geo_cell_for(media.latitude, media.longitude)
+            changed += ['latitude', 'longitude', 'geo_cell']
+        if media.captured_at is None and 'captured_at' in data:
+            media.captured_at = data['captured_at']
+            changed.append('captured_at')
+        return changed
+
+    @staticmethod
+    def apply_upload(media):
+        """Legge l'EXIF del file appena caricato (non ancora nello storage) di una foto."""
+        if media.media_type != 'image':
+            return []
+        upload = media.media_url.file
+        data = read_exif(upload)
+        upload.seek(0)
+        media.exif_read = True
+        return ExifService.apply(media, data)
+
+    @staticmethod
+    def locate_post(media):
+        """Dà al post le coordinate del media se non ne ha, così compare su mappa e nearby."""
+        if media.latitude is None or media.longitude is None:
+            return 0
+        return DiaryPost.objects.filter(pk=media.post_id, latitude__isnull=True).update(
+            latitude=media.latitude,
+            longitude=media.longitude,
+            geo_cell=geo_cell_for(media.latitude, media.longitude)
+        )
@@ -0,0 +1,204 @@
+# triptales/geo_service.py
+from math import radians, sin, cos, sqrt, asin
+
+from django.db.models import Q
+
+# Alfabeto base32 usato dai geohash
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Precisione del geohash salvato su DiaryPost/PostMedia (~1.2km x 0.6km)
+GEO_CELL_PRECISION = 7
+
+EARTH_RADIUS_KM = 6371
+KM_PER_DEGREE_LAT = 111.32
+
+
+def calculate_distance(lat1, lon1, lat2, lon2):
+    """
+    Calcola la distanza tra due punti geografici usando la formula di Haversine
+    Restituisce la distanza in chilometri
+    """
+    # Converti gradi in radianti
+    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
+
+    # Formula di Haversine
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
+    c = 2 * asin(sqrt(a))
+
+    return c * EARTH_RADIUS_KM
+
+
+def encode_geohash(latitude, longitude, precision=GEO_CELL_PRECISION):
+    """Codifica una coppia lat/lon nel geohash della cella che la contiene."""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True  # I bit pari codificano la longitudine
+
+    while len(geohash) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if longitude >= mid:
+                bits = (bits << 1) | 1
+                lon_range[0] = mid
+            else:
+                bits <<= 1
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if latitude >= mid:
+                bits = (bits << 1) | 1
+                lat_range[0] = mid
+            else:
+                bits <<= 1
+                lat_range[1] = mid
+        even = not even
+        bit_count += 1
+
+        if bit_count == 5:
+            geohash.append(GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(geohash)
+
+
+def geo_cell_for(latitude, longitude):
+    """Restituisce la cella da salvare sul modello, o None se mancano le coordinate."""
+    if latitude is None or longitude is None:
+        return None
+    return encode_geohash(latitude, longitude)
+
+
+def cell_size_degrees(precision):
+    """Dimensione (lat, lon) in gradi di una cella geohash di data precisione."""
+    total_bits = precision * 5
+    lon_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / (2 ** lat_bits), 360.0 / (2 ** lon_bits)
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """
+    Restituisce (min_lat, max_lat, min_lon, max_lon) del rettangolo che
+    contiene il cerchio di raggio radius_km. La longitudine non viene
+    limitata vicino ai poli o se il cerchio attraversa l'antimeridiano.
+    """
+    delta_lat = radius_km / KM_PER_DEGREE_LAT
+    min_lat = max(latitude - delta_lat, -90.0)
+    max_lat = min(latitude + delta_lat, 90.0)
+
+    cos_lat = cos(radians(max(abs(min_lat), abs(max_lat))))
+    if cos_lat <= 0:
+        return min_lat, max_lat, -180.0, 180.0
+
+    delta_lon = radius_km / (KM_PER_DEGREE_LAT * cos_lat)
+    min_lon = longitude - delta_lon
+    max_lon = longitude + delta_lon
+    if min_lon < -180.0 or max_lon > 180.0:
+        return min_lat, max_lat, -180.0, 180.0
+
+    return min_lat, max_lat, min_lon, max_lon
+
+
+def nearby_cell_prefixes(latitude, longitude, radius_km):
+    """
+    Restituisce i prefissi geohash (cella centrale + 8 vicine) che coprono
+    il cerchio di raggio radius_km, scegliendo la precisione più fine in cui
+    una cella è almeno grande quanto il raggio. Restituisce None se il
+    raggio è troppo ampio perché il prefiltro abbia senso.
+
+    Il raggio in gradi è calcolato senza limitare il rettangolo ai poli o
+    all'antimeridiano (le celle vicine oltre l'antimeridiano si ottengono
+    riportando la longitudine in [-180, 180)); se il cerchio raggiunge un
+    polo servono tutte le longitudini e il prefiltro non si usa.
+    """
+    radius_lat = radius_km / KM_PER_DEGREE_LAT
+    farthest_lat = abs(latitude) + radius_lat
+    if farthest_lat >= 90.0:
+        return None
+    radius_lon = radius_km / (KM_PER_DEGREE_LAT * cos(radians(farthest_lat)))
+
+    precision = None
+    for candidate in range(GEO_CELL_PRECISION, 0, -1):
+        cell_lat, cell_lon = cell_size_degrees(candidate)
+        if cell_lat >= radius_lat and cell_lon >= radius_lon:
+            precision = candidate
+            break
+
+    if precision is None or precision < 2:
+        return None
+
+    cell_lat, cell_lon = cell_size_degrees(precision)
+    prefixes = set()
+    for dlat in (-cell_lat, 0, cell_lat):
+        neighbour_lat = latitude + dlat
+        if neighbour_lat < -90.0 or neighbour_lat > 90.0:
+            continue
+        for dlon in (-cell_lon, 0, cell_lon):
+            neighbour_lon = (longitude + dlon + 180.0) % 360.0 - 180.0
+            prefixes.add(encode_geohash(neighbour_lat, neighbour_lon, precision))
+
+    return sorted(prefixes)
+
+
+def prefix_range(prefix):
+    """Intervallo [start, end) di geohash che iniziano con prefix (usa l'indice B-tree)."""
+    return prefix, prefix + '~'
+
+
+def nearby_filter(latitude, longitude, radius_km):
+    """
+    Costruisce il filtro SQL per i candidati entro radius_km: rettangolo di
+    lat/lon più intervalli sulle celle geohash vicine (colonna indicizzata).
+    La distanza esatta va poi verificata con calculate_distance.
+    """
+    min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius_km)
+    condition = Q(latitude__range=(min_lat, max_lat), longitude__range=(min_lon, max_lon))
+
+    prefixes = nearby_cell_prefixes(latitude, longitude, radius_km)
+    if prefixes:
+        cells = Q()
+        for prefix in prefixes:
+            start, end = prefix_range(prefix)
+            cells |= Q(geo_cell__gte=start, geo_cell__lt=end)
+        condition &= cells
+
+    return condition
+
+
+# Precisione geohash dei cluster per livello di zoom della mappa (0-15).
+# Dallo zoom CLUSTER_MAX_ZOOM + 1 in poi la mappa riceve i singoli post.
+CLUSTER_PRECISION_BY_ZOOM = (1, 1, 1, 2, 2, 2, 3, 3, 4, 4, 4, 5, 5, 6, 6, 7)
+CLUSTER_MAX_ZOOM = len(CLUSTER_PRECISION_BY_ZOOM) - 1
+
+
+def cluster_precision_for_zoom(zoom):
+    """Precisione delle celle di clustering per lo zoom, o None se vanno restituiti i post."""
+    if zoom > CLUSTER_MAX_ZOOM:
+        return None
+    return min(CLUSTER_PRECISION_BY_ZOOM[max(zoom, 0)], GEO_CELL_PRECISION)
+
+
+def parse_bbox(value):
+    """
+    Interpreta il parametro bbox "min_lon,min_lat,max_lon,max_lat".
+    Solleva ValueError se il formato o le coordinate non sono validi.
+    """
+    min_lon, min_lat, max_lon, max_lat = (float(part) for part in value.split(','))
+    if not (-90 <= min_lat <= max_lat <= 90 and -180 <= min_lon <= 180 and -180 <= max_lon <= 180):
+        raise ValueError("bbox non valido")
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def bbox_filter(bbox, prefix=''):
+    """Filtro SQL per i punti nel bbox; gestisce i viewport a cavallo dell'antimeridiano."""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    condition = Q(**{f'{prefix}latitude__range': (min_lat, max_lat)})
+    if min_lon <= max_lon:
+        return condition & Q(**{f'{prefix}longitude__range': (min_lon, max_lon)})
+    return condition & (Q(**{f'{prefix}longitude__gte': min_lon}) | Q(**{f'{prefix}longitude__lte': max_lon}))
@@ -0,0 +1,185 @@
+# triptales/image_service.py
+"""
+Versioni ridimensionate (renditions) delle immagini dei post, generate in
+background dal job generate_renditions su un pool di processi.
+"""
+import io
+import logging
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import Image, ImageOps, features
+
+from .jobs import enqueue
+from .models import PostMedia
+
+logger = logging.getLogger(__name__)
+
+RENDITION_SIZES = tuple(sorted(getattr(settings, 'MEDIA_RENDITION_SIZES', (128, 512, 1280))))
+RENDITION_WORKERS = getattr(settings, 'MEDIA_RENDITION_WORKERS', None) or os.cpu_count() or 1
+# WebP se Pillow lo supporta, altrimenti JPEG
+RENDITION_FORMAT, RENDITION_EXTENSION = ('WEBP', 'webp') if features.check('webp') else ('JPEG', 'jpg')
+RENDITION_QUALITY = 80
+# Immagini lette e inviate al pool ma non ancora salvate: limita la memoria del processo principale
+RENDITION_MAX_IN_FLIGHT = RENDITION_WORKERS * 2
+
+# Lato lungo delle miniature usate da mappa e liste di post
+MAP_THUMBNAIL_SIZE = 128
+FEED_THUMBNAIL_SIZE = 512
+
+_pool = None
+
+
+def render_image(data, sizes=RENDITION_SIZES):
+    """
+    Ridimensiona un'immagine (bytes) perché il lato lungo non superi ogni
+    dimensione in sizes (senza ingrandirla). Restituisce {dimensione: bytes}.
+    Gira nei processi del pool: non usa il database.
+    """
+    image = Image.open(io.BytesIO(data))
+    largest = max(sizes)
+    # JPEG: decodifica direttamente a 1/2, 1/4 o 1/8 restando sopra la dimensione più grande
+    image.draft('RGB', (largest, largest))
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    if image.mode == 'RGBA' and RENDITION_FORMAT == 'JPEG':
+        image = image.convert('RGB')
+
+    renditions = {}
+    # Dalla più grande alla più piccola, ognuna ricavata dalla precedente
+    for size in sorted(sizes, reverse=True):
+        factor = max(image.size) // (size * 2)
+        if factor >= 2:
+            # reduce() fa una media di blocchi interi, molto più veloce del resampling completo
+            image = image.reduce(factor)
+        if max(image.size) > size:
+            scale = size / max(image.size)
+            image = image.resize(
+                (max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                Image.Resampling.LANCZOS
+            )
+
+        output = io.BytesIO()
+        image.save(output, RENDITION_FORMAT, quality=RENDITION_QUALITY)
+        renditions[size] = output.getvalue()
+    return renditions
+
+
+def get_pool():
+    """Pool di processi del worker, creato alla prima richiesta e riusato tra i job."""
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=RENDITION_WORKERS)
+    return _pool
+
+
+def reset_pool():
+    """Chiude il pool (es. dopo un processo morto); il prossimo get_pool() ne crea uno nuovo."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def rendition_name(media_id, size):
+    return f'post_media/renditions/{media_id}_{size}.{RENDITION_EXTENSION}'
+
+
+def rendition_url(media, size):
+    """
+    URL (relativo) della rendition più piccola almeno grande quanto size,
+    o della più grande disponibile; l'originale se non ce ne sono.
+    """
+    if not media.renditions:
+        return media.media_url.url
+    available = sorted(int(key) for key in media.renditions)
+    chosen = next((key for key in available if key >= size), available[-1])
+    return default_storage.url(media.renditions[str(chosen)])
+
+
+class ImageService:
+    """Generazione e pubblicazione delle renditions dei PostMedia."""
+
+    @staticmethod
+    def schedule_renditions(media):
+        """Accoda la generazione delle renditions di un'immagine appena caricata."""
+        if media.media_type == 'image':
+            enqueue('generate_renditions', {'media_id': media.pk}, dedupe_key=f'generate_renditions:{media.pk}')
+
+    @staticmethod
+    def generate_renditions(media_ids):
+        """
+        Genera le renditions dei media indicati sul pool di processi e le
+        salva nello storage. Le immagini non leggibili vengono saltate.
+        Restituisce il numero di media elaborati.
+        """
+        in_flight = deque()
+        done = 0
+        try:
+            for media in PostMedia.objects.filter(pk__in=media_ids, media_type='image'):
+                try:
+                    with media.media_url.open('rb') as source:
+                        data = source.read()
+                except OSError as e:
+                    logger.warning("Rendition del media %s saltata, file non leggibile: %s", media.pk, e)
+                    continue
+
+                in_flight.append((media, get_pool().submit(render_image, data)))
+                del data
+                if len(in_flight) >= RENDITION_MAX_IN_FLIGHT:
+                    done += ImageService._publish(*in_flight.popleft())
+
+            while in_flight:
+                done += ImageService._publish(*in_flight.popleft())
+        except BrokenProcessPool:
+            # Un processo è morto (es. memoria): il job riprova con un pool nuovo
+            reset_pool()
+            raise
+        return done
+
+    @staticmethod
+    def _publish(media, future):
+        """Salva le renditions calcolate da future; restituisce 1 se riuscito."""
+        try:
+            images = future.result()
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            logger.warning("Rendition del media %s non riuscita: %s", media.pk, e)
+            return 0
+
+        renditions = {}
+        for size, content in images.items():
+            name = rendition_name(media.pk, size)
+            if default_storage.exists(name):
+                default_storage.delete(name)
+            renditions[str(size)] = default_storage.save(name, ContentFile(content))
+        PostMedia.objects.filter(pk=media.pk).update(renditions=renditions)
+        return 1
+
+    @staticmethod
+    def delete_renditions(media):
+        """Cancella dopo il commit i file delle renditions del media (anche se renditions è vecchio)."""
+        names = set(media.renditions.values()) | {rendition_name(media.pk, size) for size in RENDITION_SIZES}
+
+        def delete_files():
+            for name in names:
+                default_storage.delete(name)
+
+        transaction.on_commit(delete_files)
+
+    @staticmethod
+    def file_replaced(media):
+        """
+        Dopo il salvataggio di un file nuovo su un media esistente: le
+        renditions del file precedente vengono cancellate e rigenerate.
+        """
+        ImageService.delete_renditions(media)
+        PostMedia.objects.filter(pk=media.pk).update(renditions={})
+        media.renditions = {}
+        ImageService.schedule_renditions(media)
@@ -0,0 +1,133 @@
+# triptales/jobs.py
+"""
+Coda di lavori persistente sul database, eseguita da `python manage.py run_jobs`.
+
+I job con la stessa dedupe_key vengono accorpati finché non sono presi in
+carico da un worker; alla presa in carico la chiave viene liberata, così un
+evento successivo accoda una nuova esecuzione invece di andare perso. Un
+job fallito torna in coda con la sua chiave, e se nel frattempo ne è stato
+accodato uno uguale resta solo quello.
+"""
+import logging
+import os
+import socket
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+JOB_LEASE_SECONDS = getattr(settings, 'JOB_LEASE_SECONDS', 300)
+JOB_MAX_ATTEMPTS = getattr(settings, 'JOB_MAX_ATTEMPTS', 5)
+
+# nome -> (funzione, batch)
+TASKS = {}
+
+
+def task(name, batch=False):
+    """
+    Registra una funzione come task. Se batch è True la funzione riceve la
+    lista dei payload di tutti i job di quel task presi in carico insieme.
+    """
+    def register(func):
+        TASKS[name] = (func, batch)
+        return func
+    return register
+
+
+def enqueue(task_name, payload=None, dedupe_key=None, run_at=None):
+    """Accoda un job; con dedupe_key non fa nulla se uno uguale è già in attesa."""
+    Job.objects.bulk_create([
+        Job(task=task_name, payload=payload or {}, dedupe_key=dedupe_key, run_at=run_at or timezone.now())
+    ], ignore_conflicts=dedupe_key is not None)
+
+
+def default_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def claim_jobs(worker_id, limit=100):
+    """Prende in carico fino a limit job pronti (anche quelli con lease scaduto)."""
+    now = timezone.now()
+    available = Q(claimed_at__isnull=True) | Q(claimed_at__lt=now - timedelta(seconds=JOB_LEASE_SECONDS))
+    ready = Job.objects.filter(available, status='pending', run_at__lte=now)
+
+    dedupe_keys = dict(ready.order_by('run_at', 'id').values_list('id', 'dedupe_key')[:limit])
+    if not dedupe_keys:
+        return []
+
+    # L'UPDATE condizionato garantisce che ogni job vada a un solo worker
+    candidate_ids = list(dedupe_keys)
+    ready.filter(id__in=candidate_ids).update(claimed_by=worker_id, claimed_at=now, dedupe_key=None)
+    jobs = list(Job.objects.filter(id__in=candidate_ids, claimed_by=worker_id, claimed_at=now))
+    # La chiave resta sull'istanza per rimetterla se il job va ripetuto (vedi _retry_later)
+    for job in jobs:
+        job.dedupe_key = dedupe_keys[job.id]
+    return jobs
+
+
+def run_pending(worker_id=None, limit=100):
+    """Esegue un giro di job pronti; restituisce (eseguiti, falliti)."""
+    worker_id = worker_id or default_worker_id()
+    jobs = claim_jobs(worker_id, limit)
+
+    by_task = {}
+    for job in jobs:
+        by_task.setdefault(job.task, []).append(job)
+
+    done = failed = 0
+    for task_name, task_jobs in by_task.items():
+        func, batch = TASKS.get(task_name, (None, False))
+        groups = [task_jobs] if batch else [[job] for job in task_jobs]
+        for group in groups:
+            try:
+                if func is None:
+                    raise LookupError(f"Task sconosciuto: {task_name}")
+                with transaction.atomic():
+                    if batch:
+                        func([job.payload for job in group])
+                    else:
+                        func(group[0].payload)
+            except Exception:
+                _retry_later(group, traceback.format_exc())
+                failed += len(group)
+            else:
+                Job.objects.filter(id__in=[job.id for job in group]).delete()
+                done += len(group)
+    return done, failed
+
+
+def _retry_later(jobs, error):
+    """
+    Rilascia i job con backoff esponenziale, o li segna falliti dopo
+    JOB_MAX_ATTEMPTS. I job ripetuti riprendono la loro dedupe_key, così gli
+    eventi che arrivano durante l'attesa vengono accorpati al nuovo tentativo.
+    """
+    logger.error("Job %s falliti: %s", [job.id for job in jobs], error)
+    now = timezone.now()
+    for job in jobs:
+        job.attempts += 1
+        job.last_error = error
+        job.claimed_by = None
+        job.claimed_at = None
+        if job.attempts >= JOB_MAX_ATTEMPTS:
+            job.status = 'failed'
+        else:
+            job.run_at = now + timedelta(seconds=2 ** job.attempts)
+    Job.objects.bulk_update(jobs, ['attempts', 'last_error', 'claimed_by', 'claimed_at', 'status', 'run_at'])
+
+    for job in jobs:
+        if job.status != 'pending' or not job.dedupe_key:
+            continue
+        try:
+            with transaction.atomic():
+                Job.objects.filter(pk=job.pk).update(dedupe_key=job.dedupe_key)
+        except IntegrityError:
+            # Un job uguale è stato accodato mentre questo era in esecuzione: basta quello
+            Job.objects.filter(pk=job.pk).delete()
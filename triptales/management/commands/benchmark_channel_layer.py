@@ -0,0 +1,119 @@
+import asyncio
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from triptales.channel_layer import ChannelBroker, UnixSocketChannelLayer
+
+GROUP = 'benchmark'
+
+
+def run_broker(path, ready):
+    ChannelBroker(path).run(ready)
+
+
+def run_worker(path, subscribers, messages, ready, results):
+    """Processo worker: iscrive `subscribers` canali al gruppo e misura le consegne."""
+
+    async def main():
+        layer = UnixSocketChannelLayer(path=path, capacity=messages + 100)
+        channels = [await layer.new_channel() for _ in range(subscribers)]
+        for channel in channels:
+            await layer.group_add(GROUP, channel)
+        # Il broker elabora i frame di una connessione in ordine: quando torna
+        # il probe inviato al gruppo, le iscrizioni sono attive
+        await layer.group_send(GROUP, {'type': 'probe', 'worker': os.getpid()})
+        while (await layer.receive(channels[0])).get('worker') != os.getpid():
+            pass
+        ready.put(os.getpid())
+
+        latencies = []
+        last_received = 0
+
+        async def consume(channel):
+            nonlocal last_received
+            received = 0
+            while received < messages:
+                message = await layer.receive(channel)
+                if message['type'] == 'probe':
+                    continue
+                received += 1
+                last_received = time.time()
+                latencies.append(last_received - message['sent_at'])
+
+        try:
+            await asyncio.wait_for(asyncio.gather(*(consume(c) for c in channels)), timeout=120)
+        except asyncio.TimeoutError:
+            pass
+        results.put((latencies, last_received))
+
+    asyncio.run(main())
+
+
+class Command(BaseCommand):
+    help = "Misura messaggi/secondo e latenza del fan-out dei gruppi del channel layer con N worker."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', default='1,2,4,8', help="Numero di processi worker da provare.")
+        parser.add_argument('--subscribers', type=int, default=10, help="Connessioni nel gruppo per worker.")
+        parser.add_argument('--messages', type=int, default=2000, help="Messaggi inviati al gruppo per prova.")
+
+    def handle(self, *args, **options):
+        counts = [int(value) for value in options['workers'].split(',')]
+        subscribers = options['subscribers']
+        messages = options['messages']
+        context = multiprocessing.get_context('spawn')
+
+        self.stdout.write(
+            f"{'worker':>6} {'consegne':>9} {'msg/s':>10} {'consegne/s':>11} "
+            f"{'p50 ms':>8} {'p99 ms':>8} {'persi':>6}"
+        )
+        for workers in counts:
+            # Broker dedicato e socket nuovo per ogni prova
+            path = os.path.join(tempfile.mkdtemp(), 'bench.sock')
+            broker_ready = context.Event()
+            broker = context.Process(target=run_broker, args=(path, broker_ready), daemon=True)
+            broker.start()
+            broker_ready.wait(10)
+
+            ready, results = context.Queue(), context.Queue()
+            processes = [
+                context.Process(target=run_worker, args=(path, subscribers, messages, ready, results))
+                for _ in range(workers)
+            ]
+            for process in processes:
+                process.start()
+            for _ in processes:
+                ready.get(timeout=60)
+
+            started = time.time()
+            asyncio.run(self._send_all(path, messages))
+
+            latencies, finished = [], started
+            for _ in processes:
+                worker_latencies, last_received = results.get(timeout=180)
+                latencies.extend(worker_latencies)
+                finished = max(finished, last_received)
+            for process in processes:
+                process.join()
+            broker.terminate()
+
+            elapsed = max(finished - started, 1e-9)
+            expected = messages * subscribers * workers
+            latencies.sort()
+            p50 = statistics.median(latencies) * 1000 if latencies else 0
+            p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000 if latencies else 0
+            self.stdout.write(
+                f"{workers:>6} {len(latencies):>9} {messages / elapsed:>10.0f} "
+                f"{len(latencies) / elapsed:>11.0f} {p50:>8.2f} {p99:>8.2f} {expected - len(latencies):>6}"
+            )
+
+    @staticmethod
+    async def _send_all(path, messages):
+        layer = UnixSocketChannelLayer(path=path)
+        for index in range(messages):
+            await layer.group_send(GROUP, {'type': 'chat_message', 'index': index, 'sent_at': time.time()})
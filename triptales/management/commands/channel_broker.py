@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from triptales.channel_layer import DEFAULT_SOCKET_PATH, ChannelBroker, acquire_broker_lock
+
+
+class Command(BaseCommand):
+    help = "Avvia il broker del channel layer in un processo dedicato (invece che dentro un worker ASGI)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help="Socket Unix del broker (default: quello in CHANNEL_LAYERS).")
+
+    def handle(self, *args, **options):
+        config = settings.CHANNEL_LAYERS['default'].get('CONFIG', {})
+        path = options['path'] or config.get('path', DEFAULT_SOCKET_PATH)
+
+        lock_file = acquire_broker_lock(path)
+        if lock_file is None:
+            raise CommandError(f"Un broker è già attivo su {path}.")
+
+        self.stdout.write(f"Broker in ascolto su {path}")
+        try:
+            ChannelBroker(
+                path,
+                group_expiry=config.get('group_expiry', 86400),
+                capacity=config.get('capacity', 100)
+            ).run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            lock_file.close()
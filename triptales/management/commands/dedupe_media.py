@@ -0,0 +1,68 @@
+import time
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from triptales.blob_service import BlobService, file_sha256
+from triptales.models import MediaBlob, PostMedia
+
+
+class Command(BaseCommand):
+    help = "Deduplica per contenuto (SHA-256) i file dei media caricati prima dei MediaBlob e riporta i byte recuperati."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=200, help="Media elaborati per blocco.")
+        parser.add_argument('--dry-run', action='store_true', help="Calcola i duplicati senza modificare nulla.")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        dry_run = options['dry_run']
+        pending = PostMedia.objects.filter(blob__isnull=True).exclude(media_url='')
+
+        total = pending.count()
+        processed = duplicates = reclaimed = 0
+        hashes = {}  # nome del file -> (sha256, dimensione): i file condivisi si leggono una volta
+        first_names = {}  # sha256 -> file che resta per quel contenuto (per --dry-run)
+        duplicate_names = set()
+        last_id = 0
+        started = time.monotonic()
+
+        while True:
+            chunk = list(pending.filter(pk__gt=last_id).order_by('pk')[:chunk_size])
+            if not chunk:
+                break
+            last_id = chunk[-1].pk
+
+            for media in chunk:
+                name = media.media_url.name
+                if name not in hashes:
+                    try:
+                        with default_storage.open(name, 'rb') as file:
+                            hashes[name] = (file_sha256(file), file.size)
+                    except OSError as e:
+                        self.stderr.write(f"Media {media.pk} saltato, file non leggibile: {e}")
+                        continue
+                sha256, size = hashes[name]
+
+                if dry_run:
+                    # Come adopt: il contenuto già salvato in un MediaBlob resta in quel file
+                    if sha256 not in first_names:
+                        existing = MediaBlob.objects.filter(sha256=sha256).values_list('file', flat=True).first()
+                        first_names[sha256] = existing or name
+                    removed = first_names[sha256] != name and name not in duplicate_names
+                    duplicate_names.add(name)
+                else:
+                    removed = BlobService.adopt(media, sha256, size)
+                if removed:
+                    duplicates += 1
+                    reclaimed += size
+
+            processed += len(chunk)
+            elapsed = time.monotonic() - started
+            self.stdout.write(f"{processed}/{total} media ({processed / elapsed if elapsed else 0:.0f} media/s)")
+
+        verb = "Recuperabili" if dry_run else "Recuperati"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {reclaimed} byte ({reclaimed / 1024 / 1024:.1f} MB) eliminando {duplicates} file duplicati "
+            f"su {processed} media in {time.monotonic() - started:.1f}s."
+        ))
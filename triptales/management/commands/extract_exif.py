@@ -0,0 +1,63 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from triptales.exif_service import ExifService, read_stored_exif
+from triptales.models import PostMedia
+
+
+class Command(BaseCommand):
+    help = (
+        "Legge coordinate GPS e data di scatto dall'EXIF delle foto che ne sono prive e geolocalizza i post. "
+        "Ogni foto viene letta una sola volta, anche se non ha metadati."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=200, help="Foto elaborate per blocco.")
+        parser.add_argument('--workers', type=int, default=8, help="Thread che leggono i file in parallelo.")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        photos = PostMedia.objects.filter(media_type='image', exif_read=False).exclude(media_url='').filter(
+            Q(latitude__isnull=True) | Q(captured_at__isnull=True)
+        )
+
+        total = photos.count()
+        processed = located = dated = posts_located = 0
+        last_id = 0
+        started = time.monotonic()
+        self.stdout.write(f"{total} foto da elaborare con {options['workers']} thread.")
+
+        # I thread leggono solo le intestazioni dei file; il database lo aggiorna il thread principale
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            while True:
+                chunk = list(photos.filter(pk__gt=last_id).order_by('pk')[:chunk_size])
+                if not chunk:
+                    break
+                last_id = chunk[-1].pk
+
+                updated = []
+                for media, data in zip(chunk, pool.map(read_stored_exif, [media.media_url.name for media in chunk])):
+                    changed = ExifService.apply(media, data)
+                    if changed:
+                        updated.append(media)
+                    located += 'latitude' in changed
+                    dated += 'captured_at' in changed
+
+                with transaction.atomic():
+                    PostMedia.objects.bulk_update(updated, ['latitude', 'longitude', 'geo_cell', 'captured_at'])
+                    PostMedia.objects.filter(pk__in=[media.pk for media in chunk]).update(exif_read=True)
+                    for media in updated:
+                        posts_located += ExifService.locate_post(media)
+
+                processed += len(chunk)
+                elapsed = time.monotonic() - started
+                self.stdout.write(f"{processed}/{total} foto ({processed / elapsed if elapsed else 0:.0f} foto/s)")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Coordinate trovate per {located} foto, data di scatto per {dated}, {posts_located} post geolocalizzati "
+            f"su {processed} foto in {time.monotonic() - started:.1f}s."
+        ))
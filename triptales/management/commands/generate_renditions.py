@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from triptales.image_service import RENDITION_WORKERS, ImageService
+from triptales.models import PostMedia
+
+
+class Command(BaseCommand):
+    help = "Genera le renditions delle immagini che ne sono prive (o di tutte con --all)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=100, help="Immagini elaborate per blocco.")
+        parser.add_argument('--all', action='store_true', help="Rigenera anche le renditions già presenti.")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        images = PostMedia.objects.filter(media_type='image')
+        if not options['all']:
+            images = images.filter(renditions={})
+
+        total = images.count()
+        processed = done = 0
+        last_id = 0
+        started = time.monotonic()
+        self.stdout.write(f"{total} immagini da elaborare con {RENDITION_WORKERS} processi.")
+
+        while True:
+            media_ids = list(images.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+            if not media_ids:
+                break
+            last_id = media_ids[-1]
+
+            done += ImageService.generate_renditions(media_ids)
+            processed += len(media_ids)
+            elapsed = time.monotonic() - started
+            self.stdout.write(f"{processed}/{total} immagini ({processed / elapsed if elapsed else 0:.1f} immagini/s)")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Renditions generate per {done} immagini su {processed} in {time.monotonic() - started:.1f}s."
+        ))
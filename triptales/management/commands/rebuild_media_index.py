@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from triptales.media_search_service import MediaSearchService
+from triptales.models import PostMedia
+
+
+class Command(BaseCommand):
+    help = "Ricostruisce l'indice dei risultati ML (MediaTerm) di tutti i media."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="Media elaborati per blocco.")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        total = PostMedia.objects.count()
+        processed = terms = 0
+        last_id = 0
+        started = time.monotonic()
+
+        while True:
+            media_ids = list(
+                PostMedia.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:chunk_size]
+            )
+            if not media_ids:
+                break
+            last_id = media_ids[-1]
+
+            with transaction.atomic():
+                terms += MediaSearchService.rebuild(PostMedia.objects.filter(pk__in=media_ids))
+
+            processed += len(media_ids)
+            elapsed = time.monotonic() - started
+            self.stdout.write(f"{processed}/{total} media ({processed / elapsed if elapsed else 0:.0f} media/s)")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Indicizzati {terms} termini di {processed} media in {time.monotonic() - started:.1f}s."
+        ))
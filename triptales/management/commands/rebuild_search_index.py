@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from triptales.search_service import create_search_indexes, drop_search_indexes
+
+
+class Command(BaseCommand):
+    help = (
+        "Ricrea da zero gli indici full-text di gruppi e post. I trigger persi quando una "
+        "migration ricostruisce le tabelle su SQLite vengono già ricreati da migrate."
+    )
+
+    def handle(self, *args, **options):
+        with connection.schema_editor() as schema_editor:
+            drop_search_indexes(schema_editor)
+            create_search_indexes(schema_editor)
+        self.stdout.write(self.style.SUCCESS(f"Indici full-text ricreati ({connection.vendor})."))
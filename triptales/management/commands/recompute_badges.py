@@ -0,0 +1,92 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from triptales.activity_service import ActivityService
+from triptales.badge_service import BadgeService, compile_rules, rule_reached, stats_values
+from triptales.models import Badge, UserBadge, UserStats, Utente
+
+
+class Command(BaseCommand):
+    help = (
+        "Ricalcola i criteri dei badge per tutti gli utenti e assegna i badge mancanti. I badge già "
+        "assegnati non vengono mai tolti: quelli che con le regole attuali non sarebbero più "
+        "raggiunti vengono solo segnalati."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Utenti elaborati per blocco.")
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Mostra i badge che verrebbero assegnati (e quelli non più raggiunti) senza salvare."
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        dry_run = options['dry_run']
+
+        # Le soglie potrebbero essere appena cambiate: rileggi le regole e svuota la cache
+        BadgeService.invalidate_rules()
+        rules = compile_rules()
+        badge_names = dict(Badge.objects.values_list('id', 'name'))
+        empty_values = stats_values(UserStats())
+
+        total = Utente.objects.count()
+        awarded = {badge_id: 0 for badge_id, _ in rules}
+        unreached = {badge_id: 0 for badge_id, _ in rules}
+        processed = 0
+        last_id = 0
+        started = time.monotonic()
+
+        while True:
+            users = dict(
+                Utente.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', 'username')[:chunk_size]
+            )
+            if not users:
+                break
+            last_id = max(users)
+
+            stats = ActivityService.compute_user_stats(list(users))
+            owned = set(UserBadge.objects.filter(user_id__in=users).values_list('user_id', 'badge_id'))
+
+            new_badges = []
+            for user_id in users:
+                values = stats_values(stats[user_id]) if user_id in stats else empty_values
+                for badge_id, conditions in rules:
+                    reached = rule_reached(values, conditions)
+                    if (user_id, badge_id) not in owned and reached:
+                        new_badges.append(UserBadge(user_id=user_id, badge_id=badge_id))
+                        awarded[badge_id] += 1
+                        if dry_run and options['verbosity'] > 1:
+                            self.stdout.write(f"+ {users[user_id]}: {badge_names[badge_id]}")
+                    elif (user_id, badge_id) in owned and not reached:
+                        # Regola resa più severa dopo l'assegnazione: il badge resta
+                        unreached[badge_id] += 1
+                        if options['verbosity'] > 1:
+                            self.stdout.write(f"- {users[user_id]}: {badge_names[badge_id]} (non più raggiunto)")
+
+            if not dry_run:
+                UserBadge.objects.bulk_create(new_badges, ignore_conflicts=True)
+
+            processed += len(users)
+            elapsed = time.monotonic() - started
+            self.stdout.write(
+                f"{processed}/{total} utenti ({processed / elapsed if elapsed else 0:.0f} utenti/s), "
+                f"badge nuovi in questo blocco: {len(new_badges)}"
+            )
+
+        for badge_id, count in awarded.items():
+            if count or unreached[badge_id]:
+                self.stdout.write(f"{badge_names[badge_id]}: +{count}, non più raggiunti {unreached[badge_id]}")
+
+        total_awarded = sum(awarded.values())
+        total_unreached = sum(unreached.values())
+        if total_unreached:
+            self.stdout.write(f"Badge assegnati che le regole attuali non assegnerebbero (non rimossi): {total_unreached}")
+        if dry_run:
+            self.stdout.write(f"Badge che verrebbero assegnati: {total_awarded}")
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f"Assegnati {total_awarded} badge a {processed} utenti in {time.monotonic() - started:.1f}s."
+            ))
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+
+from triptales.activity_service import ActivityService
+from triptales.models import Utente
+
+
+class Command(BaseCommand):
+    help = (
+        "Riallinea i contatori denormalizzati ai dati reali: like e commenti dei post, "
+        "UserStats, GroupScore, DailyScore (entro la retention) e UserLocation degli utenti."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Mostra quanti contatori sono disallineati senza correggerli."
+        )
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Utenti elaborati per blocco.")
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        chunk_size = options['chunk_size']
+
+        drifted_posts = ActivityService.reconcile_post_counters(dry_run=dry_run)
+
+        drifted = {'stats': 0, 'group_scores': 0, 'daily_scores': 0, 'locations': 0}
+        last_id = 0
+        while True:
+            user_ids = list(
+                Utente.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:chunk_size]
+            )
+            if not user_ids:
+                break
+            last_id = user_ids[-1]
+            for key, count in ActivityService.reconcile_user_counters(user_ids, dry_run=dry_run).items():
+                drifted[key] += count
+
+        summary = (
+            f"post: {drifted_posts}, UserStats: {drifted['stats']}, "
+            f"GroupScore: {drifted['group_scores']}, DailyScore: {drifted['daily_scores']}, "
+            f"UserLocation: {drifted['locations']}"
+        )
+        if dry_run:
+            self.stdout.write(f"Righe con contatori disallineati - {summary}")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Contatori corretti - {summary}"))
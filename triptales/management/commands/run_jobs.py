@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from triptales.jobs import default_worker_id, run_pending
+from triptales.tasks import schedule_daily_pruning, schedule_upload_collection
+
+
+class Command(BaseCommand):
+    help = "Worker in background: esegue i job in coda (verifica badge, ...)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Esegue i job pronti ed esce.")
+        parser.add_argument('--batch-size', type=int, default=100, help="Job presi in carico per giro.")
+        parser.add_argument('--sleep', type=float, default=1.0, help="Attesa in secondi quando la coda è vuota.")
+
+    def handle(self, *args, **options):
+        worker_id = default_worker_id()
+        self.stdout.write(f"Worker {worker_id} avviato")
+        # I job periodici si riprogrammano da soli; qui ci si assicura che esistano
+        schedule_daily_pruning()
+        schedule_upload_collection()
+
+        try:
+            while True:
+                done, failed = run_pending(worker_id, options['batch_size'])
+                if done or failed:
+                    self.stdout.write(f"Job eseguiti: {done}, falliti: {failed}")
+                if options['once'] and not (done or failed):
+                    break
+                if not (done or failed):
+                    time.sleep(options['sleep'])
+        except KeyboardInterrupt:
+            self.stdout.write("Worker fermato")
@@ -0,0 +1,117 @@
+# triptales/media_search_service.py
+import json
+import re
+import unicodedata
+
+from django.db.models import Count, Q
+
+from .models import MediaTerm, PostMedia
+
+MAX_TERM_LENGTH = 64
+# I testi OCR molto lunghi (es. pannelli informativi) vengono troncati nell'indice
+MAX_WORDS_PER_MEDIA = 300
+
+
+def normalize(text):
+    """Minuscolo e senza accenti: 'Città' -> 'citta'."""
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def normalize_label(label):
+    """Etichetta di un oggetto riconosciuto, con gli spazi compattati ('Eiffel  Tower' -> 'eiffel tower')."""
+    return ' '.join(normalize(label).split())[:MAX_TERM_LENGTH]
+
+
+def text_words(text):
+    """Parole (di almeno 2 caratteri) di un testo OCR, caption o query, senza duplicati e in ordine."""
+    words = dict.fromkeys(
+        word for word in re.findall(r'\w+', normalize(text or '')) if 2 <= len(word) <= MAX_TERM_LENGTH
+    )
+    return list(words)
+
+
+def object_labels(detected_objects):
+    """Etichette di detected_objects: lista di {'label': ...} o di stringhe (anche come JSON testuale)."""
+    if isinstance(detected_objects, str):
+        try:
+            detected_objects = json.loads(detected_objects)
+        except ValueError:
+            return []
+    if not isinstance(detected_objects, list):
+        return []
+
+    labels = []
+    for item in detected_objects:
+        label = item.get('label') if isinstance(item, dict) else item
+        if isinstance(label, str) and normalize_label(label):
+            labels.append(normalize_label(label))
+    return list(dict.fromkeys(labels))
+
+
+def media_terms(media):
+    """Insieme di (kind, term) con cui indicizzare un media."""
+    terms = {('label', label) for label in object_labels(media.detected_objects)}
+    words = text_words(f"{media.ocr_text or ''} {media.caption or ''}")
+    terms.update(('word', word) for word in words[:MAX_WORDS_PER_MEDIA])
+    return terms
+
+
+class MediaSearchService:
+    """Indice invertito dei risultati ML (MediaTerm) e ricerca dei media."""
+
+    @staticmethod
+    def index_media(media):
+        """
+        Allinea i MediaTerm del media ai suoi risultati ML; da chiamare nella
+        stessa transazione del salvataggio. Scrive solo i termini cambiati.
+        """
+        terms = media_terms(media)
+        existing = set(MediaTerm.objects.filter(media=media).values_list('kind', 'term'))
+
+        removed = existing - terms
+        if removed:
+            stale = Q()
+            for kind, term in removed:
+                stale |= Q(kind=kind, term=term)
+            MediaTerm.objects.filter(stale, media=media).delete()
+
+        MediaTerm.objects.bulk_create([
+            MediaTerm(media=media, post_id=media.post_id, group_id=media.post.group_id, kind=kind, term=term)
+            for kind, term in terms - existing
+        ], ignore_conflicts=True)
+
+    @staticmethod
+    def rebuild(media_queryset):
+        """Ricostruisce da zero i termini dei media indicati; restituisce quanti termini ha scritto."""
+        media_list = list(media_queryset.select_related('post'))
+        MediaTerm.objects.filter(media__in=[media.pk for media in media_list]).delete()
+        created = MediaTerm.objects.bulk_create([
+            MediaTerm(media=media, post_id=media.post_id, group_id=media.post.group_id, kind=kind, term=term)
+            for media in media_list for kind, term in media_terms(media)
+        ], batch_size=1000, ignore_conflicts=True)
+        return len(created)
+
+    @staticmethod
+    def search(labels=(), words=(), groups=None):
+        """
+        PostMedia che hanno tutte le etichette e tutte le parole indicate
+        (già normalizzate), limitati ai gruppi in groups se indicato.
+        """
+        # Senza duplicati: il conteggio dei termini trovati deve essere uguale a quelli cercati
+        labels = list(dict.fromkeys(labels))
+        words = list(dict.fromkeys(words))
+        wanted = Q()
+        if labels:
+            wanted |= Q(kind='label', term__in=labels)
+        if words:
+            wanted |= Q(kind='word', term__in=words)
+
+        matches = MediaTerm.objects.filter(wanted)
+        if groups is not None:
+            matches = matches.filter(group__in=groups)
+        # Ogni (media, kind, term) è unico: il media corrisponde se trova tutti i termini
+        media_ids = matches.order_by().values('media').annotate(found=Count('pk')).filter(
+            found=len(labels) + len(words)
+        ).values('media')
+        return PostMedia.objects.filter(id__in=media_ids)
@@ -0,0 +1,82 @@
+# triptales/membership_cache.py
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import GroupMembership
+
+MEMBERSHIP_CACHE_TTL = getattr(settings, 'MEMBERSHIP_CACHE_TTL', 300)
+
+
+def _version_key(user_id):
+    return f'triptales:memberships_version:{user_id}'
+
+
+def _cache_key(user_id, version):
+    return f'triptales:memberships:{user_id}:{version}'
+
+
+def _current_version(user_id):
+    """
+    Versione delle membership dell'utente. Le mappe salvate con una versione
+    precedente non vengono più lette, anche se scritte dopo l'invalidazione
+    da una richiesta che aveva letto dati vecchi.
+    """
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(key, version, None):
+            version = cache.get(key) or version
+    return version
+
+
+def get_group_roles(user_id):
+    """Mappa group_id -> ruolo dell'utente, dalla cache condivisa o dal database."""
+    key = _cache_key(user_id, _current_version(user_id))
+    roles = cache.get(key)
+    if roles is None:
+        roles = dict(GroupMembership.objects.filter(user_id=user_id).values_list('group_id', 'role'))
+        cache.set(key, roles, MEMBERSHIP_CACHE_TTL)
+    return roles
+
+
+def is_member(user_id, group_id):
+    return int(group_id) in get_group_roles(user_id)
+
+
+def request_group_roles(request):
+    """Come get_group_roles per l'utente della richiesta, letto una sola volta per richiesta."""
+    roles = getattr(request, '_group_roles', None)
+    if roles is None:
+        roles = get_group_roles(request.user.id) if request.user.is_authenticated else {}
+        request._group_roles = roles
+    return roles
+
+
+def request_is_member(request, group_id):
+    return int(group_id) in request_group_roles(request)
+
+
+def request_is_admin(request, group_id):
+    return request_group_roles(request).get(int(group_id)) == 'admin'
+
+
+def member_group_ids(request):
+    """ID dei gruppi dell'utente della richiesta, per i filtri group__in."""
+    return list(request_group_roles(request))
+
+
+def invalidate(user_id):
+    """
+    Da chiamare quando cambiano le membership dell'utente. La versione
+    cambia subito e di nuovo al commit, così una lettura fatta prima del
+    commit non resta in cache.
+    """
+    def bump():
+        cache.set(_version_key(user_id), uuid.uuid4().hex, None)
+
+    bump()
+    transaction.on_commit(bump)
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('triptales', '0003_alter_diarypost_options_groupinvite'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gruppo',
+            name='is_private',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.20 on 2026-10-16 22:29
+
+from django.db import migrations, models
+
+from triptales.geo_service import geo_cell_for
+
+
+def populate_geo_cells(apps, schema_editor):
+    for model_name in ('DiaryPost', 'PostMedia'):
+        model = apps.get_model('triptales', model_name)
+        rows = model.objects.filter(latitude__isnull=False, longitude__isnull=False)
+        batch = []
+        for obj in rows.only('id', 'latitude', 'longitude').iterator():
+            obj.geo_cell = geo_cell_for(obj.latitude, obj.longitude)
+            batch.append(obj)
+            if len(batch) >= 500:
+                model.objects.bulk_update(batch, ['geo_cell'])
+                batch = []
+        if batch:
+            model.objects.bulk_update(batch, ['geo_cell'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('triptales', '0004_gruppo_is_private'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='diarypost',
+            name='geo_cell',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=12, null=True),
+        ),
+        migrations.AddField(
+            model_name='postmedia',
+            name='geo_cell',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=12, null=True),
+        ),
+        migrations.RunPython(populate_geo_cells, migrations.RunPython.noop),
+    ]
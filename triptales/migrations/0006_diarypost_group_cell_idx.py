@@ -0,0 +1,17 @@
+# Generated by Django 4.2.20 on 2026-10-16 22:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('triptales', '0005_geo_cell'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='diarypost',
+            index=models.Index(fields=['group', 'geo_cell'], name='diarypost_group_cell_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.20 on 2026-10-16 22:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('triptales', '0006_diarypost_group_cell_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'created_at', 'id'], name='comment_post_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='diarypost',
+            index=models.Index(fields=['group', 'created_at', 'id'], name='diarypost_group_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='diarypost',
+            index=models.Index(fields=['author', 'created_at', 'id'], name='diarypost_author_created_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.20 on 2026-10-16 22:33
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def populate_counters(apps, schema_editor):
+    DiaryPost = apps.get_model('triptales', 'DiaryPost')
+    Like = apps.get_model('triptales', 'Like')
+    Comment = apps.get_model('triptales', 'Comment')
+
+    def count_subquery(model):
+        counts = model.objects.filter(post=OuterRef('pk')).order_by().values('post').annotate(
+            total=Count('pk')
+        ).values('total')
+        return Coalesce(Subquery(counts, output_field=IntegerField()), Value(0))
+
+    DiaryPost.objects.update(likes_count=count_subquery(Like), comments_count=count_subquery(Comment))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('triptales', '0007_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='diarypost',
+            name='comments_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='diarypost',
+            name='likes_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
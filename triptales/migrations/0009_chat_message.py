@@ -0,0 +1,118 @@
+# Generated by Django 4.2.20 on 2026-10-16 22:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+BATCH_SIZE = 1000
+
+
+def chat_posts_queryset(DiaryPost, PostMedia):
+    """
+    Messaggi di chat da spostare: i post con is_chat_message, creati
+    dall'API di chat, che ChatMessage rappresenta per intero (titolo "Chat
+    message", senza posizione, commenti o like, al massimo un'immagine). Un
+    post con il flag ma senza questa forma resta un DiaryPost, così nessun
+    dato va perso. I messaggi salvati dal websocket non avevano il flag e
+    comparivano già come post, non in chat: restano post.
+    """
+    chat_shape = models.Q(
+        is_chat_message=True,
+        title='Chat message',
+        latitude__isnull=True,
+        longitude__isnull=True,
+        comments__isnull=True,
+        likes__isnull=True
+    ) & (models.Q(location_name__isnull=True) | models.Q(location_name=''))
+    other_media = PostMedia.objects.exclude(media_type='image').values('post_id')
+    many_media = PostMedia.objects.order_by().values('post_id').annotate(
+        total=models.Count('id')
+    ).filter(total__gt=1).values('post_id')
+    return DiaryPost.objects.filter(chat_shape).exclude(id__in=other_media).exclude(
+        id__in=many_media
+    ).distinct().order_by('created_at', 'id')
+
+
+def move_chat_messages(apps, schema_editor):
+    """
+    Sposta i messaggi di chat da DiaryPost a ChatMessage in ordine
+    cronologico (vedi chat_posts_queryset). Le immagini inviate in chat
+    restano dove sono: il messaggio punta allo stesso file.
+    """
+    DiaryPost = apps.get_model('triptales', 'DiaryPost')
+    ChatMessage = apps.get_model('triptales', 'ChatMessage')
+    PostMedia = apps.get_model('triptales', 'PostMedia')
+
+    chat_posts = chat_posts_queryset(DiaryPost, PostMedia)
+
+    images = dict(
+        PostMedia.objects.filter(post__in=chat_posts.values('id')).values_list('post_id', 'media_url')
+    )
+
+    batch = []
+    moved_ids = []
+    for post in chat_posts.only('id', 'group_id', 'author_id', 'content', 'created_at').iterator():
+        batch.append(ChatMessage(
+            group_id=post.group_id,
+            author_id=post.author_id,
+            content=post.content,
+            image=images.get(post.id),
+            created_at=post.created_at
+        ))
+        moved_ids.append(post.id)
+        if len(batch) >= BATCH_SIZE:
+            ChatMessage.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        ChatMessage.objects.bulk_create(batch)
+
+    for start in range(0, len(moved_ids), BATCH_SIZE):
+        DiaryPost.objects.filter(id__in=moved_ids[start:start + BATCH_SIZE]).delete()
+
+
+def restore_chat_messages(apps, schema_editor):
+    DiaryPost = apps.get_model('triptales', 'DiaryPost')
+    ChatMessage = apps.get_model('triptales', 'ChatMessage')
+    PostMedia = apps.get_model('triptales', 'PostMedia')
+
+    for message in ChatMessage.objects.order_by('id').iterator():
+        post = DiaryPost.objects.create(
+            group_id=message.group_id,
+            author_id=message.author_id,
+            title='Chat message',
+            content=message.content,
+            created_at=message.created_at,
+            is_chat_message=True
+        )
+        if message.image:
+            PostMedia.objects.create(post=post, media_type='image', media_url=message.image.name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('triptales', '0008_post_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content', models.TextField(blank=True)),
+                ('image', models.FileField(blank=True, null=True, upload_to='chat_media/')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_messages', to=settings.AUTH_USER_MODEL)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_messages', to='triptales.gruppo')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['group', 'id'], name='chatmessage_group_id_idx')],
+            },
+        ),
+        migrations.RunPython(move_chat_messages, restore_chat_messages),
+        migrations.RemoveField(
+            model_name='diarypost',
+            name='is_chat_message',
+        ),
+    ]
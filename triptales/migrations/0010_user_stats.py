@@ -0,0 +1,88 @@
+# Generated by Django 4.2.20 on 2026-10-16 22:45
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q
+import django.db.models.deletion
+
+
+def populate_user_stats(apps, schema_editor):
+    DiaryPost = apps.get_model('triptales', 'DiaryPost')
+    PostMedia = apps.get_model('triptales', 'PostMedia')
+    Like = apps.get_model('triptales', 'Like')
+    UserStats = apps.get_model('triptales', 'UserStats')
+    UserLocation = apps.get_model('triptales', 'UserLocation')
+
+    stats = {}
+
+    def get(user_id):
+        if user_id not in stats:
+            stats[user_id] = UserStats(user_id=user_id)
+        return stats[user_id]
+
+    for row in DiaryPost.objects.order_by().values('author').annotate(total=Count('pk')):
+        get(row['author']).posts_count = row['total']
+
+    locations = (
+        DiaryPost.objects.exclude(location_name__isnull=True).exclude(location_name='')
+        .order_by().values('author', 'location_name').annotate(total=Count('pk'))
+    )
+    user_locations = []
+    for row in locations:
+        user_locations.append(UserLocation(user_id=row['author'], name=row['location_name'], posts_count=row['total']))
+        get(row['author']).locations_count += 1
+
+    media = PostMedia.objects.order_by().values('post__author').annotate(
+        photos=Count('pk', filter=Q(media_type='image')),
+        ocr=Count('pk', filter=Q(ocr_text__gt='')),
+        detections=Count('pk', filter=Q(detected_objects__isnull=False)),
+        captions=Count('pk', filter=Q(caption__gt=''))
+    )
+    for row in media:
+        user_stats = get(row['post__author'])
+        user_stats.photos_count = row['photos']
+        user_stats.ocr_count = row['ocr']
+        user_stats.detections_count = row['detections']
+        user_stats.captions_count = row['captions']
+
+    for row in Like.objects.order_by().values('post__author').annotate(total=Count('pk')):
+        get(row['post__author']).likes_received = row['total']
+
+    UserLocation.objects.bulk_create(user_locations, batch_size=500)
+    UserStats.objects.bulk_create(stats.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('triptales', '0009_chat_message'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='activity_stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('posts_count', models.PositiveIntegerField(default=0)),
+                ('locations_count', models.PositiveIntegerField(default=0)),
+                ('photos_count', models.PositiveIntegerField(default=0)),
+                ('ocr_count', models.PositiveIntegerField(default=0)),
+                ('detections_count', models.PositiveIntegerField(default=0)),
+                ('captions_count', models.PositiveIntegerField(default=0)),
+                ('likes_received', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserLocation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('posts_count', models.PositiveIntegerField(default=1)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='locations', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'name')},
+            },
+        ),
+        migrations.RunPython(populate_user_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+from django.core.cache import cache
+from django.db import migrations
+
+# Badge assegnati automaticamente da BadgeService in base a Badge.criteria
+DEFAULT_BADGES = [
+    ('Esploratore', 'Hai visitato 5 o più luoghi diversi!', 'badge_icons/explorer.png', {'locations': 5}),
+    ('Traduttore', 'Hai tradotto testo in 3 o più post!', 'badge_icons/translator.png', {'translations': 3}),
+    ('Osservatore', 'Hai riconosciuto oggetti in 10 o più post!', 'badge_icons/observer.png', {'object_detections': 10}),
+    ('Fotografo', 'Hai caricato 20 o più foto!', 'badge_icons/photographer.png', {'photos': 20}),
+    ('Social', 'I tuoi post hanno ricevuto 15 o più like!', 'badge_icons/social.png', {'likes': 15}),
+    ('AI Explorer', 'Hai sfruttato tutte le funzionalità AI: OCR, riconoscimento oggetti e caption intelligenti!',
+     'badge_icons/ai_explorer.png', {'ml_features': 3}),
+    ('Polyglot', 'Maestro delle lingue! Hai tradotto testo in 10+ foto diverse.', 'badge_icons/polyglot.png',
+     {'translations': 10}),
+]
+
+
+def create_default_badges(apps, schema_editor):
+    Badge = apps.get_model('triptales', 'Badge')
+    existing = set(Badge.objects.values_list('name', flat=True))
+    Badge.objects.bulk_create([
+        Badge(name=name, description=description, icon_url=icon_url, criteria=criteria)
+        for name, description, icon_url, criteria in DEFAULT_BADGES
+        if name not in existing
+    ])
+    # Le regole compilate da BadgeService sono in cache (vedi badge_service.RULES_CACHE_KEY)
+    cache.delete('triptales:badge_rules')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('triptales', '0010_user_stats'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_default_badges, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,102 @@
+# Generated by Django 4.2.20 on 2026-10-16 22:55
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def populate_scores(apps, schema_editor):
+    Utente = apps.get_model('triptales', 'Utente')
+    GroupMembership = apps.get_model('triptales', 'GroupMembership')
+    DiaryPost = apps.get_model('triptales', 'DiaryPost')
+    Like = apps.get_model('triptales', 'Like')
+    Comment = apps.get_model('triptales', 'Comment')
+    UserStats = apps.get_model('triptales', 'UserStats')
+    GroupScore = apps.get_model('triptales', 'GroupScore')
+
+    # Una riga UserStats per ogni utente, anche senza attività
+    UserStats.objects.bulk_create(
+        [UserStats(user_id=user_id) for user_id in Utente.objects.filter(activity_stats__isnull=True).values_list('pk', flat=True)],
+        batch_size=500
+    )
+    comments = Comment.objects.filter(author=OuterRef('user')).order_by().values('author').annotate(
+        total=Count('pk')
+    ).values('total')
+    UserStats.objects.update(comments_count=Coalesce(Subquery(comments, output_field=IntegerField()), Value(0)))
+    UserStats.objects.update(score=F('posts_count') + F('likes_received') * 2 + F('comments_count'))
+
+    scores = {}
+
+    def get(group_id, user_id):
+        if (group_id, user_id) not in scores:
+            scores[group_id, user_id] = GroupScore(group_id=group_id, user_id=user_id, is_member=False)
+        return scores[group_id, user_id]
+
+    for group_id, user_id in GroupMembership.objects.values_list('group', 'user'):
+        get(group_id, user_id).is_member = True
+    for row in DiaryPost.objects.order_by().values('group', 'author').annotate(total=Count('pk')):
+        get(row['group'], row['author']).posts_count = row['total']
+    for row in Like.objects.order_by().values('post__group', 'post__author').annotate(total=Count('pk')):
+        get(row['post__group'], row['post__author']).likes_received = row['total']
+    for row in Comment.objects.order_by().values('post__group', 'author').annotate(total=Count('pk')):
+        get(row['post__group'], row['author']).comments_count = row['total']
+
+    for score in scores.values():
+        score.score = score.posts_count + score.likes_received * 2 + score.comments_count
+    GroupScore.objects.bulk_create(scores.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('triptales', '0012_job_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupScore',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_member', models.BooleanField(default=True)),
+                ('posts_count', models.PositiveIntegerField(default=0)),
+                ('likes_received', models.PositiveIntegerField(default=0)),
+                ('comments_count', models.PositiveIntegerField(default=0)),
+                ('score', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='userstats',
+            name='comments_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userstats',
+            name='score',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='userstats',
+            index=models.Index(fields=['score', 'user'], name='userstats_score_idx'),
+        ),
+        migrations.AddField(
+            model_name='groupscore',
+            name='group',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scores', to='triptales.gruppo'),
+        ),
+        migrations.AddField(
+            model_name='groupscore',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='group_scores', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='groupscore',
+            index=models.Index(fields=['group', 'is_member', 'score', 'user'], name='groupscore_rank_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='groupscore',
+            unique_together={('group', 'user')},
+        ),
+        migrations.RunPython(populate_scores, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 4.2.20 on 2026-10-16 22:59
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+import django.db.models.deletion
+
+
+def populate_daily_scores(apps, schema_editor):
+    DiaryPost = apps.get_model('triptales', 'DiaryPost')
+    Like = apps.get_model('triptales', 'Like')
+    Comment = apps.get_model('triptales', 'Comment')
+    DailyScore = apps.get_model('triptales', 'DailyScore')
+
+    # Solo i giorni ancora entro la retention (vedi settings.DAILY_SCORE_RETENTION_DAYS)
+    since = timezone.now() - timedelta(days=getattr(settings, 'DAILY_SCORE_RETENTION_DAYS', 400))
+    buckets = {}
+
+    def add(row, user_field, group_field, counter):
+        key = (row[user_field], row[group_field], row['day'])
+        if key not in buckets:
+            buckets[key] = DailyScore(user_id=key[0], group_id=key[1], day=key[2])
+        setattr(buckets[key], counter, row['total'])
+
+    sources = [
+        (DiaryPost.objects.filter(created_at__gte=since), 'author', 'group', 'posts_count'),
+        (Like.objects.filter(created_at__gte=since), 'post__author', 'post__group', 'likes_received'),
+        (Comment.objects.filter(created_at__gte=since), 'author', 'post__group', 'comments_count'),
+    ]
+    for queryset, user_field, group_field, counter in sources:
+        rows = queryset.annotate(day=TruncDate('created_at')).order_by().values(
+            user_field, group_field, 'day'
+        ).annotate(total=Count('pk'))
+        for row in rows:
+            add(row, user_field, group_field, counter)
+
+    for bucket in buckets.values():
+        bucket.score = bucket.posts_count + bucket.likes_received * 2 + bucket.comments_count
+    DailyScore.objects.bulk_create(buckets.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('triptales', '0013_leaderboard_scores'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyScore',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('posts_count', models.PositiveIntegerField(default=0)),
+                ('likes_received', models.PositiveIntegerField(default=0)),
+                ('comments_count', models.PositiveIntegerField(default=0)),
+                ('score', models.PositiveIntegerField(default=0)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_scores', to='triptales.gruppo')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_scores', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['group', 'day'], name='dailyscore_group_day_idx'), models.Index(fields=['day'], name='dailyscore_day_idx')],
+                'unique_together': {('user', 'group', 'day')},
+            },
+        ),
+        migrations.RunPython(populate_daily_scores, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 4.2.20 on 2026-10-16 23:05
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+import django.utils.timezone
+
+
+def populate_group_activity(apps, schema_editor):
+    Gruppo = apps.get_model('triptales', 'Gruppo')
+    GroupMembership = apps.get_model('triptales', 'GroupMembership')
+    DiaryPost = apps.get_model('triptales', 'DiaryPost')
+    ChatMessage = apps.get_model('triptales', 'ChatMessage')
+
+    members = dict(GroupMembership.objects.order_by().values('group').annotate(total=Count('pk')).values_list('group', 'total'))
+    posts = {
+        row['group']: row for row in
+        DiaryPost.objects.order_by().values('group').annotate(total=Count('pk'), last=Max('created_at'))
+    }
+    messages = dict(ChatMessage.objects.order_by().values('group').annotate(last=Max('created_at')).values_list('group', 'last'))
+
+    groups = list(Gruppo.objects.all())
+    for group in groups:
+        group.member_count = members.get(group.pk, 0)
+        group.post_count = posts[group.pk]['total'] if group.pk in posts else 0
+        activity = [group.created_at, messages.get(group.pk)]
+        if group.pk in posts:
+            activity.append(posts[group.pk]['last'])
+        group.last_activity_at = max(when for when in activity if when is not None)
+    Gruppo.objects.bulk_update(groups, ['member_count', 'post_count', 'last_activity_at'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('triptales', '0014_daily_scores'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gruppo',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='gruppo',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='gruppo',
+            name='post_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='gruppo',
+            index=models.Index(fields=['-last_activity_at', '-id'], name='gruppo_activity_idx'),
+        ),
+        migrations.RunPython(populate_group_activity, migrations.RunPython.noop),
+    ]
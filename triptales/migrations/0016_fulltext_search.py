@@ -0,0 +1,22 @@
+from django.db import migrations
+
+from triptales.search_service import create_search_indexes, drop_search_indexes
+
+
+def create_indexes(apps, schema_editor):
+    create_search_indexes(schema_editor)
+
+
+def drop_indexes(apps, schema_editor):
+    drop_search_indexes(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('triptales', '0015_group_activity'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
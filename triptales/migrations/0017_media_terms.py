@@ -0,0 +1,52 @@
+# Generated by Django 4.2.20 on 2026-10-16 23:11
+
+from django.db import migrations, models
+from django.db.models import Q
+import django.db.models.deletion
+
+from triptales.media_search_service import media_terms
+
+
+def populate_media_terms(apps, schema_editor):
+    PostMedia = apps.get_model('triptales', 'PostMedia')
+    MediaTerm = apps.get_model('triptales', 'MediaTerm')
+
+    with_results = PostMedia.objects.filter(
+        Q(detected_objects__isnull=False) | Q(ocr_text__gt='') | Q(caption__gt='')
+    ).select_related('post')
+    terms = []
+    for media in with_results.iterator(chunk_size=500):
+        terms.extend(
+            MediaTerm(media_id=media.pk, post_id=media.post_id, group_id=media.post.group_id, kind=kind, term=term)
+            for kind, term in media_terms(media)
+        )
+        if len(terms) >= 5000:
+            MediaTerm.objects.bulk_create(terms, ignore_conflicts=True)
+            terms = []
+    MediaTerm.objects.bulk_create(terms, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('triptales', '0016_fulltext_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('label', 'Object label'), ('word', 'Text word')], max_length=5)),
+                ('term', models.CharField(max_length=64)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='media_terms', to='triptales.gruppo')),
+                ('media', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='terms', to='triptales.postmedia')),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='media_terms', to='triptales.diarypost')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['group', 'kind', 'term', 'media'], name='mediaterm_group_term_idx'), models.Index(fields=['kind', 'term', 'media'], name='mediaterm_term_idx')],
+                'unique_together': {('media', 'kind', 'term')},
+            },
+        ),
+        migrations.RunPython(populate_media_terms, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.20 on 2026-10-16 23:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('triptales', '0017_media_terms'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='postmedia',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.20 on 2026-10-16 23:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('triptales', '0020_media_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='postmedia',
+            name='captured_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.20 on 2026-10-16 23:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('triptales', '0021_media_captured_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['group', 'created_at', 'id'], name='chatmessage_group_created_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='chatmessage',
+            name='chatmessage_group_id_idx',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.20 on 2026-10-17 00:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('triptales', '0022_chat_created_order'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='postmedia',
+            name='exif_read',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
@@ -6,7 +6,13 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
 
+from django.db import transaction
+
+from triptales.activity_service import ActivityService, media_counters
 from triptales.badge_service import BadgeService
+from triptales.image_service import ImageService
+from triptales.media_search_service import MediaSearchService
+from triptales.membership_cache import request_is_member
 
 
 # Note: This is a placeholder service for ML Kit integration
@@ -85,13 +91,14 @@ def process_ml_results(request):
         post = DiaryPost.objects.get(id=post_id)
 
         # Ensure user has permission (is post author or group member)
-        if post.author != request.user and not post.group.memberships.filter(user=request.user).exists():
+        if post.author != request.user and not request_is_member(request, post.group_id):
             return Response({"error": "Permission denied"}, status=status.HTTP_403_FORBIDDEN)
 
         # Find associated media or create new one
         media_id = data.get('media_id')
         if media_id:
             media = PostMedia.objects.get(id=media_id)
+            previous_counters = media_counters(media)
         else:
             # Create new media entry if media_id not provided
             media_file = request.FILES.get('media_file')
@@ -99,11 +106,12 @@ def process_ml_results(request):
                 return Response({"error": "media_file is required for new media"},
                                 status=status.HTTP_400_BAD_REQUEST)
 
-            media = PostMedia.objects.create(
+            media = PostMedia(
                 post=post,
                 media_type=data.get('media_type', 'image'),
                 media_url=media_file
             )
+            previous_counters = None
 
         # Update media with ML Kit results
         if 'detected_objects' in ml_results:
@@ -122,10 +130,17 @@ def process_ml_results(request):
             media.latitude = float(latitude)
             media.longitude = float(longitude)
 
-        media.save()
-
-        # Check for badge eligibility
-        BadgeService.check_all_badges(request.user)
+        with transaction.atomic():
+            media.save()
+            if previous_counters is None:
+                ActivityService.media_added(media)
+                ImageService.schedule_renditions(media)
+            else:
+                ActivityService.media_updated(media, previous_counters)
+            MediaSearchService.index_media(media)
+
+        # Queue the badge eligibility check
+        BadgeService.schedule_check(media.post.author_id)
 
         return Response({
             "id": media.id,
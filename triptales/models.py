@@ -1,7 +1,30 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.utils import timezone
 
+from .geo_service import geo_cell_for
+
+
+def update_geo_cell(save_kwargs):
+    """Aggiunge geo_cell agli update_fields quando cambiano le coordinate."""
+    update_fields = save_kwargs.get('update_fields')
+    if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+        save_kwargs['update_fields'] = set(update_fields) | {'geo_cell'}
+
+
+def exclude_from_full_save(instance, save_kwargs, excluded):
+    """
+    Un salvataggio completo di una riga esistente non riscrive i campi in
+    excluded (contatori aggiornati con F() o campi scritti solo dai job),
+    che nell'istanza in memoria possono essere vecchi.
+    """
+    if not instance._state.adding and save_kwargs.get('update_fields') is None:
+        save_kwargs['update_fields'] = [
+            field.name for field in instance._meta.concrete_fields
+            if not field.primary_key and field.name not in excluded
+        ]
 
 
 
@@ -24,6 +47,19 @@ class Gruppo(models.Model):
     created_by = models.ForeignKey(Utente, on_delete=models.CASCADE, related_name='created_groups')
     created_at = models.DateTimeField(default=timezone.now)
     is_private = models.BooleanField(default=False)  # Campo aggiunto
+    # Contatori denormalizzati, aggiornati da ActivityService e dai segnali delle membership
+    last_activity_at = models.DateTimeField(default=timezone.now)  # ultimo post o messaggio
+    member_count = models.PositiveIntegerField(default=0)
+    post_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-last_activity_at', '-id'], name='gruppo_activity_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        exclude_from_full_save(self, kwargs, {'last_activity_at', 'member_count', 'post_count'})
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.name
@@ -56,15 +92,65 @@ class DiaryPost(models.Model):
     latitude = models.FloatField(null=True, blank=True)
     longitude = models.FloatField(null=True, blank=True)
     location_name = models.CharField(max_length=255, null=True, blank=True)
-    is_chat_message = models.BooleanField(default=False)
+    # Cella geohash calcolata da latitude/longitude, usata come indice spaziale
+    geo_cell = models.CharField(max_length=12, null=True, blank=True, db_index=True, editable=False)
+    # Contatori denormalizzati, aggiornati da ActivityService
+    likes_count = models.PositiveIntegerField(default=0, editable=False)
+    comments_count = models.PositiveIntegerField(default=0, editable=False)
 
     class Meta:
         ordering = ['created_at']  # Ordina per data di creazione
+        indexes = [
+            # Clustering della mappa per gruppo sui prefissi di geo_cell
+            models.Index(fields=['group', 'geo_cell'], name='diarypost_group_cell_idx'),
+            # Paginazione keyset su (created_at, id) per gruppo e per autore
+            models.Index(fields=['group', 'created_at', 'id'], name='diarypost_group_created_idx'),
+            models.Index(fields=['author', 'created_at', 'id'], name='diarypost_author_created_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.geo_cell = geo_cell_for(self.latitude, self.longitude)
+        update_geo_cell(kwargs)
+        exclude_from_full_save(self, kwargs, {'likes_count', 'comments_count'})
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.title
 
 
+class ChatMessage(models.Model):
+    """Messaggio della chat di gruppo, separato dai post del diario (append-only)."""
+    group = models.ForeignKey(Gruppo, on_delete=models.CASCADE, related_name='chat_messages')
+    author = models.ForeignKey(Utente, on_delete=models.CASCADE, related_name='chat_messages')
+    content = models.TextField(blank=True)
+    image = models.FileField(upload_to='chat_media/', null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # Scrollback della chat per gruppo in ordine di invio (created_at è preso alla ricezione)
+            models.Index(fields=['group', 'created_at', 'id'], name='chatmessage_group_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"Message by {self.author.username} in {self.group.name}"
+
+
+class MediaBlob(models.Model):
+    """
+    File di un media salvato una sola volta per contenuto (SHA-256): i
+    PostMedia con gli stessi byte puntano allo stesso blob (vedi blob_service).
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to='post_media/', max_length=255)
+    size = models.PositiveBigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)  # PostMedia che usano il file
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.ref_count} riferimenti)"
+
+
 class PostMedia(models.Model):
     MEDIA_TYPES = [
         ('image', 'Image'),
@@ -80,17 +166,86 @@ class PostMedia(models.Model):
     caption = models.TextField(null=True, blank=True)
     latitude = models.FloatField(null=True, blank=True)
     longitude = models.FloatField(null=True, blank=True)
+    geo_cell = models.CharField(max_length=12, null=True, blank=True, db_index=True, editable=False)
+    captured_at = models.DateTimeField(null=True, blank=True)  # data di scatto, dall'EXIF se il client non la invia
+    # EXIF già letto (all'upload o da extract_exif): le foto senza metadati non vengono rilette
+    exif_read = models.BooleanField(default=False, editable=False)
+    # Versioni ridimensionate delle immagini: {"128": "<nome nello storage>", ...}, vedi image_service
+    renditions = models.JSONField(default=dict, blank=True, editable=False)
+    blob = models.ForeignKey(MediaBlob, on_delete=models.PROTECT, null=True, blank=True,
+                             related_name='media', editable=False)
+
+    def save(self, *args, **kwargs):
+        self.geo_cell = geo_cell_for(self.latitude, self.longitude)
+        update_geo_cell(kwargs)
+        # renditions è scritto solo dal job delle immagini
+        exclude_from_full_save(self, kwargs, {'renditions'})
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.media_type} for {self.post.title}"
 
 
+class UploadSession(models.Model):
+    """
+    Upload a blocchi di un media grande (video): i byte ricevuti sono in un
+    file parziale (vedi upload_service) finché il client non finalizza.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(Utente, on_delete=models.CASCADE, related_name='upload_sessions')
+    post = models.ForeignKey(DiaryPost, on_delete=models.CASCADE, related_name='upload_sessions')
+    filename = models.CharField(max_length=255)
+    media_type = models.CharField(max_length=10, choices=PostMedia.MEDIA_TYPES)
+    total_size = models.PositiveBigIntegerField()
+    received_size = models.PositiveBigIntegerField(default=0)  # byte contigui ricevuti dall'inizio
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(default=timezone.now, db_index=True)  # ultimo blocco ricevuto
+
+    def __str__(self):
+        return f"Upload {self.filename} ({self.received_size}/{self.total_size})"
+
+
+class MediaTerm(models.Model):
+    """
+    Indice invertito dei risultati ML dei media: etichette degli oggetti
+    riconosciuti e parole di OCR e caption, normalizzate (vedi media_search_service).
+    """
+    KIND_CHOICES = [
+        ('label', 'Object label'),
+        ('word', 'Text word'),
+    ]
+
+    media = models.ForeignKey(PostMedia, on_delete=models.CASCADE, related_name='terms')
+    # Post e gruppo denormalizzati per filtrare senza join
+    post = models.ForeignKey(DiaryPost, on_delete=models.CASCADE, related_name='media_terms')
+    group = models.ForeignKey(Gruppo, on_delete=models.CASCADE, related_name='media_terms')
+    kind = models.CharField(max_length=5, choices=KIND_CHOICES)
+    term = models.CharField(max_length=64)
+
+    class Meta:
+        unique_together = ('media', 'kind', 'term')
+        indexes = [
+            models.Index(fields=['group', 'kind', 'term', 'media'], name='mediaterm_group_term_idx'),
+            models.Index(fields=['kind', 'term', 'media'], name='mediaterm_term_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind}:{self.term} -> media {self.media_id}"
+
+
 class Comment(models.Model):
     post = models.ForeignKey(DiaryPost, on_delete=models.CASCADE, related_name='comments')
     author = models.ForeignKey(Utente, on_delete=models.CASCADE, related_name='comments')
     content = models.TextField()
     created_at = models.DateTimeField(default=timezone.now)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['post', 'created_at', 'id'], name='comment_post_created_idx'),
+        ]
+
     def __str__(self):
         return f"Comment by {self.author.username} on {self.post.title}"
 
@@ -129,6 +284,84 @@ class UserBadge(models.Model):
         return f"{self.user.username} earned {self.badge.name}"
 
 
+class UserStats(models.Model):
+    """Contatori di attività dell'utente, aggiornati in modo incrementale da ActivityService."""
+    user = models.OneToOneField(Utente, on_delete=models.CASCADE, primary_key=True, related_name='activity_stats')
+    posts_count = models.PositiveIntegerField(default=0)
+    locations_count = models.PositiveIntegerField(default=0)  # luoghi distinti dei post
+    photos_count = models.PositiveIntegerField(default=0)
+    ocr_count = models.PositiveIntegerField(default=0)  # media con testo OCR
+    detections_count = models.PositiveIntegerField(default=0)  # media con oggetti riconosciuti
+    captions_count = models.PositiveIntegerField(default=0)
+    likes_received = models.PositiveIntegerField(default=0)
+    comments_count = models.PositiveIntegerField(default=0)  # commenti scritti
+    # Punteggio della classifica globale (vedi activity_service.SCORE_WEIGHTS)
+    score = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['score', 'user'], name='userstats_score_idx'),
+        ]
+
+    def __str__(self):
+        return f"Stats of {self.user.username}"
+
+
+class GroupScore(models.Model):
+    """Punteggio della classifica di un utente per l'attività in un gruppo."""
+    group = models.ForeignKey(Gruppo, on_delete=models.CASCADE, related_name='scores')
+    user = models.ForeignKey(Utente, on_delete=models.CASCADE, related_name='group_scores')
+    # Falso quando l'utente lascia il gruppo: il punteggio resta se rientra
+    is_member = models.BooleanField(default=True)
+    posts_count = models.PositiveIntegerField(default=0)
+    likes_received = models.PositiveIntegerField(default=0)
+    comments_count = models.PositiveIntegerField(default=0)
+    score = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('group', 'user')
+        indexes = [
+            models.Index(fields=['group', 'is_member', 'score', 'user'], name='groupscore_rank_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} in {self.group.name}: {self.score}"
+
+
+class DailyScore(models.Model):
+    """Punteggio giornaliero di un utente in un gruppo, per le classifiche su finestre di date."""
+    user = models.ForeignKey(Utente, on_delete=models.CASCADE, related_name='daily_scores')
+    group = models.ForeignKey(Gruppo, on_delete=models.CASCADE, related_name='daily_scores')
+    day = models.DateField()
+    posts_count = models.PositiveIntegerField(default=0)
+    likes_received = models.PositiveIntegerField(default=0)
+    comments_count = models.PositiveIntegerField(default=0)
+    score = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'group', 'day')
+        indexes = [
+            models.Index(fields=['group', 'day'], name='dailyscore_group_day_idx'),
+            models.Index(fields=['day'], name='dailyscore_day_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} in {self.group.name} on {self.day}: {self.score}"
+
+
+class UserLocation(models.Model):
+    """Luoghi distinti dei post di un utente, con quanti post ci sono stati scritti."""
+    user = models.ForeignKey(Utente, on_delete=models.CASCADE, related_name='locations')
+    name = models.CharField(max_length=255)
+    posts_count = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        unique_together = ('user', 'name')
+
+    def __str__(self):
+        return f"{self.user.username} at {self.name}"
+
+
 # Aggiungi questo al file triptales/models.py
 
 class GroupInvite(models.Model):
@@ -148,4 +381,31 @@ class GroupInvite(models.Model):
         unique_together = ('group', 'invited_user')
 
     def __str__(self):
-        return f"Invite for {self.invited_user.username} to {self.group.name}"
\ No newline at end of file
+        return f"Invite for {self.invited_user.username} to {self.group.name}"
+
+class Job(models.Model):
+    """Lavoro in coda per il worker in background (`python manage.py run_jobs`)."""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('failed', 'Failed'),
+    ]
+
+    task = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    # Un solo job in attesa per chiave: le richieste duplicate vengono accorpate
+    dedupe_key = models.CharField(max_length=255, null=True, blank=True, unique=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    run_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    claimed_by = models.CharField(max_length=100, null=True, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='job_status_run_at_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.task} ({self.status})"
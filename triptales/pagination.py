@@ -0,0 +1,120 @@
+# triptales/pagination.py
+import base64
+import binascii
+import json
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+
+
+class KeysetPagination:
+    """
+    Paginazione a cursore (keyset) su un ordinamento stabile, per default
+    (created_at, id). ?before=<cursor> scorre verso gli elementi più vecchi,
+    ?after=<cursor> verso quelli più recenti; ?limit= imposta la pagina.
+
+    newest_first decide l'ordine dei risultati restituiti; start_from_newest
+    fa partire la prima pagina dagli elementi più recenti anche quando i
+    risultati sono in ordine cronologico (es. scrollback della chat).
+    """
+    page_size = 20
+    max_page_size = 100
+    limit_query_param = 'limit'
+    invalid_cursor_message = 'Cursore non valido.'
+
+    def __init__(self, fields=('created_at', 'id'), newest_first=True, start_from_newest=False):
+        self.fields = fields
+        self.newest_first = newest_first
+        self.start_from_newest = start_from_newest or newest_first
+        self.before = None
+        self.after = None
+
+    def paginate_queryset(self, queryset, request):
+        limit = self.get_limit(request)
+        before = self.decode_cursor(request.query_params.get('before'), queryset.model)
+        after = self.decode_cursor(request.query_params.get('after'), queryset.model)
+
+        if after is not None:
+            queryset = queryset.filter(self._keyset_filter(after, 'gt'))
+            if before is not None:
+                queryset = queryset.filter(self._keyset_filter(before, 'lt'))
+            ascending = True
+        elif before is not None:
+            queryset = queryset.filter(self._keyset_filter(before, 'lt'))
+            ascending = False
+        else:
+            ascending = not self.start_from_newest
+
+        ordering = self.fields if ascending else [f'-{name}' for name in self.fields]
+        rows = list(queryset.order_by(*ordering)[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        if ascending:
+            has_older, has_newer = after is not None, has_more or before is not None
+            oldest, newest = (rows[0], rows[-1]) if rows else (None, None)
+        else:
+            has_older, has_newer = has_more, before is not None
+            oldest, newest = (rows[-1], rows[0]) if rows else (None, None)
+
+        self.before = self.encode_cursor(oldest) if has_older and oldest else None
+        self.after = self.encode_cursor(newest) if has_newer and newest else None
+
+        if ascending == self.newest_first:
+            rows.reverse()
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response({
+            'before': self.before,
+            'after': self.after,
+            'results': data
+        })
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(limit, 1), self.max_page_size)
+
+    def encode_cursor(self, obj):
+        values = []
+        for name in self.fields:
+            value = getattr(obj, name)
+            values.append(value.isoformat() if hasattr(value, 'isoformat') else value)
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, cursor, model):
+        if not cursor:
+            return None
+        try:
+            raw_values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if not isinstance(raw_values, list) or len(raw_values) != len(self.fields):
+                raise ValueError
+            values = [self.field_value(model, name, raw) for name, raw in zip(self.fields, raw_values)]
+        except (binascii.Error, UnicodeDecodeError, ValueError, TypeError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        if any(value is None for value in values):
+            raise NotFound(self.invalid_cursor_message)
+        return values
+
+    @staticmethod
+    def field_value(model, name, raw):
+        try:
+            return model._meta.get_field(name).to_python(raw)
+        except FieldDoesNotExist:
+            # Campo annotato (es. un punteggio aggregato): accetta solo valori numerici
+            if isinstance(raw, bool) or not isinstance(raw, (int, float)):
+                raise ValueError
+            return raw
+
+    def _keyset_filter(self, values, lookup):
+        """(f1, f2, ...) > / < (v1, v2, ...) espresso come OR di prefissi uguali."""
+        condition = Q()
+        for position, name in enumerate(self.fields):
+            equal = {self.fields[i]: values[i] for i in range(position)}
+            condition |= Q(**equal, **{f'{name}__{lookup}': values[position]})
+        return condition
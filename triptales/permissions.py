@@ -1,5 +1,5 @@
 from rest_framework import permissions
-from .models import GroupMembership
+from .membership_cache import request_is_admin, request_is_member
 
 
 class IsOwnerOrReadOnly(permissions.BasePermission):
@@ -30,9 +30,9 @@ class IsMemberOrReadOnly(permissions.BasePermission):
         if request.method in permissions.SAFE_METHODS:
             return True
 
-        # Check if user is a member of the group
-        if hasattr(obj, 'group'):
-            return GroupMembership.objects.filter(user=request.user, group=obj.group).exists()
+        # Check if user is a member of the group (group_id non carica il Gruppo)
+        if getattr(obj, 'group_id', None) is not None:
+            return request_is_member(request, obj.group_id)
         return False
 
 
@@ -47,15 +47,11 @@ class IsGroupAdmin(permissions.BasePermission):
             return True
 
         # Check if user is an admin of the group
-        if hasattr(obj, 'group'):
-            group = obj.group
-        elif hasattr(obj, 'membership'):
-            group = obj.membership.group
+        if getattr(obj, 'group_id', None) is not None:
+            group_id = obj.group_id
+        elif getattr(obj, 'membership_id', None) is not None:
+            group_id = obj.membership.group_id
         else:
             return False
 
-        return GroupMembership.objects.filter(
-            user=request.user,
-            group=group,
-            role='admin'
-        ).exists()
\ No newline at end of file
+        return request_is_admin(request, group_id)
\ No newline at end of file
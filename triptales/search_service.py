@@ -0,0 +1,187 @@
+# triptales/search_service.py
+"""
+Ricerca full-text su gruppi e post.
+
+Su SQLite l'indice è una tabella FTS5 external-content tenuta allineata da
+trigger; su MySQL è un indice FULLTEXT. Le query restituiscono lo stesso
+queryset annotato con rank (più alto = più rilevante); sugli altri database
+si ripiega su icontains senza ranking.
+"""
+import re
+
+from django.db import connection
+from django.db.models import FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+from rest_framework import filters
+
+from .models import DiaryPost, Gruppo
+
+MAX_SEARCH_TERMS = 10
+
+# modello -> (colonne indicizzate, pesi per il ranking)
+SEARCH_INDEXES = {
+    Gruppo: (('name', 'location', 'description'), (10.0, 5.0, 1.0)),
+    DiaryPost: (('title', 'content', 'location_name'), (10.0, 1.0, 5.0)),
+}
+
+
+def search_terms(query):
+    """Parole della query (al massimo MAX_SEARCH_TERMS), senza operatori della sintassi FTS."""
+    return re.findall(r'\w+', (query or '').lower())[:MAX_SEARCH_TERMS]
+
+
+def _fts_table(model):
+    return f'{model._meta.db_table}_fts'
+
+
+def _fulltext_index_name(model):
+    return f'{model._meta.model_name}_fulltext_idx'
+
+
+SQLITE_TRIGGER_SUFFIXES = ('ai', 'ad', 'au')
+
+
+def _sqlite_create_statements(model):
+    """Tabella FTS5 external-content, trigger che la tengono allineata e ricostruzione del contenuto."""
+    columns, _ = SEARCH_INDEXES[model]
+    table = model._meta.db_table
+    fts = _fts_table(model)
+    column_list = ', '.join(columns)
+    new_values = ', '.join(f'new.{column}' for column in columns)
+    old_values = ', '.join(f'old.{column}' for column in columns)
+    return [
+        f"CREATE VIRTUAL TABLE {fts} USING fts5({column_list}, content='{table}', content_rowid='id', "
+        f"tokenize='unicode61 remove_diacritics 2')",
+        f"CREATE TRIGGER {fts}_ai AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {fts}(rowid, {column_list}) VALUES (new.id, {new_values}); END",
+        f"CREATE TRIGGER {fts}_ad AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {column_list}) VALUES ('delete', old.id, {old_values}); END",
+        # Solo sulle colonne indicizzate: gli UPDATE dei contatori non toccano l'indice
+        f"CREATE TRIGGER {fts}_au AFTER UPDATE OF {column_list} ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {column_list}) VALUES ('delete', old.id, {old_values}); "
+        f"INSERT INTO {fts}(rowid, {column_list}) VALUES (new.id, {new_values}); END",
+        f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+    ]
+
+
+def _sqlite_drop_statements(model):
+    fts = _fts_table(model)
+    return [f"DROP TRIGGER IF EXISTS {fts}_{suffix}" for suffix in SQLITE_TRIGGER_SUFFIXES] + [
+        f"DROP TABLE IF EXISTS {fts}"
+    ]
+
+
+def create_search_indexes(schema_editor):
+    """Crea gli indici full-text per il database in uso (chiamato dalle migration)."""
+    vendor = schema_editor.connection.vendor
+    for model, (columns, _) in SEARCH_INDEXES.items():
+        if vendor == 'sqlite':
+            for statement in _sqlite_create_statements(model):
+                schema_editor.execute(statement)
+        elif vendor == 'mysql':
+            schema_editor.execute(
+                f"ALTER TABLE {model._meta.db_table} ADD FULLTEXT INDEX {_fulltext_index_name(model)} "
+                f"({', '.join(columns)})"
+            )
+
+
+def drop_search_indexes(schema_editor):
+    vendor = schema_editor.connection.vendor
+    for model in SEARCH_INDEXES:
+        if vendor == 'sqlite':
+            for statement in _sqlite_drop_statements(model):
+                schema_editor.execute(statement)
+        elif vendor == 'mysql':
+            schema_editor.execute(f"ALTER TABLE {model._meta.db_table} DROP INDEX {_fulltext_index_name(model)}")
+
+
+def repair_search_indexes(connection):
+    """
+    Su SQLite una migration che ricostruisce la tabella di Gruppo o
+    DiaryPost ne elimina i trigger, e l'indice smetterebbe di seguire i
+    dati senza errori. Ricrea (e ripopola) gli indici a cui manca qualche
+    trigger; quelli non ancora creati dalla migration 0016 sono lasciati
+    stare. Restituisce i modelli riparati. Chiamato dopo ogni migrate.
+    """
+    if connection.vendor != 'sqlite':
+        return []
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')")
+        existing = {name for name, in cursor.fetchall()}
+
+        repaired = []
+        for model in SEARCH_INDEXES:
+            fts = _fts_table(model)
+            if fts not in existing:
+                continue
+            if all(f'{fts}_{suffix}' in existing for suffix in SQLITE_TRIGGER_SUFFIXES):
+                continue
+            for statement in _sqlite_drop_statements(model) + _sqlite_create_statements(model):
+                cursor.execute(statement)
+            repaired.append(model)
+    return repaired
+
+
+def fulltext_search(queryset, terms):
+    """
+    Filtra queryset (Gruppo o DiaryPost) sui post/gruppi che contengono
+    tutti i termini, anche come prefisso, e lo annota con rank.
+    """
+    model = queryset.model
+    columns, weights = SEARCH_INDEXES[model]
+    table = model._meta.db_table
+
+    if connection.vendor == 'sqlite':
+        fts = _fts_table(model)
+        match = ' '.join(f'"{term}"*' for term in terms)
+        weight_list = ', '.join(str(weight) for weight in weights)
+        # bm25() è negativo: più è basso, più il risultato è rilevante
+        rank = RawSQL(
+            f"SELECT -bm25({fts}, {weight_list}) FROM {fts} WHERE {fts} MATCH %s AND rowid = {table}.id",
+            (match,), output_field=FloatField()
+        )
+        matches = RawSQL(f"SELECT rowid FROM {fts} WHERE {fts} MATCH %s", (match,))
+        return queryset.filter(id__in=matches).annotate(rank=rank)
+
+    if connection.vendor == 'mysql':
+        column_list = ', '.join(f'{table}.{column}' for column in columns)
+        against = ' '.join(f'+{term}*' for term in terms)
+        rank = RawSQL(f"MATCH ({column_list}) AGAINST (%s IN BOOLEAN MODE)", (against,), output_field=FloatField())
+        return queryset.annotate(rank=rank).filter(rank__gt=0)
+
+    condition = Q()
+    for term in terms:
+        in_any_column = Q()
+        for column in columns:
+            in_any_column |= Q(**{f'{column}__icontains': term})
+        condition &= in_any_column
+    return queryset.filter(condition).annotate(rank=Value(0.0, output_field=FloatField()))
+
+
+def visible_groups(queryset, user):
+    """Gruppi pubblici o di cui l'utente è membro."""
+    return queryset.filter(Q(is_private=False) | Q(id__in=user.memberships.values('group')))
+
+
+def visible_posts(queryset, user):
+    """Post dei gruppi pubblici o di cui l'utente è membro."""
+    member_groups = user.memberships.values('group')
+    return queryset.filter(Q(group__is_private=False) | Q(group__in=member_groups))
+
+
+class FullTextSearchFilter(filters.SearchFilter):
+    """
+    SearchFilter di DRF sull'indice full-text: con ?search= restituisce solo
+    i risultati visibili all'utente, ordinati per rilevanza.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        terms = search_terms(request.query_params.get(self.search_param))
+        if not terms:
+            return queryset
+        if queryset.model is Gruppo:
+            queryset = visible_groups(queryset, request.user)
+        else:
+            queryset = visible_posts(queryset, request.user)
+        return fulltext_search(queryset, terms).order_by('-rank', '-id')
@@ -1,8 +1,53 @@
+from django.core.files.storage import default_storage
+from django.db import models
 from rest_framework import serializers
-from .models import Utente, Gruppo, GroupMembership, DiaryPost, PostMedia, Comment, Like, Badge, UserBadge, GroupInvite
+from .image_service import FEED_THUMBNAIL_SIZE, rendition_url
+from .models import (Utente, Gruppo, GroupMembership, DiaryPost, PostMedia, Comment, Like, Badge, UserBadge,
+                     GroupInvite, ChatMessage, UploadSession)
 
 
-class UserSerializer(serializers.ModelSerializer):
+def parse_list_param(request, name):
+    """Legge un parametro di query separato da virgole (es. ?fields=id,title)."""
+    value = request.query_params.get(name) if request is not None else None
+    if not value:
+        return None
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def sparse_fieldset_kwargs(request):
+    """Argomenti fields/expand per i serializer dinamici, solo per le letture."""
+    if request is None or request.method != 'GET':
+        return {}
+    return {
+        'fields': parse_list_param(request, 'fields'),
+        'expand': parse_list_param(request, 'expand'),
+    }
+
+
+class DynamicFieldsMixin:
+    """
+    Sparse fieldset per i ModelSerializer: fields=[...] limita i campi
+    restituiti, expand=[...] aggiunge i campi annidati di expandable_fields.
+    """
+    # nome campo -> (classe serializer, kwargs)
+    expandable_fields = {}
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        expand = kwargs.pop('expand', None)
+        super().__init__(*args, **kwargs)
+
+        for name in expand or ():
+            if name in self.expandable_fields and name not in self.fields:
+                serializer_class, options = self.expandable_fields[name]
+                self.fields[name] = serializer_class(**options)
+
+        if fields:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+class UserSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
 
     class Meta:
@@ -24,20 +69,18 @@ class UserSerializer(serializers.ModelSerializer):
         return user
 
 
-class TripGroupSerializer(serializers.ModelSerializer):
+class TripGroupSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     created_by = UserSerializer(read_only=True)
-    member_count = serializers.SerializerMethodField()
 
     class Meta:
         model = Gruppo
         fields = ['id', 'name', 'description', 'cover_image', 'start_date', 'end_date',
-                  'location', 'created_by', 'created_at', 'member_count', 'is_private']
-
-    def get_member_count(self, obj):
-        return GroupMembership.objects.filter(group=obj).count()
+                  'location', 'created_by', 'created_at', 'member_count', 'post_count',
+                  'last_activity_at', 'is_private']
+        read_only_fields = ['member_count', 'post_count', 'last_activity_at']
 
 
-class GroupMembershipSerializer(serializers.ModelSerializer):
+class GroupMembershipSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
     group = TripGroupSerializer(read_only=True)
 
@@ -46,7 +89,7 @@ class GroupMembershipSerializer(serializers.ModelSerializer):
         fields = ['id', 'user', 'group', 'join_date', 'role']
 
 
-class CommentSerializer(serializers.ModelSerializer):
+class CommentSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
 
     class Meta:
@@ -62,44 +105,130 @@ class LikeSerializer(serializers.ModelSerializer):
         fields = ['id', 'post', 'user', 'created_at']
 
 
-class PostMediaSerializer(serializers.ModelSerializer):
+class PostMediaSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    renditions = serializers.SerializerMethodField()
+
     class Meta:
         model = PostMedia
-        fields = ['id', 'post', 'media_type', 'media_url', 'created_at',
-                  'detected_objects', 'ocr_text', 'caption', 'latitude', 'longitude']
+        fields = ['id', 'post', 'media_type', 'media_url', 'renditions', 'created_at',
+                  'detected_objects', 'ocr_text', 'caption', 'latitude', 'longitude', 'captured_at']
+
+    def get_renditions(self, obj):
+        """URL delle versioni ridimensionate per lato lungo, es. {"128": ..., "512": ...}; vuoto finché non sono pronte."""
+        request = self.context.get('request')
+        urls = {}
+        for size, name in obj.renditions.items():
+            url = default_storage.url(name)
+            urls[size] = request.build_absolute_uri(url) if request else url
+        return urls
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'post', 'filename', 'media_type', 'total_size', 'received_size',
+                  'latitude', 'longitude', 'created_at', 'updated_at']
+        read_only_fields = fields
+
+
+def liked_post_ids(user, post_ids):
+    """ID dei post (tra post_ids) a cui user ha messo like, con una sola query."""
+    if user is None or not user.is_authenticated or not post_ids:
+        return set()
+    return set(Like.objects.filter(user=user, post_id__in=post_ids).values_list('post_id', flat=True))
+
+
+class DiaryPostListSerializer(serializers.ListSerializer):
+    """Risolve user_has_liked per tutta la pagina con un'unica query."""
+
+    def to_representation(self, data):
+        posts = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        request = self.context.get('request')
+        self.child.liked_post_ids = liked_post_ids(
+            getattr(request, 'user', None), [post.pk for post in posts]
+        )
+        return super().to_representation(posts)
 
 
 # triptales/serializers.py
-class DiaryPostSerializer(serializers.ModelSerializer):
+class DiaryPostSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
     comments = CommentSerializer(many=True, read_only=True)
     media = PostMediaSerializer(many=True, read_only=True)
-    likes_count = serializers.SerializerMethodField()
     user_has_liked = serializers.SerializerMethodField()
 
     class Meta:
         model = DiaryPost
         fields = ['id', 'group', 'author', 'title', 'content', 'created_at',
                   'latitude', 'longitude', 'location_name', 'comments', 'media',
-                  'likes_count', 'user_has_liked', 'is_chat_message']
+                  'likes_count', 'comments_count', 'user_has_liked']
+        read_only_fields = ['likes_count', 'comments_count']
+        list_serializer_class = DiaryPostListSerializer
 
-    def get_likes_count(self, obj):
-        return obj.likes.count()
+    # Impostato da DiaryPostListSerializer quando si serializza una lista
+    liked_post_ids = None
 
     def get_user_has_liked(self, obj):
+        if self.liked_post_ids is not None:
+            return obj.pk in self.liked_post_ids
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             return obj.likes.filter(user=request.user).exists()
         return False
 
 
-class BadgeSerializer(serializers.ModelSerializer):
+class UserSummarySerializer(serializers.ModelSerializer):
+    """Autore compatto per le liste di post."""
+
+    class Meta:
+        model = Utente
+        fields = ['id', 'username', 'profile_picture']
+
+
+class DiaryPostSummarySerializer(DiaryPostSerializer):
+    """
+    Rappresentazione compatta per le liste: niente commenti e media annidati,
+    solo i contatori e la miniatura della prima immagine. ?expand=comments,media
+    li aggiunge quando servono.
+    """
+    author = UserSummarySerializer(read_only=True)
+    thumbnail_url = serializers.SerializerMethodField()
+
+    expandable_fields = {
+        'comments': (CommentSerializer, {'many': True, 'read_only': True}),
+        'media': (PostMediaSerializer, {'many': True, 'read_only': True}),
+    }
+
+    class Meta(DiaryPostSerializer.Meta):
+        fields = ['id', 'group', 'author', 'title', 'content', 'created_at',
+                  'latitude', 'longitude', 'location_name', 'thumbnail_url',
+                  'likes_count', 'comments_count', 'user_has_liked']
+
+    def get_thumbnail_url(self, obj):
+        # Usa i media precaricati invece di una query per post
+        images = [media for media in obj.media.all() if media.media_type == 'image']
+        if not images:
+            return None
+        url = rendition_url(min(images, key=lambda media: media.pk), FEED_THUMBNAIL_SIZE)
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+
+class ChatMessageSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    author = UserSummarySerializer(read_only=True)
+
+    class Meta:
+        model = ChatMessage
+        fields = ['id', 'group', 'author', 'content', 'image', 'created_at']
+
+
+class BadgeSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Badge
         fields = ['id', 'name', 'description', 'icon_url', 'criteria']
 
 
-class UserBadgeSerializer(serializers.ModelSerializer):
+class UserBadgeSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     badge = BadgeSerializer(read_only=True)
     user = UserSerializer(read_only=True)
 
@@ -112,7 +241,7 @@ class UserBadgeSerializer(serializers.ModelSerializer):
 
 # Aggiungi questo nel file triptales/serializers.py
 
-class GroupInviteSerializer(serializers.ModelSerializer):
+class GroupInviteSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     invited_by = UserSerializer(read_only=True)
     invited_user = UserSerializer(read_only=True)
     group = TripGroupSerializer(read_only=True)
@@ -0,0 +1,85 @@
+# triptales/signals.py
+import logging
+
+from django.db import connections
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import membership_cache
+from .activity_service import counter_updates
+from .badge_service import BadgeService
+from .blob_service import BlobService
+from .exif_service import ExifService
+from .image_service import ImageService
+from .models import Badge, Gruppo, GroupMembership, GroupScore, PostMedia, UserStats, Utente
+from .search_service import repair_search_indexes
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_save, sender=GroupMembership)
+@receiver(post_delete, sender=GroupMembership)
+def membership_changed(sender, instance, **kwargs):
+    membership_cache.invalidate(instance.user_id)
+
+
+@receiver(post_save, sender=GroupMembership)
+def membership_saved(sender, instance, created, **kwargs):
+    if not created:
+        return
+    Gruppo.objects.filter(pk=instance.group_id).update(member_count=F('member_count') + 1)
+    # La classifica del gruppo elenca anche i membri senza attività
+    if not GroupScore.objects.filter(group_id=instance.group_id, user_id=instance.user_id).update(is_member=True):
+        GroupScore.objects.bulk_create([GroupScore(group_id=instance.group_id, user_id=instance.user_id)], ignore_conflicts=True)
+
+
+@receiver(post_delete, sender=GroupMembership)
+def membership_deleted(sender, instance, **kwargs):
+    Gruppo.objects.filter(pk=instance.group_id).update(**counter_updates({'member_count': -1}))
+    GroupScore.objects.filter(group_id=instance.group_id, user_id=instance.user_id).update(is_member=False)
+
+
+@receiver(post_save, sender=Utente)
+def user_created(sender, instance, created, **kwargs):
+    # Ogni utente compare nella classifica globale, anche senza attività
+    if created:
+        UserStats.objects.bulk_create([UserStats(user=instance)], ignore_conflicts=True)
+
+
+@receiver(post_save, sender=Badge)
+@receiver(post_delete, sender=Badge)
+def badge_changed(sender, instance, **kwargs):
+    BadgeService.invalidate_rules()
+
+
+@receiver(pre_save, sender=PostMedia)
+def media_file_saving(sender, instance, **kwargs):
+    if instance.media_url and not instance.media_url._committed:
+        # Coordinate e data di scatto dall'EXIF del file nuovo, anche per il post se non le ha
+        ExifService.apply_upload(instance)
+        ExifService.locate_post(instance)
+        # Le renditions del file sostituito vanno rifatte dopo il salvataggio
+        instance._file_replaced = instance.pk is not None
+    # I file nuovi vengono salvati una sola volta per contenuto
+    BlobService.attach(instance)
+
+
+@receiver(post_save, sender=PostMedia)
+def media_file_saved(sender, instance, **kwargs):
+    BlobService.release_replaced(instance)
+    if instance.__dict__.pop('_file_replaced', False):
+        ImageService.file_replaced(instance)
+
+
+@receiver(post_delete, sender=PostMedia)
+def media_deleted(sender, instance, **kwargs):
+    if instance.blob_id:
+        BlobService.release(instance.blob_id)
+    ImageService.delete_renditions(instance)
+
+
+def search_indexes_migrated(sender, using, **kwargs):
+    """post_migrate (collegato in apps.py): ricrea i trigger full-text persi da una ricostruzione delle tabelle."""
+    for model in repair_search_indexes(connections[using]):
+        logger.warning("Indice full-text di %s ricreato: mancavano i trigger", model._meta.label)
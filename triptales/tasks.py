@@ -0,0 +1,62 @@
+# triptales/tasks.py
+"""Task eseguiti dal worker in background (vedi triptales/jobs.py)."""
+import logging
+from datetime import datetime, time, timedelta
+
+from django.utils import timezone
+
+from .activity_service import ActivityService
+from .badge_service import BadgeService
+from .image_service import ImageService
+from .jobs import enqueue, task
+from .upload_service import UploadService
+
+logger = logging.getLogger(__name__)
+
+
+@task('award_badges', batch=True)
+def award_badges(payloads):
+    """Valuta i badge di tutti gli utenti dei job presi in carico insieme."""
+    BadgeService.award_badges({payload['user_id'] for payload in payloads})
+
+
+@task('generate_renditions', batch=True)
+def generate_renditions(payloads):
+    """Renditions delle immagini caricate, elaborate in parallelo sul pool di processi."""
+    ImageService.generate_renditions({payload['media_id'] for payload in payloads})
+
+
+@task('prune_daily_scores')
+def prune_daily_scores(payload):
+    """Pulizia giornaliera dei bucket delle classifiche; si riprogramma per il giorno dopo."""
+    ActivityService.prune_daily_scores()
+    schedule_daily_pruning(timezone.localdate() + timedelta(days=1))
+
+
+def schedule_daily_pruning(day=None):
+    """Accoda la pulizia dei bucket per l'inizio di day (default oggi), una sola per giorno."""
+    day = day or timezone.localdate()
+    enqueue(
+        'prune_daily_scores',
+        dedupe_key=f'prune_daily_scores:{day.isoformat()}',
+        run_at=timezone.make_aware(datetime.combine(day, time.min))
+    )
+
+
+@task('collect_upload_sessions')
+def collect_upload_sessions(payload):
+    """Eliminazione oraria delle sessioni di upload abbandonate; si riprogramma per l'ora dopo."""
+    removed = UploadService.collect_expired()
+    if removed:
+        logger.info("Sessioni di upload scadute eliminate: %s", removed)
+    schedule_upload_collection(timezone.now() + timedelta(hours=1))
+
+
+def schedule_upload_collection(when=None):
+    """Accoda la pulizia delle sessioni di upload per l'ora di when (default adesso), una sola per ora."""
+    when = (when or timezone.now()).replace(minute=0, second=0, microsecond=0)
+    enqueue(
+        'collect_upload_sessions',
+        dedupe_key=f'collect_upload_sessions:{when.isoformat()}',
+        run_at=when
+    )
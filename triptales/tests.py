@@ -1,3 +1,1243 @@
-from django.test import TestCase
+import asyncio
+import io
+import os
+import random
+import shutil
+import tempfile
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from math import asin, atan2, cos, degrees, radians, sin
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import ExifTags, Image
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from rest_framework.test import APIClient
+
+from . import jobs, signals, upload_service
+from .consumer import ChatConsumer
+from .activity_service import DAILY_SCORE_RETENTION_DAYS, ActivityService
+from .badge_service import BadgeService, compile_rules
+from .channel_layer import FRAME_HEADER, MAX_FRAME_SIZE, UnixSocketChannelLayer, encode_frame, read_frame
+from .chat_buffer import ChatMessageBuffer
+from .image_service import ImageService
+from .media_search_service import MediaSearchService
+from .exif_service import read_exif
+from .geo_service import EARTH_RADIUS_KM, calculate_distance, encode_geohash, nearby_cell_prefixes
+from .models import (
+    Badge, ChatMessage, Comment, DailyScore, DiaryPost, GroupMembership, GroupScore, Gruppo, Job, Like,
+    MediaBlob, MediaTerm, PostMedia, UploadSession, UserBadge, UserLocation, UserStats, Utente,
+)
+
+
+class TripTalesTestCase(TestCase):
+    """Un gruppo con tre membri (u0 admin) e i file dei media in una cartella temporanea."""
+
+    def setUp(self):
+        cache.clear()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.users = [Utente.objects.create_user(f'u{i}', f'u{i}@example.com', 'password') for i in range(3)]
+        self.group = Gruppo.objects.create(
+            name='Roma trip', description='Viaggio a Roma', start_date=date.today(),
+            end_date=date.today(), location='Roma', created_by=self.users[0]
+        )
+        for i, user in enumerate(self.users):
+            GroupMembership.objects.create(user=user, group=self.group, role='admin' if i == 0 else 'member')
+        self.post = DiaryPost.objects.create(group=self.group, author=self.users[0], title='Colosseo', content='Visita')
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def walk(self, client, url, cursor, **params):
+        """Segue il cursore cursor ('before' o 'after') fino all'ultima pagina; restituisce gli id."""
+        ids = []
+        while True:
+            response = client.get(url, params)
+            self.assertEqual(response.status_code, 200, response.content)
+            data = response.json()
+            ids += [item['id'] for item in data['results']]
+            if not data[cursor]:
+                return ids
+            params[cursor] = data[cursor]
+
+
+def destination(latitude, longitude, distance_km, bearing):
+    """Punto a distance_km da (latitude, longitude) nella direzione bearing (gradi)."""
+    lat1, lon1, theta = radians(latitude), radians(longitude), radians(bearing)
+    delta = distance_km / EARTH_RADIUS_KM
+    lat2 = asin(sin(lat1) * cos(delta) + cos(lat1) * sin(delta) * cos(theta))
+    lon2 = lon1 + atan2(sin(theta) * sin(delta) * cos(lat1), cos(delta) - sin(lat1) * sin(lat2))
+    return degrees(lat2), (degrees(lon2) + 180.0) % 360.0 - 180.0
+
+
+class NearbyTests(TripTalesTestCase):
+    # Roma, vicino ai poli e a cavallo dell'antimeridiano
+    CENTERS = [(41.9, 12.5), (89.5, 10.0), (-89.2, -170.0), (0.0, 179.99), (65.0, -179.9)]
+    RADII = [0.05, 0.5, 5, 50, 400]
+
+    def setUp(self):
+        super().setUp()
+        rng = random.Random(7)
+        for latitude, longitude in self.CENTERS:
+            # Distanze da pochi metri a qualche centinaio di km, in tutte le direzioni
+            for i in range(25):
+                point = destination(latitude, longitude, 10 ** rng.uniform(-2, 2.8), rng.uniform(0, 360))
+                DiaryPost.objects.create(
+                    group=self.group, author=self.users[0], title=f'Punto {i}', content='c',
+                    latitude=point[0], longitude=point[1]
+                )
+        self.client = self.client_for(self.users[0])
+
+    def test_matches_haversine_scan(self):
+        posts = list(DiaryPost.objects.filter(latitude__isnull=False))
+        for latitude, longitude in self.CENTERS:
+            for radius in self.RADII:
+                expected = sorted(
+                    (calculate_distance(latitude, longitude, p.latitude, p.longitude), p.id) for p in posts
+                    if calculate_distance(latitude, longitude, p.latitude, p.longitude) <= radius
+                )
+                response = self.client.get('/api/diary-posts/nearby/', {
+                    'latitude': latitude, 'longitude': longitude, 'radius': radius
+                })
+                self.assertEqual(response.status_code, 200, response.content)
+                self.assertEqual(
+                    [p['id'] for p in response.json()], [post_id for _, post_id in expected],
+                    (latitude, longitude, radius)
+                )
+
+    def test_cell_prefixes(self):
+        # Il cerchio attraversa l'antimeridiano: servono celle da entrambi i lati
+        prefixes = nearby_cell_prefixes(0.0, 179.99, 5)
+        self.assertTrue(any(p.startswith('x') for p in prefixes))
+        self.assertTrue(any(p.startswith('8') for p in prefixes))
+        # Un cerchio che raggiunge il polo non usa il prefiltro
+        self.assertIsNone(nearby_cell_prefixes(89.99, 0.0, 5))
+        # Raggio più piccolo di una cella: precisione massima
+        self.assertEqual({len(p) for p in nearby_cell_prefixes(41.9, 12.5, 0.05)}, {7})
+        # La precisione segue il raggio richiesto, non il rettangolo limitato
+        self.assertEqual({len(p) for p in nearby_cell_prefixes(41.9, 12.5, 50)}, {3})
+
+
+class MapClusterTests(TripTalesTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = random.Random(2)
+        points = [(45 + rng.uniform(-1, 1), 9 + rng.uniform(-1, 1)) for _ in range(30)]
+        # Isole Figi, a cavallo dell'antimeridiano
+        points += [(-17.0, 179.2), (-17.0, 179.8), (-17.1, -179.6), (-17.1, -179.9)]
+        DiaryPost.objects.bulk_create([
+            DiaryPost(group=self.group, author=self.users[0], title='t', content='c', latitude=lat, longitude=lon,
+                      geo_cell=encode_geohash(lat, lon))
+            for lat, lon in points
+        ])
+        self.url = f'/api/trip-groups/{self.group.id}/map_posts/'
+        self.client = self.client_for(self.users[0])
+
+    def test_clusters_cover_every_post(self):
+        data = self.client.get(self.url, {'zoom': 6}).json()
+        self.assertEqual(data['mode'], 'clusters')
+        self.assertEqual(sum(c['count'] for c in data['clusters']), 34)
+
+        data = self.client.get(self.url, {'zoom': 10, 'bbox': '8.5,44.5,9.5,45.5'}).json()
+        expected = DiaryPost.objects.filter(latitude__range=(44.5, 45.5), longitude__range=(8.5, 9.5)).count()
+        self.assertEqual(sum(c['count'] for c in data['clusters']), expected)
+
+        data = self.client.get(self.url, {'zoom': 18, 'bbox': '8.5,44.5,9.5,45.5'}).json()
+        self.assertEqual((data['mode'], len(data['posts'])), ('posts', expected))
+
+    def test_cluster_centre_near_antimeridian(self):
+        data = self.client.get(self.url, {'zoom': 0, 'bbox': '179,-18,-179,-16'}).json()
+        clusters = {round(c['longitude']): c for c in data['clusters']}
+        # Ogni cella resta dal suo lato di ±180, con il baricentro dei suoi post
+        self.assertEqual(set(clusters), {180, -180})
+        self.assertAlmostEqual(clusters[180]['longitude'], 179.5, places=3)
+        self.assertAlmostEqual(clusters[-180]['longitude'], -179.75, places=3)
+
+
+class KeysetPaginationTests(TripTalesTestCase):
+    def setUp(self):
+        super().setUp()
+        now = timezone.now()
+        # Timestamp ripetuti: l'ordine deve restare stabile grazie all'id
+        for i in range(20):
+            DiaryPost.objects.create(
+                group=self.group, author=self.users[0], title=f'Post {i}', content='c',
+                created_at=now - timedelta(minutes=i // 3)
+            )
+            Comment.objects.create(post=self.post, author=self.users[1], content=f'Commento {i}', created_at=now)
+        self.client = self.client_for(self.users[0])
+
+    def test_feed_walks_every_post_once_newest_first(self):
+        ids = self.walk(self.client, '/api/diary-posts/feed/', 'before', limit=7)
+        self.assertEqual(ids, list(DiaryPost.objects.order_by('-created_at', '-id').values_list('id', flat=True)))
+
+    def test_after_cursor_returns_previous_page(self):
+        first = self.client.get('/api/diary-posts/feed/', {'limit': 5}).json()
+        self.assertIsNone(first['after'])
+        second = self.client.get('/api/diary-posts/feed/', {'limit': 5, 'before': first['before']}).json()
+        back = self.client.get('/api/diary-posts/feed/', {'limit': 5, 'after': second['after']}).json()
+        self.assertEqual([p['id'] for p in back['results']], [p['id'] for p in first['results']])
+
+    def test_comments_walk_oldest_first(self):
+        ids = self.walk(self.client, f'/api/diary-posts/{self.post.id}/comments/', 'after', limit=4)
+        self.assertEqual(ids, list(Comment.objects.order_by('created_at', 'id').values_list('id', flat=True)))
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/diary-posts/feed/', {'before': 'zzz'})
+        self.assertEqual(response.status_code, 404)
+
+
+class ChatMigrationTests(TransactionTestCase):
+    """0009 sposta in ChatMessage solo i messaggi creati dall'API di chat, e il reverse li ripristina."""
+
+    before = [('triptales', '0008_post_counters')]
+    after = [('triptales', '0009_chat_message')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+        super().tearDown()
+
+    def test_moves_only_flagged_chat_posts(self):
+        apps = self.migrate(self.before)
+        Utente = apps.get_model('triptales', 'Utente')
+        Gruppo = apps.get_model('triptales', 'Gruppo')
+        DiaryPost = apps.get_model('triptales', 'DiaryPost')
+        PostMedia = apps.get_model('triptales', 'PostMedia')
+        Like = apps.get_model('triptales', 'Like')
+
+        user = Utente.objects.create(username='u0', email='u0@example.com')
+        group = Gruppo.objects.create(name='Roma trip', created_by=user, start_date=date(2024, 7, 1),
+                                      end_date=date(2024, 7, 10))
+        sent_at = timezone.now() - timedelta(days=1)
+        chat = DiaryPost.objects.create(group=group, author=user, title='Chat message', content='Ciao',
+                                        is_chat_message=True, created_at=sent_at)
+        photo = DiaryPost.objects.create(group=group, author=user, title='Chat message', content='',
+                                         is_chat_message=True, created_at=sent_at)
+        PostMedia.objects.create(post=photo, media_type='image', media_url='post_media/a.jpg')
+        # Un post vero con lo stesso titolo e uno con il flag ma con un like non vanno persi
+        DiaryPost.objects.create(group=group, author=user, title='Chat message', content='Diario')
+        liked = DiaryPost.objects.create(group=group, author=user, title='Chat message', content='Like',
+                                         is_chat_message=True)
+        Like.objects.create(post=liked, user=user)
+
+        apps = self.migrate(self.after)
+        ChatMessage = apps.get_model('triptales', 'ChatMessage')
+        DiaryPost = apps.get_model('triptales', 'DiaryPost')
+        self.assertEqual(
+            list(ChatMessage.objects.order_by('id').values_list('content', 'image', 'created_at')),
+            [('Ciao', '', sent_at), ('', 'post_media/a.jpg', sent_at)]
+        )
+        self.assertEqual(sorted(DiaryPost.objects.values_list('content', flat=True)), ['Diario', 'Like'])
+
+        apps = self.migrate(self.before)
+        DiaryPost = apps.get_model('triptales', 'DiaryPost')
+        restored = DiaryPost.objects.filter(is_chat_message=True, likes__isnull=True).order_by('id')
+        self.assertEqual(
+            [(post.title, post.content, post.created_at, post.location_name) for post in restored],
+            [(chat.title, chat.content, sent_at, None), (photo.title, photo.content, sent_at, None)]
+        )
+        self.assertEqual(list(restored[1].media.values_list('media_url', flat=True)), ['post_media/a.jpg'])
+        self.assertEqual(DiaryPost.objects.count(), 4)
+
+
+class ChatHistoryTests(TripTalesTestCase):
+    def test_scrollback_follows_created_at(self):
+        now = timezone.now()
+        # Messaggi inseriti fuori ordine: la cronologia segue created_at, non l'id
+        for i in range(12):
+            ChatMessage.objects.create(
+                group=self.group, author=self.users[i % 3], content=f'm{i}',
+                created_at=now - timedelta(seconds=(i * 7) % 12)
+            )
+        client = self.client_for(self.users[1])
+        url = f'/api/trip-groups/{self.group.id}/messages/'
+        expected = list(ChatMessage.objects.order_by('created_at', 'id').values_list('id', flat=True))
+
+        latest = client.get(url, {'limit': 5}).json()
+        self.assertEqual([m['id'] for m in latest['results']], expected[-5:])
+        older = client.get(url, {'limit': 5, 'before': latest['before']}).json()
+        self.assertEqual([m['id'] for m in older['results']], expected[-10:-5])
+
+    def test_invalid_message_does_not_lose_the_batch(self):
+        batch = [
+            ChatMessage(group=self.group, author=self.users[0], content='Ciao'),
+            ChatMessage(group=self.group, author=self.users[1], content=None),
+            ChatMessage(group=self.group, author=self.users[2], content='A domani'),
+        ]
+        with self.assertLogs('triptales.chat_buffer', 'ERROR') as logs:
+            ChatMessageBuffer._write(batch)
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(list(ChatMessage.objects.order_by('id').values_list('content', flat=True)), ['Ciao', 'A domani'])
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ChatConsumerTests(TripTalesTestCase):
+    @async_to_sync
+    async def connect(self, user, group_id):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{group_id}/')
+        communicator.scope['user'] = user
+        communicator.scope['url_route'] = {'kwargs': {'group_id': str(group_id)}}
+        connected, _ = await communicator.connect()
+        if connected:
+            await communicator.disconnect()
+        return connected
+
+    def test_reconnect_uses_cached_membership(self):
+        self.assertTrue(self.connect(self.users[1], self.group.id))
+        # Le riconnessioni successive leggono le membership dalla cache
+        with self.assertNumQueries(0):
+            self.assertTrue(self.connect(self.users[1], self.group.id))
+
+    def test_only_members_can_connect(self):
+        self.assertTrue(self.connect(self.users[2], self.group.id))
+        GroupMembership.objects.filter(user=self.users[2], group=self.group).delete()
+        self.assertFalse(self.connect(self.users[2], self.group.id))
+        self.assertFalse(self.connect(self.users[1], 'abc'))
+
+
+class ChannelLayerTests(SimpleTestCase):
+    def test_corrupt_frame_reconnects(self):
+        path = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        layer = UnixSocketChannelLayer(path=path)
+
+        async def main():
+            connections = []
+
+            async def fake_broker(reader, writer):
+                connections.append(writer)
+                hello = await read_frame(reader)
+                channel = f'specific.{hello["client"]}!test'
+                if len(connections) == 1:
+                    # Frame oltre il limite: il client deve chiudere e riconnettersi
+                    writer.write(FRAME_HEADER.pack(MAX_FRAME_SIZE + 1))
+                else:
+                    writer.write(encode_frame({'op': 'deliver', 'channels': [channel], 'message': {'type': 'ok'}}))
+                await writer.drain()
+
+            server = await asyncio.start_unix_server(fake_broker, path=path)
+            async with server:
+                channel = f'specific.{(await layer.connection()).client_id}!test'
+                with self.assertLogs('triptales.channel_layer', 'WARNING'):
+                    message = await asyncio.wait_for(layer.receive(channel), 5)
+                self.assertEqual(message, {'type': 'ok'})
+                self.assertEqual(len(connections), 2)
+                await layer.close()
+
+        asyncio.run(main())
+
+
+class CounterTests(TripTalesTestCase):
+    def test_likes_and_comments_keep_counters(self):
+        for user in self.users:
+            response = self.client_for(user).post(f'/api/diary-posts/{self.post.id}/like/')
+            self.assertTrue(response.json()['liked'])
+        response = self.client_for(self.users[1]).post(f'/api/diary-posts/{self.post.id}/like/')
+        self.assertEqual(response.json()['total_likes'], 2)
+
+        self.client_for(self.users[1]).post(f'/api/diary-posts/{self.post.id}/add_comment/', {'content': 'Bello'})
+        response = self.client_for(self.users[2]).post('/api/comments/', {'post': self.post.id, 'content': 'Wow'})
+        self.assertEqual(response.status_code, 201, response.content)
+        self.client_for(self.users[2]).delete(f'/api/comments/{response.json()["id"]}/')
+
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.likes_count, self.post.comments_count), (2, 1))
+
+    def test_unlike_of_already_removed_like_does_not_decrement(self):
+        self.client_for(self.users[1]).post(f'/api/diary-posts/{self.post.id}/like/')
+        # Un'altra richiesta ha già tolto il like tra la lettura e la delete
+        original_delete = Like.delete
+
+        def delete_twice(like, *args, **kwargs):
+            Like.objects.filter(pk=like.pk).delete()
+            return original_delete(like, *args, **kwargs)
+
+        with mock.patch.object(Like, 'delete', delete_twice):
+            self.client_for(self.users[1]).post(f'/api/diary-posts/{self.post.id}/like/')
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.likes_count, 1)
+
+    def test_full_save_does_not_overwrite_counters(self):
+        stale = DiaryPost.objects.get(pk=self.post.pk)
+        self.client_for(self.users[1]).post(f'/api/diary-posts/{self.post.id}/like/')
+        stale.title = 'Fori Imperiali'
+        stale.save()
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.title, self.post.likes_count), ('Fori Imperiali', 1))
+
+    def test_reconcile_counters_fixes_drift(self):
+        self.client_for(self.users[1]).post(f'/api/diary-posts/{self.post.id}/like/')
+        DiaryPost.objects.filter(pk=self.post.pk).update(likes_count=99)
+
+        call_command('reconcile_counters', '--dry-run', stdout=io.StringIO())
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.likes_count, 99)
+
+        call_command('reconcile_counters', stdout=io.StringIO())
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.likes_count, 1)
+
+
+class LikedFlagTests(TripTalesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.posts = [
+            DiaryPost.objects.create(group=self.group, author=self.users[0], title='t', content='c',
+                                     latitude=41.9, longitude=12.5)
+            for _ in range(12)
+        ]
+        self.liked = {post.id for post in self.posts[::3]}
+        Like.objects.bulk_create([Like(post_id=post_id, user=self.users[1]) for post_id in self.liked])
+        Like.objects.bulk_create([Like(post=post, user=self.users[2]) for post in self.posts[1::3]])
+
+    def test_page_resolves_likes_in_one_query(self):
+        client = self.client_for(self.users[1])
+        client.get('/api/diary-posts/feed/')
+        # Con i gruppi dell'utente in cache: pagina, media e like della pagina, qualunque sia la dimensione
+        for limit in (3, 12):
+            with self.assertNumQueries(3):
+                results = client.get('/api/diary-posts/feed/', {'limit': limit}).json()['results']
+            self.assertEqual(len(results), limit)
+        self.assertEqual({post['id'] for post in results if post['user_has_liked']}, self.liked)
+
+    def test_every_list_endpoint_agrees(self):
+        client = self.client_for(self.users[1])
+        nearby = client.get('/api/diary-posts/nearby/', {'latitude': 41.9, 'longitude': 12.5}).json()
+        self.assertEqual({post['id'] for post in nearby if post['user_has_liked']}, self.liked)
+        map_posts = client.get(f'/api/trip-groups/{self.group.id}/map_posts/').json()['posts']
+        self.assertEqual({post['id'] for post in map_posts if post['user_has_liked']}, self.liked)
+        group_posts = self.walk(client, f'/api/trip-groups/{self.group.id}/posts/', 'before')
+        self.assertEqual(len(group_posts), 13)
+
+        for post in self.posts[:2]:
+            detail = client.get(f'/api/diary-posts/{post.id}/').json()
+            self.assertEqual(detail['user_has_liked'], post.id in self.liked)
+
+
+class SummarySerializerTests(TripTalesTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(12):
+            post = DiaryPost.objects.create(group=self.group, author=self.users[0], title=f'p{i}', content='c')
+            PostMedia.objects.create(post=post, media_url=f'post_media/p{i}.jpg')
+            Comment.objects.create(post=post, author=self.users[1], content='Bello')
+        self.last = post
+
+    def test_lists_use_the_compact_form(self):
+        client = self.client_for(self.users[1])
+        # Gruppi dell'utente, pagina con gli autori, media e like della pagina
+        with self.assertNumQueries(4):
+            results = client.get('/api/diary-posts/feed/').json()['results']
+        first = results[0]
+        self.assertNotIn('comments', first)
+        self.assertNotIn('media', first)
+        self.assertIn('comments_count', first)
+        self.assertTrue(first['thumbnail_url'].endswith('p11.jpg'))
+        self.assertEqual(set(first['author']), {'id', 'username', 'profile_picture'})
+
+        detail = client.get(f'/api/diary-posts/{self.last.id}/').json()
+        self.assertEqual(len(detail['comments']), 1)
+        self.assertEqual(len(detail['media']), 1)
+
+    def test_fields_and_expand(self):
+        client = self.client_for(self.users[1])
+        results = client.get('/api/diary-posts/feed/', {'fields': 'id,title,comments', 'expand': 'comments'}).json()['results']
+        self.assertEqual(set(results[0]), {'id', 'title', 'comments'})
+        self.assertEqual([comment['content'] for comment in results[0]['comments']], ['Bello'])
+        # Le relazioni annidate costano una query ciascuna, non una per post
+        with self.assertNumQueries(5):
+            client.get('/api/diary-posts/feed/', {'expand': 'comments,media'})
+
+        response = client.get(f'/api/trip-groups/{self.group.id}/posts/', {'fields': 'id'})
+        self.assertEqual(set(response.json()['results'][0]), {'id'})
+        self.assertEqual(set(client.get('/api/users/me/', {'fields': 'id,username'}).json()), {'id', 'username'})
+
+        response = client.post('/api/diary-posts/?fields=id', {'group': self.group.id, 'title': 'x', 'content': 'y'})
+        self.assertEqual(response.status_code, 201, response.content)
+
+
+class ReconcileCountersTests(TripTalesTestCase):
+    def setUp(self):
+        super().setUp()
+        for user in self.users:
+            self.client_for(user).post('/api/diary-posts/', {
+                'group': self.group.id, 'title': 't', 'content': 'c', 'location_name': 'Roma'
+            })
+        for user in self.users[1:]:
+            self.client_for(user).post(f'/api/diary-posts/{self.post.id}/like/')
+            self.client_for(user).post(f'/api/diary-posts/{self.post.id}/add_comment/', {'content': 'Bello'})
+
+    def snapshot(self):
+        return {
+            'stats': list(UserStats.objects.order_by('pk').values()),
+            'group_scores': list(GroupScore.objects.order_by('pk').values()),
+            'daily_scores': list(DailyScore.objects.order_by('group', 'user', 'day').values(
+                'group', 'user', 'day', 'posts_count', 'likes_received', 'comments_count', 'score'
+            )),
+            'locations': list(UserLocation.objects.order_by('user', 'name').values('user', 'name', 'posts_count')),
+        }
+
+    def test_counters_kept_by_activity_have_no_drift(self):
+        # Il post del setUp è creato senza ActivityService: si parte da contatori riallineati
+        ActivityService.reconcile_user_counters([user.pk for user in self.users])
+        drifted = ActivityService.reconcile_user_counters([user.pk for user in self.users], dry_run=True)
+        self.assertEqual(drifted, {'stats': 0, 'group_scores': 0, 'daily_scores': 0, 'locations': 0})
+
+    def test_drift_is_detected_and_repaired(self):
+        ActivityService.reconcile_user_counters([user.pk for user in self.users])
+        expected = self.snapshot()
+
+        today = timezone.localdate()
+        UserStats.objects.filter(user=self.users[0]).update(likes_received=40, score=80)
+        GroupScore.objects.filter(user=self.users[1]).update(posts_count=7)
+        DailyScore.objects.filter(user=self.users[2]).delete()
+        DailyScore.objects.create(user=self.users[1], group=self.group, day=today - timedelta(days=3), score=5)
+        DailyScore.objects.filter(user=self.users[0]).update(likes_received=0)
+        UserLocation.objects.filter(user=self.users[1]).update(posts_count=3)
+        UserLocation.objects.create(user=self.users[2], name='Napoli')
+
+        out = io.StringIO()
+        call_command('reconcile_counters', '--dry-run', stdout=out)
+        self.assertIn('UserStats: 1, GroupScore: 1, DailyScore: 3, UserLocation: 2', out.getvalue())
+        self.assertNotEqual(self.snapshot(), expected)
+
+        call_command('reconcile_counters', stdout=io.StringIO())
+        self.assertEqual(self.snapshot(), expected)
+
+    def test_stats_are_read_from_user_stats(self):
+        client = self.client_for(self.users[0])
+        with self.assertNumQueries(1):
+            self.assertEqual(client.get('/api/users/stats/').json(), {'postCount': 1, 'likesCount': 2, 'commentsCount': 0})
+
+        ids = f'{self.users[1].id},{self.users[2].id},99999'
+        with self.assertNumQueries(1):
+            data = client.get('/api/users/stats/batch/', {'ids': ids}).json()
+        self.assertEqual(data, {
+            str(self.users[1].id): {'postCount': 1, 'likesCount': 0, 'commentsCount': 1},
+            str(self.users[2].id): {'postCount': 1, 'likesCount': 0, 'commentsCount': 1},
+        })
+        self.assertEqual(client.get('/api/users/stats/batch/').status_code, 400)
+        self.assertEqual(client.get('/api/users/stats/batch/', {'ids': 'a,b'}).status_code, 400)
+        too_many = ','.join(str(user_id) for user_id in range(1, 200))
+        self.assertEqual(client.get('/api/users/stats/batch/', {'ids': too_many}).status_code, 400)
+
+    def test_daily_scores_outside_retention_are_left_to_prune(self):
+        old = timezone.now() - timedelta(days=DAILY_SCORE_RETENTION_DAYS + 5)
+        Comment.objects.create(post=self.post, author=self.users[1], content='Vecchio', created_at=old)
+        ActivityService.reconcile_user_counters([user.pk for user in self.users])
+        self.assertFalse(DailyScore.objects.filter(day__lt=timezone.localdate(old) + timedelta(days=1)).exists())
+
+
+class LeaderboardTests(TripTalesTestCase):
+    def test_scores_and_ranks(self):
+        # u0: 2 like ricevuti, u1: 2 post, u2: 1 commento
+        for _ in range(2):
+            self.client_for(self.users[1]).post('/api/diary-posts/', {'group': self.group.id, 'title': 't', 'content': 'c'})
+        self.client_for(self.users[2]).post(f'/api/diary-posts/{self.post.id}/add_comment/', {'content': 'Bello'})
+        for user in self.users[1:]:
+            self.client_for(user).post(f'/api/diary-posts/{self.post.id}/like/')
+
+        board = self.client_for(self.users[0]).get('/api/users/leaderboard/', {'group_id': self.group.id}).json()
+        rows = [(e['username'], e['total_score'], e['rank']) for e in board['results']]
+        self.assertEqual(rows, [('u0', 4, 1), ('u1', 2, 2), ('u2', 1, 3)])
+
+        me = self.client_for(self.users[2]).get('/api/users/leaderboard/me/', {'group_id': self.group.id}).json()
+        self.assertEqual(me['rank'], 3)
+
+    def test_former_members_are_hidden_from_group_board(self):
+        GroupMembership.objects.filter(user=self.users[2], group=self.group).delete()
+        board = self.client_for(self.users[0]).get('/api/users/leaderboard/', {'group_id': self.group.id}).json()
+        self.assertNotIn(self.users[2].id, [e['id'] for e in board['results']])
+
+
+class LeaderboardWindowTests(TripTalesTestCase):
+    def test_window_counts_only_recent_activity(self):
+        old = timezone.now() - timedelta(days=10)
+        with mock.patch('django.utils.timezone.localdate', return_value=timezone.localdate(old)):
+            self.client_for(self.users[1]).post('/api/diary-posts/', {'group': self.group.id, 'title': 't', 'content': 'c'})
+        self.client_for(self.users[0]).post('/api/diary-posts/', {'group': self.group.id, 'title': 't', 'content': 'c'})
+
+        week = self.client_for(self.users[0]).get('/api/users/leaderboard/', {'window': '7d'}).json()
+        self.assertEqual([e['username'] for e in week['results']], ['u0'])
+        month = self.client_for(self.users[0]).get('/api/users/leaderboard/', {'window': '30d'}).json()
+        self.assertEqual({e['username'] for e in month['results']}, {'u0', 'u1'})
+
+    def test_trip_window_uses_trip_dates(self):
+        old = timezone.now() - timedelta(days=10)
+        with mock.patch('django.utils.timezone.localdate', return_value=timezone.localdate(old)):
+            self.client_for(self.users[1]).post('/api/diary-posts/', {'group': self.group.id, 'title': 't', 'content': 'c'})
+        self.client_for(self.users[2]).post('/api/diary-posts/', {'group': self.group.id, 'title': 't', 'content': 'c'})
+        Gruppo.objects.filter(pk=self.group.pk).update(
+            start_date=timezone.localdate(old) - timedelta(days=1), end_date=timezone.localdate(old)
+        )
+
+        trip = self.client_for(self.users[0]).get('/api/users/leaderboard/', {'group_id': self.group.id, 'window': 'trip'})
+        self.assertEqual(trip.status_code, 200, trip.content)
+        self.assertEqual([e['username'] for e in trip.json()['results']], ['u1'])
+
+    def test_trip_older_than_retention_is_rejected(self):
+        start = timezone.localdate() - timedelta(days=DAILY_SCORE_RETENTION_DAYS + 5)
+        Gruppo.objects.filter(pk=self.group.pk).update(start_date=start, end_date=start + timedelta(days=7))
+        for url in ('/api/users/leaderboard/', '/api/users/leaderboard/me/'):
+            response = self.client_for(self.users[0]).get(url, {'group_id': self.group.id, 'window': 'trip'})
+            self.assertEqual(response.status_code, 400, url)
+
+
+class ActivityCounterTests(TripTalesTestCase):
+    def assertStatsMatchData(self, user):
+        expected = ActivityService.compute_user_stats([user.pk]).get(user.pk) or UserStats(user=user)
+        stats = UserStats.objects.get(pk=user.pk)
+        fields = [field.name for field in UserStats._meta.concrete_fields if not field.primary_key]
+        self.assertEqual({field: getattr(stats, field) for field in fields},
+                         {field: getattr(expected, field) for field in fields})
+
+    def test_api_activity_keeps_user_stats(self):
+        author = self.client_for(self.users[1])
+        post_ids = []
+        for place in ['Roma', 'Napoli', 'Roma', '']:
+            response = author.post('/api/diary-posts/', {
+                'group': self.group.id, 'title': 't', 'content': 'c', 'location_name': place
+            })
+            post_ids.append(response.json()['id'])
+        response = author.post('/api/post-media/upload_media/', {
+            'post_id': post_ids[0], 'media_file': jpeg_upload(), 'caption': 'Il Colosseo'
+        }, format='multipart')
+        media_id = response.json()['id']
+        author.post('/api/ml-results/', {'post_id': post_ids[0], 'media_id': media_id, 'ml_results': {
+            'detected_objects': [{'label': 'arena'}], 'ocr_text': 'Uscita'
+        }}, format='json')
+        for user in (self.users[0], self.users[2]):
+            self.client_for(user).post(f'/api/diary-posts/{post_ids[0]}/like/')
+        self.client_for(self.users[2]).post(f'/api/diary-posts/{post_ids[1]}/add_comment/', {'content': 'Bello'})
+
+        stats = UserStats.objects.get(pk=self.users[1].pk)
+        self.assertEqual(
+            (stats.posts_count, stats.locations_count, stats.photos_count, stats.ocr_count,
+             stats.detections_count, stats.captions_count, stats.likes_received),
+            (4, 2, 1, 1, 1, 1, 2)
+        )
+        self.assertStatsMatchData(self.users[1])
+
+        # Cancellare un post toglie i suoi media, like e il luogo non più usato
+        self.assertEqual(author.delete(f'/api/diary-posts/{post_ids[0]}/').status_code, 204)
+        self.assertEqual(author.delete(f'/api/diary-posts/{post_ids[1]}/').status_code, 204)
+        self.assertStatsMatchData(self.users[1])
+        self.assertStatsMatchData(self.users[2])
+        self.assertEqual(UserStats.objects.get(pk=self.users[1].pk).locations_count, 1)
+
+    def test_seeded_badge_awarded_at_threshold(self):
+        # Le regole vengono dai badge creati dalla migrazione (Esploratore: 5 luoghi)
+        explorer = Badge.objects.get(name='Esploratore')
+        author = self.client_for(self.users[1])
+        for place in ['Roma', 'Napoli', 'Firenze', 'Siena']:
+            author.post('/api/diary-posts/', {'group': self.group.id, 'title': 't', 'content': 'c', 'location_name': place})
+        BadgeService.get_rules()
+        # Sotto soglia la verifica è una sola lettura di UserStats
+        with self.assertNumQueries(1):
+            self.assertEqual(BadgeService.check_all_badges(self.users[1]), [])
+
+        author.post('/api/diary-posts/', {'group': self.group.id, 'title': 't', 'content': 'c', 'location_name': 'Pisa'})
+        self.assertEqual(BadgeService.check_all_badges(self.users[1]), [explorer.id])
+        self.assertEqual(BadgeService.check_all_badges(self.users[1]), [])
+
+
+def legacy_badges(user):
+    """Badge meritati secondo i vecchi controlli di BadgeService, uno per badge sui dati reali."""
+    media = PostMedia.objects.filter(post__author=user)
+    with_ocr = media.filter(ocr_text__isnull=False, ocr_text__gt='')
+    with_objects = media.filter(detected_objects__isnull=False)
+    with_caption = media.filter(caption__isnull=False, caption__gt='')
+    checks = {
+        'Esploratore': DiaryPost.objects.filter(author=user, location_name__isnull=False)
+        .values('location_name').distinct().count() >= 5,
+        'Traduttore': with_ocr.count() >= 3,
+        'Osservatore': with_objects.count() >= 10,
+        'Fotografo': media.filter(media_type='image').count() >= 20,
+        'Social': Like.objects.filter(post__author=user).count() >= 15,
+        'AI Explorer': with_ocr.exists() and with_objects.exists() and with_caption.exists(),
+        'Polyglot': with_ocr.count() >= 10,
+    }
+    return {name for name, earned in checks.items() if earned}
+
+
+class BadgeRuleTests(TripTalesTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = random.Random(12)
+        self.users += [Utente.objects.create_user(f'u{i}', f'u{i}@example.com', 'password') for i in range(3, 8)]
+        places = ['Roma', 'Napoli', 'Firenze', 'Siena', 'Pisa', 'Lucca', 'Assisi']
+
+        # Dati scritti senza passare dai contatori: UserStats viene poi ricalcolato da zero
+        posts = DiaryPost.objects.bulk_create([
+            DiaryPost(group=self.group, author=user, title='t', content='c', location_name=rng.choice(places + [None]))
+            for user in self.users for _ in range(rng.randint(0, 12))
+        ])
+        PostMedia.objects.bulk_create([
+            PostMedia(
+                post=post, media_url='post_media/x.jpg', media_type=rng.choice(['image'] * 4 + ['video']),
+                ocr_text=rng.choice(['', '', '', 'Uscita']), caption=rng.choice(['', '', 'Una piazza']),
+                detected_objects=rng.choice([None, None, [{'label': 'fontana'}]])
+            )
+            for post in posts for _ in range(rng.randint(0, 6))
+        ])
+        Like.objects.bulk_create([
+            Like(post=post, user=user) for post in posts for user in rng.sample(self.users, rng.randint(0, 5))
+        ])
+        ActivityService.reconcile_user_counters([user.pk for user in self.users])
+
+    def test_compiled_rules_match_legacy_checks(self):
+        # Con le regole in cache tutti i badge di tutti gli utenti costano una query
+        BadgeService.get_rules()
+        with self.assertNumQueries(1):
+            earned = BadgeService.earned_badges([user.pk for user in self.users])
+        self.assertTrue(earned)
+
+        BadgeService.award_badges([user.pk for user in self.users])
+        for user in self.users:
+            awarded = set(UserBadge.objects.filter(user=user).values_list('badge__name', flat=True))
+            self.assertEqual(awarded, legacy_badges(user), user.username)
+        self.assertEqual(BadgeService.earned_badges([user.pk for user in self.users]), {})
+
+    def test_invalid_criteria_are_skipped(self):
+        badge = Badge.objects.create(name='Misterioso', description='d', icon_url='x.png', criteria={'sunsets': 3})
+        with self.assertLogs('triptales.badge_service', 'WARNING'):
+            rules = compile_rules()
+        self.assertNotIn(badge.id, [badge_id for badge_id, _ in rules])
+
+
+class RecomputeBadgesTests(TripTalesTestCase):
+    def test_dry_run_reports_both_directions(self):
+        DiaryPost.objects.bulk_create([
+            DiaryPost(group=self.group, author=self.users[0], title='t', content='c', location_name=place)
+            for place in ('Roma', 'Napoli', 'Firenze', 'Siena', 'Pisa')
+        ])
+        # Badge assegnato con una soglia che l'utente non raggiunge più
+        photographer = Badge.objects.get(name='Fotografo')
+        UserBadge.objects.create(user=self.users[1], badge=photographer)
+
+        out = io.StringIO()
+        call_command('recompute_badges', '--dry-run', verbosity=2, stdout=out)
+        self.assertIn('+ u0: Esploratore', out.getvalue())
+        self.assertIn('- u1: Fotografo', out.getvalue())
+        self.assertEqual(UserBadge.objects.count(), 1)
+
+        call_command('recompute_badges', stdout=io.StringIO())
+        self.assertEqual(
+            set(UserBadge.objects.values_list('user__username', 'badge__name')),
+            {('u0', 'Esploratore'), ('u1', 'Fotografo')}
+        )
+
+
+class JobQueueTests(TripTalesTestCase):
+    def setUp(self):
+        super().setUp()
+        Job.objects.all().delete()
+        self.calls = []
+        tasks = dict(jobs.TASKS)
+        jobs.TASKS['test_task'] = (self.calls.append, False)
+        self.addCleanup(jobs.TASKS.update, tasks)
+        self.addCleanup(jobs.TASKS.pop, 'test_task', None)
+
+    def test_dedupe_key_merges_pending_jobs(self):
+        jobs.enqueue('test_task', {'n': 1}, dedupe_key='test:1')
+        jobs.enqueue('test_task', {'n': 2}, dedupe_key='test:1')
+        self.assertEqual(Job.objects.count(), 1)
+
+        # Preso in carico il job, la chiave è libera per un evento successivo
+        claimed = jobs.claim_jobs('w1')
+        jobs.enqueue('test_task', {'n': 3}, dedupe_key='test:1')
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(Job.objects.count(), 2)
+
+    def test_claimed_job_goes_to_one_worker_until_lease_expires(self):
+        jobs.enqueue('test_task', {'n': 1})
+        self.assertEqual(len(jobs.claim_jobs('w1')), 1)
+        self.assertEqual(jobs.claim_jobs('w2'), [])
+
+        Job.objects.update(claimed_at=timezone.now() - timedelta(seconds=jobs.JOB_LEASE_SECONDS + 1))
+        self.assertEqual(jobs.run_pending('w2'), (1, 0))
+        self.assertEqual(self.calls, [{'n': 1}])
+        self.assertFalse(Job.objects.exists())
+
+    def test_failed_job_is_retried_later(self):
+        jobs.enqueue('unknown_task')
+        with self.assertLogs('triptales.jobs', 'ERROR'):
+            self.assertEqual(jobs.run_pending('w1'), (0, 1))
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts, job.claimed_by), ('pending', 1, None))
+        self.assertGreater(job.run_at, timezone.now())
+
+    def test_retried_job_keeps_dedupe_key(self):
+        jobs.enqueue('unknown_task', dedupe_key='test:1')
+        with self.assertLogs('triptales.jobs', 'ERROR'):
+            jobs.run_pending('w1')
+        # Un evento durante l'attesa del nuovo tentativo viene accorpato
+        jobs.enqueue('unknown_task', dedupe_key='test:1')
+        self.assertEqual(list(Job.objects.values_list('dedupe_key', 'attempts')), [('test:1', 1)])
+
+    def test_job_enqueued_while_running_replaces_the_retry(self):
+        jobs.enqueue('test_task', {'n': 1}, dedupe_key='test:1')
+        claimed = jobs.claim_jobs('w1')
+        jobs.enqueue('test_task', {'n': 2}, dedupe_key='test:1')
+        with self.assertLogs('triptales.jobs', 'ERROR'):
+            jobs._retry_later(claimed, 'errore')
+        self.assertEqual(list(Job.objects.values_list('payload', 'dedupe_key')), [({'n': 2}, 'test:1')])
+
+
+class MyGroupsTests(TripTalesTestCase):
+    def make_group(self, name, days_ago):
+        group = Gruppo.objects.create(
+            name=name, description='', start_date=date.today(), end_date=date.today(), location='Roma',
+            created_by=self.users[0], last_activity_at=timezone.now() - timedelta(days=days_ago)
+        )
+        GroupMembership.objects.create(user=self.users[0], group=group, role='admin')
+        return group
+
+    def my_groups(self):
+        response = self.client_for(self.users[0]).get('/api/trip-groups/my/')
+        self.assertEqual(response.status_code, 200, response.content)
+        return [(group['name'], group['member_count'], group['post_count']) for group in response.json()]
+
+    def test_sorted_by_last_activity(self):
+        Gruppo.objects.filter(pk=self.group.pk).update(last_activity_at=timezone.now() - timedelta(days=3))
+        napoli = self.make_group('Napoli trip', 2)
+        self.make_group('Firenze trip', 1)
+        self.assertEqual([name for name, _, _ in self.my_groups()], ['Firenze trip', 'Napoli trip', 'Roma trip'])
+
+        # Un post, un messaggio o un ingresso aggiornano contatori e ordine
+        client = self.client_for(self.users[0])
+        client.post('/api/diary-posts/', {'group': self.group.id, 'title': 't', 'content': 'c'})
+        self.client_for(self.users[1]).post(f'/api/trip-groups/{napoli.id}/join/')
+        client.post(f'/api/trip-groups/{napoli.id}/send_message/', {'content': 'Ciao'})
+        self.assertEqual(self.my_groups(), [('Napoli trip', 2, 0), ('Roma trip', 3, 1), ('Firenze trip', 1, 0)])
+
+        # Un post con data vecchia non riporta indietro l'ultima attività
+        client.post('/api/diary-posts/', {
+            'group': self.group.id, 'title': 't', 'content': 'c', 'created_at': '2020-01-01T00:00:00Z'
+        })
+        self.assertEqual([name for name, _, _ in self.my_groups()], ['Napoli trip', 'Roma trip', 'Firenze trip'])
+
+    def test_list_is_one_query(self):
+        for i in range(5):
+            self.make_group(f'g{i}', i)
+        self.client_for(self.users[0]).get('/api/trip-groups/my/')
+        with self.assertNumQueries(1):
+            self.assertEqual(len(self.my_groups()), 6)
+
+
+class FullTextSearchTests(TripTalesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.outsider = Utente.objects.create_user('outsider', 'outsider@example.com', 'password')
+        self.group.is_private = True
+        self.group.save()
+        self.public_group = Gruppo.objects.create(
+            name='Firenze aperta', description='Gita', start_date=date.today(),
+            end_date=date.today(), location='Firenze', created_by=self.users[1]
+        )
+
+    def search_posts(self, user, query):
+        response = self.client_for(user).get('/api/diary-posts/search/', {'search': query})
+        self.assertEqual(response.status_code, 200, response.content)
+        return [p['id'] for p in response.json()['results']]
+
+    def test_index_follows_insert_update_and_delete(self):
+        post = DiaryPost.objects.create(group=self.group, author=self.users[0], title='Pantheon', content='Cupola')
+        self.assertEqual(self.search_posts(self.users[1], 'pantheon'), [post.id])
+
+        post.title = 'Fontana di Trevi'
+        post.save()
+        self.assertEqual(self.search_posts(self.users[1], 'pantheon'), [])
+        self.assertEqual(self.search_posts(self.users[1], 'trevi'), [post.id])
+
+        post.delete()
+        self.assertEqual(self.search_posts(self.users[1], 'trevi'), [])
+
+    def test_private_groups_and_posts_are_hidden(self):
+        private = DiaryPost.objects.create(group=self.group, author=self.users[0], title='Duomo', content='c')
+        public = DiaryPost.objects.create(group=self.public_group, author=self.users[1], title='Duomo', content='c')
+        self.assertEqual(sorted(self.search_posts(self.users[0], 'duomo')), sorted([private.id, public.id]))
+        self.assertEqual(self.search_posts(self.outsider, 'duomo'), [public.id])
+
+        for user, expected in ((self.users[0], {self.group.id}), (self.outsider, set())):
+            response = self.client_for(user).get('/api/trip-groups/search/', {'search': 'roma'})
+            self.assertEqual({g['id'] for g in response.json()['results']}, expected)
+
+    def test_lost_triggers_are_recreated_after_migrate(self):
+        # Come dopo una migration che ricostruisce la tabella su SQLite
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TRIGGER triptales_diarypost_fts_ai")
+        with self.assertLogs('triptales.signals', 'WARNING'):
+            signals.search_indexes_migrated(sender=None, using='default')
+
+        post = DiaryPost.objects.create(group=self.group, author=self.users[0], title='Pantheon', content='c')
+        self.assertEqual(self.search_posts(self.users[0], 'pantheon'), [post.id])
+        self.assertEqual(self.search_posts(self.users[0], 'colosseo'), [self.post.id])
+
+
+class MediaSearchTests(TripTalesTestCase):
+    def upload(self, post, **fields):
+        response = self.client_for(self.users[0]).post('/api/post-media/upload_media/', {
+            'post_id': post.id, 'media_file': jpeg_upload(), **fields
+        }, format='multipart')
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.json()['id']
+
+    def search_ids(self, user, url, **params):
+        response = self.client_for(user).get(url, params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return [media['id'] for media in response.json()['results']]
+
+    def test_index_follows_ml_results(self):
+        first = self.upload(self.post)
+        response = self.client_for(self.users[0]).post('/api/ml-results/', {
+            'post_id': self.post.id, 'media_id': first, 'ml_results': {
+                'detected_objects': [{'label': 'Monument', 'confidence': 0.9}, {'label': 'Statue'}],
+                'ocr_text': 'Qui visse Giuseppe Verdì', 'caption': 'A monument'
+            }
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(
+            set(MediaTerm.objects.filter(media_id=first).values_list('kind', 'term')),
+            {('label', 'monument'), ('label', 'statue'), ('word', 'qui'), ('word', 'visse'),
+             ('word', 'giuseppe'), ('word', 'verdi'), ('word', 'monument')}
+        )
+        second = self.upload(self.post, detected_objects='[{"label": "monument"}]')
+
+        url = f'/api/trip-groups/{self.group.id}/media/search/'
+        self.assertEqual(self.search_ids(self.users[1], url, label='monument'), [second, first])
+        self.assertEqual(self.search_ids(self.users[1], url, label='monument,statue'), [first])
+        self.assertEqual(self.search_ids(self.users[1], url, q='verdi GIUSEPPE'), [first])
+        self.assertEqual(self.client_for(self.users[1]).get(url).status_code, 400)
+
+        # Risultati ML nuovi: i termini vecchi spariscono dall'indice
+        self.client_for(self.users[0]).post('/api/ml-results/', {
+            'post_id': self.post.id, 'media_id': first, 'ml_results': {'detected_objects': [{'label': 'tree'}]}
+        }, format='json')
+        self.assertEqual(self.search_ids(self.users[1], url, label='monument'), [second])
+
+        MediaTerm.objects.all().delete()
+        call_command('rebuild_media_index', stdout=io.StringIO())
+        self.assertEqual(self.search_ids(self.users[1], url, label='tree'), [first])
+        PostMedia.objects.get(pk=first).delete()
+        self.assertFalse(MediaTerm.objects.filter(media_id=first).exists())
+
+    def test_repeated_labels_count_once(self):
+        media = PostMedia.objects.create(post=self.post, media_url='post_media/a.mp4', media_type='video',
+                                         detected_objects=[{'label': 'Monument'}])
+        MediaSearchService.index_media(media)
+        url = f'/api/trip-groups/{self.group.id}/media/search/'
+        self.assertEqual(self.search_ids(self.users[0], url, label='Monument,monument'), [media.id])
+        self.assertEqual(self.search_ids(self.users[0], url, label='monument', q='monument monument'), [])
+
+    def test_results_respect_group_privacy(self):
+        public = self.upload(self.post, detected_objects='["fontana"]')
+        hidden_group = Gruppo.objects.create(
+            name='Segreto', description='', start_date=date.today(), end_date=date.today(), location='Roma',
+            created_by=self.users[0], is_private=True
+        )
+        GroupMembership.objects.create(user=self.users[0], group=hidden_group, role='admin')
+        hidden_post = DiaryPost.objects.create(group=hidden_group, author=self.users[0], title='t', content='c')
+        hidden = self.upload(hidden_post, detected_objects='["fontana"]')
+
+        GroupMembership.objects.filter(user=self.users[2], group=self.group).delete()
+        self.assertEqual(self.search_ids(self.users[0], '/api/post-media/search/', label='fontana'), [hidden, public])
+        self.assertEqual(self.search_ids(self.users[2], '/api/post-media/search/', label='fontana'), [public])
+        response = self.client_for(self.users[2]).get(f'/api/trip-groups/{self.group.id}/media/search/',
+                                                      {'label': 'fontana'})
+        self.assertEqual(response.status_code, 403)
+
+        Gruppo.objects.filter(pk=self.group.pk).update(is_private=True)
+        self.assertEqual(self.search_ids(self.users[2], '/api/post-media/search/', label='fontana'), [])
+
+
+class MembershipCacheTests(TripTalesTestCase):
+    def test_warm_checks_cost_no_queries(self):
+        client = self.client_for(self.users[1])
+        client.post(f'/api/diary-posts/{self.post.id}/like/')
+
+        # Post, like esistente, delete, contatori (post, utente, gruppo, giorno), totale e savepoint
+        with self.assertNumQueries(10):
+            response = client.post(f'/api/diary-posts/{self.post.id}/like/')
+        self.assertFalse(response.json()['liked'])
+
+        with CaptureQueriesContext(connection) as queries:
+            client.post(f'/api/diary-posts/{self.post.id}/add_comment/', {'content': 'Bello'})
+        tables = ' '.join(query['sql'] for query in queries)
+        self.assertNotIn('FROM "triptales_groupmembership"', tables)
+        self.assertNotIn('FROM "triptales_gruppo"', tables)
+
+    def test_membership_change_is_seen_immediately(self):
+        client = self.client_for(self.users[2])
+        self.assertEqual(client.post(f'/api/diary-posts/{self.post.id}/like/').status_code, 200)
+        GroupMembership.objects.filter(user=self.users[2], group=self.group).delete()
+        self.assertEqual(client.post(f'/api/diary-posts/{self.post.id}/like/').status_code, 404)
+
+
+def jpeg_upload(size=(2000, 1500), name='foto.jpg'):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (10, 120, 200)).save(buffer, 'JPEG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+
+
+class RenditionTests(TripTalesTestCase):
+    def upload(self, file):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client_for(self.users[0]).post('/api/post-media/upload_media/', {
+                'post_id': self.post.id, 'media_file': file
+            }, format='multipart')
+        self.assertEqual(response.status_code, 201, response.content)
+        return PostMedia.objects.get(pk=response.json()['id'])
+
+    def test_job_generates_every_size(self):
+        media = self.upload(jpeg_upload())
+        broken = self.upload(SimpleUploadedFile('rotta.jpg', b'not an image', content_type='image/jpeg'))
+        self.assertEqual(Job.objects.filter(task='generate_renditions').count(), 2)
+
+        with self.assertLogs('triptales.image_service', 'WARNING'):
+            done, failed = jobs.run_pending('w1')
+        self.assertEqual(failed, 0)
+        media.refresh_from_db()
+        broken.refresh_from_db()
+        self.assertEqual(set(media.renditions), {'128', '512', '1280'})
+        self.assertEqual(broken.renditions, {})
+        with default_storage.open(media.renditions['1280']) as file, Image.open(file) as image:
+            self.assertEqual(image.size, (1280, 960))
+
+    def test_in_flight_images_are_bounded(self):
+        ids = [self.upload(jpeg_upload((100 + i, 80))).pk for i in range(4)]
+        with mock.patch('triptales.image_service.RENDITION_MAX_IN_FLIGHT', 1):
+            self.assertEqual(ImageService.generate_renditions(ids), 4)
+        self.assertEqual([len(m.renditions) for m in PostMedia.objects.filter(pk__in=ids)], [3] * 4)
+
+    def test_replaced_and_deleted_media_drop_their_renditions(self):
+        media = self.upload(jpeg_upload())
+        jobs.run_pending('w1')
+        media.refresh_from_db()
+        old_names = list(media.renditions.values())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            media.media_url = jpeg_upload((300, 200))
+            media.save()
+        media.refresh_from_db()
+        self.assertEqual(media.renditions, {})
+        self.assertFalse(any(default_storage.exists(name) for name in old_names))
+        self.assertEqual(Job.objects.filter(task='generate_renditions').count(), 1)
+
+        jobs.run_pending('w1')
+        media.refresh_from_db()
+        new_names = list(media.renditions.values())
+        self.assertTrue(all(default_storage.exists(name) for name in new_names))
+        with self.captureOnCommitCallbacks(execute=True):
+            media.delete()
+        self.assertFalse(any(default_storage.exists(name) for name in new_names))
+
+
+@mock.patch.object(upload_service, 'UPLOAD_CHUNK_MAX_SIZE', 1000)
+class ChunkedUploadTests(TripTalesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.session_dir, ignore_errors=True)
+        patcher = mock.patch.object(upload_service, 'UPLOAD_SESSION_DIR', self.session_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = self.client_for(self.users[1])
+
+    def start(self, total_size, filename='clip.mp4'):
+        response = self.client.post('/api/media-uploads/', {
+            'post_id': self.post.id, 'filename': filename, 'total_size': total_size
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.json()['id']
+
+    def put(self, session_id, data, start, total_size, client=None):
+        return (client or self.client).generic(
+            'PUT', f'/api/media-uploads/{session_id}/', data, content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE=f'bytes {start}-{start + len(data) - 1}/{total_size}'
+        )
+
+    def test_resume_and_finalize(self):
+        payload = os.urandom(2500)
+        session_id = self.start(2500)
+        self.assertEqual(self.put(session_id, payload[:1000], 0, 2500).json()['received_size'], 1000)
+        # Un chunk oltre i byte ricevuti lascerebbe un buco
+        self.assertEqual(self.put(session_id, payload[1500:2000], 1500, 2500).status_code, 416)
+        self.assertEqual(self.client.post(f'/api/media-uploads/{session_id}/finalize/').status_code, 409)
+
+        # Dopo un'interruzione il client riparte dai byte ricevuti, anche reinviandone una parte
+        self.assertEqual(self.client.get(f'/api/media-uploads/{session_id}/').json()['received_size'], 1000)
+        self.assertEqual(self.put(session_id, payload[500:1500], 500, 2500).json()['received_size'], 1500)
+        self.assertEqual(self.put(session_id, payload[1500:], 1500, 2500).json()['received_size'], 2500)
+
+        response = self.client.post(f'/api/media-uploads/{session_id}/finalize/')
+        self.assertEqual(response.status_code, 201, response.content)
+        media = PostMedia.objects.get(pk=response.json()['id'])
+        with media.media_url.open('rb') as file:
+            self.assertEqual(file.read(), payload)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(os.listdir(self.session_dir), [])
+
+    def test_limits_and_ownership(self):
+        session_id = self.start(2500)
+        self.assertEqual(self.put(session_id, b'x' * 1001, 0, 2500).status_code, 413)
+        self.assertEqual(self.put(session_id, b'x' * 10, 0, 2500, client=self.client_for(self.users[2])).status_code, 404)
+
+        outsider = Utente.objects.create_user('outsider', 'outsider@example.com', 'password')
+        response = self.client_for(outsider).post('/api/media-uploads/', {
+            'post_id': self.post.id, 'filename': 'clip.mp4', 'total_size': 10
+        }, format='json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_expired_sessions_are_collected(self):
+        session_id = self.start(10)
+        UploadSession.objects.filter(pk=session_id).update(updated_at=timezone.now() - timedelta(days=2))
+        self.assertEqual(upload_service.UploadService.collect_expired(), 1)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(os.listdir(self.session_dir), [])
+
+
+class MediaBlobTests(TripTalesTestCase):
+    def upload(self, data, filename='clip.mp4'):
+        response = self.client_for(self.users[0]).post('/api/post-media/upload_media/', {
+            'post_id': self.post.id, 'media_file': SimpleUploadedFile(filename, data)
+        }, format='multipart')
+        self.assertEqual(response.status_code, 201, response.content)
+        return PostMedia.objects.get(pk=response.json()['id'])
+
+    def test_same_content_is_stored_once(self):
+        first = self.upload(b'x' * 5000)
+        second = self.upload(b'x' * 5000, 'copy.mov')
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(first.media_url.name, second.media_url.name)
+        self.assertEqual(MediaBlob.objects.get(pk=first.blob_id).ref_count, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(MediaBlob.objects.get(pk=second.blob_id).ref_count, 1)
+        self.assertTrue(default_storage.exists(second.media_url.name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(MediaBlob.objects.exists())
+        self.assertFalse(default_storage.exists(second.media_url.name))
+
+    def test_replaced_file_releases_old_blob(self):
+        media = PostMedia.objects.create(post=self.post, media_url=ContentFile(b'abc', name='a.jpg'))
+        old_blob_id = media.blob_id
+        with self.captureOnCommitCallbacks(execute=True):
+            media.media_url = ContentFile(b'def', name='a.jpg')
+            media.save()
+        self.assertNotEqual(media.blob_id, old_blob_id)
+        self.assertFalse(MediaBlob.objects.filter(pk=old_blob_id).exists())
+
+        media.caption = 'Colosseo'
+        media.save()
+        self.assertEqual(MediaBlob.objects.get(pk=media.blob_id).ref_count, 1)
+
+    def test_dedupe_media_command(self):
+        names = [
+            default_storage.save(f'post_media/legacy{i}.jpg', ContentFile(data))
+            for i, data in enumerate([b'dup' * 100, b'dup' * 100, b'unique'])
+        ]
+        PostMedia.objects.bulk_create([PostMedia(post=self.post, media_url=name) for name in names])
+
+        out = io.StringIO()
+        call_command('dedupe_media', '--dry-run', stdout=out)
+        self.assertIn('Recuperabili 300 byte', out.getvalue())
+        self.assertFalse(MediaBlob.objects.exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('dedupe_media', stdout=io.StringIO())
+        self.assertEqual(MediaBlob.objects.get(file=names[0]).ref_count, 2)
+        self.assertFalse(default_storage.exists(names[1]))
+        self.assertEqual(set(PostMedia.objects.values_list('media_url', flat=True)), {names[0], names[2]})
+
+
+def jpeg_with_exif(gps=True, taken='2024:07:14 18:22:05', offset='+02:00'):
+    exif = Image.Exif()
+    if gps:
+        exif.get_ifd(ExifTags.IFD.GPSInfo).update({1: 'N', 2: (41.0, 53.0, 24.0), 3: 'E', 4: (12.0, 29.0, 32.0)})
+    if taken:
+        details = exif.get_ifd(ExifTags.IFD.Exif)
+        details[0x9003] = taken
+        if offset:
+            details[0x9011] = offset
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 48)).save(buffer, 'JPEG', exif=exif)
+    return buffer.getvalue()
+
+
+class ExifTests(TripTalesTestCase):
+    def test_read_exif(self):
+        data = read_exif(io.BytesIO(jpeg_with_exif()))
+        self.assertAlmostEqual(data['latitude'], 41.89, places=2)
+        self.assertAlmostEqual(data['longitude'], 12.4922, places=3)
+        self.assertEqual(data['captured_at'], datetime(2024, 7, 14, 16, 22, 5, tzinfo=dt_timezone.utc))
+
+        self.assertEqual(read_exif(io.BytesIO(jpeg_with_exif(gps=False, taken='0000:00:00 00:00:00'))), {})
+        self.assertEqual(read_exif(io.BytesIO(b'not an image')), {})
+
+    def test_upload_geotags_media_and_post(self):
+        client = self.client_for(self.users[0])
+        response = client.post('/api/post-media/upload_media/', {
+            'post_id': self.post.id, 'media_file': SimpleUploadedFile('a.jpg', jpeg_with_exif())
+        }, format='multipart')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertIsNotNone(response.json()['captured_at'])
+        media = PostMedia.objects.get(pk=response.json()['id'])
+        self.assertIsNotNone(media.geo_cell)
+        self.assertTrue(media.exif_read)
+        self.post.refresh_from_db()
+        self.assertAlmostEqual(self.post.latitude, 41.89, places=2)
+
+        # Le coordinate inviate dal client hanno la precedenza sull'EXIF
+        response = client.post('/api/post-media/upload_media/', {
+            'post_id': self.post.id, 'latitude': 10, 'longitude': 10,
+            'media_file': SimpleUploadedFile('b.jpg', jpeg_with_exif(taken=None) + b'x')
+        }, format='multipart')
+        self.assertEqual(response.json()['latitude'], 10.0)
+
+    def test_extract_exif_backfill(self):
+        names = [
+            default_storage.save('post_media/old.jpg', ContentFile(jpeg_with_exif())),
+            default_storage.save('post_media/broken.jpg', ContentFile(b'junk')),
+        ]
+        PostMedia.objects.bulk_create([PostMedia(post=self.post, media_url=name) for name in names])
+
+        call_command('extract_exif', '--workers', '2', stdout=io.StringIO())
+        media = PostMedia.objects.get(media_url=names[0])
+        self.assertIsNotNone(media.geo_cell)
+        self.assertIsNotNone(media.captured_at)
+        self.post.refresh_from_db()
+        self.assertIsNotNone(self.post.latitude)
+
+        # Anche la foto senza EXIF è segnata come letta: il secondo giro non apre nessun file
+        self.assertTrue(PostMedia.objects.get(media_url=names[1]).exif_read)
+        out = io.StringIO()
+        with mock.patch('triptales.management.commands.extract_exif.read_stored_exif') as read:
+            call_command('extract_exif', stdout=out)
+        read.assert_not_called()
+        self.assertIn('0 foto da elaborare', out.getvalue())
@@ -0,0 +1,209 @@
+# triptales/upload_service.py
+"""
+Upload a blocchi riprendibili per i media grandi.
+
+Il client crea una sessione, invia i byte con PUT e Content-Range
+(bytes inizio-fine/totale) e alla fine la finalizza, creando il PostMedia.
+Ogni blocco viene scritto su disco a pezzi da CHUNK_READ_SIZE, senza tenere
+in memoria tutta la richiesta. Dopo un'interruzione il client legge
+received_size dalla sessione e riprende da lì.
+"""
+import os
+import re
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from rest_framework import status
+
+from .activity_service import ActivityService
+from .image_service import ImageService
+from .models import PostMedia, UploadSession
+
+UPLOAD_SESSION_DIR = getattr(settings, 'UPLOAD_SESSION_DIR', os.path.join(settings.BASE_DIR, 'upload_sessions'))
+UPLOAD_MAX_SIZE = getattr(settings, 'UPLOAD_MAX_SIZE', 1024 * 1024 * 1024)
+UPLOAD_CHUNK_MAX_SIZE = getattr(settings, 'UPLOAD_CHUNK_MAX_SIZE', 8 * 1024 * 1024)
+UPLOAD_SESSION_TTL_HOURS = getattr(settings, 'UPLOAD_SESSION_TTL_HOURS', 24)
+CHUNK_READ_SIZE = 64 * 1024
+
+MEDIA_EXTENSIONS = {
+    'image': ('.jpg', '.jpeg', '.png', '.gif', '.webp'),
+    'video': ('.mp4', '.mov', '.avi', '.mkv'),
+}
+
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+
+
+class UploadError(Exception):
+    """Richiesta di upload non valida: message e status vanno nella risposta."""
+
+    def __init__(self, message, status_code=status.HTTP_400_BAD_REQUEST):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def media_type_for(filename):
+    extension = os.path.splitext(filename.lower())[1]
+    for media_type, extensions in MEDIA_EXTENSIONS.items():
+        if extension in extensions:
+            return media_type
+    return None
+
+
+def part_path(session_id):
+    return os.path.join(UPLOAD_SESSION_DIR, f'{session_id}.part')
+
+
+def parse_content_range(header, total_size):
+    """(inizio, fine inclusa) da 'bytes 0-1048575/209715200'. Solleva UploadError."""
+    match = CONTENT_RANGE_RE.fullmatch(header or '')
+    if not match:
+        raise UploadError("Header Content-Range mancante o non valido (bytes inizio-fine/totale).")
+    start, end, total = map(int, match.groups())
+    if total != total_size or start > end or end >= total_size:
+        raise UploadError("Content-Range non coerente con la dimensione del file.",
+                          status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+    if end - start + 1 > UPLOAD_CHUNK_MAX_SIZE:
+        raise UploadError(f"Blocco troppo grande: al massimo {UPLOAD_CHUNK_MAX_SIZE} byte per richiesta.",
+                          status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    return start, end
+
+
+class PartFile(File):
+    """File parziale completato: FileSystemStorage lo sposta nello storage invece di copiarlo."""
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class UploadService:
+    """Sessioni di upload a blocchi: creazione, blocchi, finalizzazione e pulizia."""
+
+    @staticmethod
+    def create_session(user, post, filename, total_size, latitude=None, longitude=None):
+        filename = os.path.basename(filename or '')
+        media_type = media_type_for(filename)
+        if media_type is None:
+            raise UploadError("Tipo di file non supportato. Usa immagini (jpg, png, gif) o video (mp4, mov, avi).")
+        if not 0 < total_size <= UPLOAD_MAX_SIZE:
+            raise UploadError(f"Dimensione del file non valida: al massimo {UPLOAD_MAX_SIZE} byte.")
+
+        session = UploadSession.objects.create(
+            user=user, post=post, filename=filename, media_type=media_type, total_size=total_size,
+            latitude=latitude, longitude=longitude
+        )
+        os.makedirs(UPLOAD_SESSION_DIR, exist_ok=True)
+        open(part_path(session.pk), 'wb').close()
+        return session
+
+    @staticmethod
+    def write_chunk(session, content_range, stream, content_length):
+        """
+        Scrive un blocco letto da stream (il corpo della richiesta) nel file
+        parziale. Il blocco può ripetere byte già ricevuti ma non lasciare
+        buchi. Restituisce la sessione aggiornata.
+        """
+        start, end = parse_content_range(content_range, session.total_size)
+        if start > session.received_size:
+            raise UploadError(
+                f"Blocco fuori sequenza: riprendi da {session.received_size}.",
+                status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+            )
+        length = end - start + 1
+        if content_length != length:
+            raise UploadError("Content-Length diverso dalla lunghezza indicata in Content-Range.")
+
+        written = 0
+        try:
+            with open(part_path(session.pk), 'r+b') as part:
+                part.seek(start)
+                while written < length:
+                    data = stream.read(min(CHUNK_READ_SIZE, length - written))
+                    if not data:
+                        break
+                    part.write(data)
+                    written += len(data)
+        except FileNotFoundError:
+            raise UploadError("Sessione di upload scaduta.", status.HTTP_404_NOT_FOUND)
+
+        # Anche un blocco interrotto a metà fa avanzare la sessione: il client riprende da lì
+        UploadSession.objects.filter(pk=session.pk, received_size__gte=start).update(
+            received_size=Greatest(F('received_size'), start + written),
+            updated_at=timezone.now()
+        )
+        session.refresh_from_db(fields=['received_size', 'updated_at'])
+        if written < length:
+            raise UploadError(f"Blocco incompleto: ricevuti {written} byte su {length}.")
+        return session
+
+    @staticmethod
+    def finalize(session):
+        """Crea il PostMedia dal file completo ed elimina la sessione."""
+        if session.received_size != session.total_size:
+            raise UploadError(
+                f"Upload incompleto: ricevuti {session.received_size} byte su {session.total_size}.",
+                status.HTTP_409_CONFLICT
+            )
+
+        try:
+            part = open(part_path(session.pk), 'rb')
+        except FileNotFoundError:
+            raise UploadError("Sessione di upload scaduta.", status.HTTP_404_NOT_FOUND)
+
+        with part, transaction.atomic():
+            # Una sola finalizzazione per sessione, anche con richieste ripetute dal client
+            if not UploadSession.objects.filter(pk=session.pk).delete()[0]:
+                raise UploadError("Sessione di upload già finalizzata.", status.HTTP_404_NOT_FOUND)
+
+            media = PostMedia.objects.create(
+                post=session.post,
+                media_type=session.media_type,
+                media_url=PartFile(part, name=session.filename),
+                latitude=session.latitude,
+                longitude=session.longitude
+            )
+            ActivityService.media_added(media)
+            ImageService.schedule_renditions(media)
+
+        UploadService.remove_part(session.pk)
+        return media
+
+    @staticmethod
+    def abort(session):
+        session_id = session.pk  # delete() azzera la pk dell'istanza
+        session.delete()
+        UploadService.remove_part(session_id)
+
+    @staticmethod
+    def remove_part(session_id):
+        try:
+            os.remove(part_path(session_id))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def collect_expired():
+        """
+        Elimina le sessioni senza blocchi da UPLOAD_SESSION_TTL_HOURS e i file
+        parziali rimasti senza sessione. Restituisce il numero di sessioni eliminate.
+        """
+        ttl = timedelta(hours=UPLOAD_SESSION_TTL_HOURS)
+        expired = list(UploadSession.objects.filter(updated_at__lt=timezone.now() - ttl).values_list('pk', flat=True))
+        UploadSession.objects.filter(pk__in=expired).delete()
+        for session_id in expired:
+            UploadService.remove_part(session_id)
+
+        # File di sessioni cancellate insieme al post o all'utente
+        if os.path.isdir(UPLOAD_SESSION_DIR):
+            cutoff = time.time() - ttl.total_seconds()
+            live = {str(session_id) for session_id in UploadSession.objects.values_list('pk', flat=True)}
+            for entry in os.scandir(UPLOAD_SESSION_DIR):
+                session_id = entry.name.removesuffix('.part')
+                if session_id not in live and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+        return len(expired)
@@ -9,6 +9,7 @@ router.register(r'trip-groups', views.TripGroupViewSet)
 router.register(r'group-memberships', views.GroupMembershipViewSet)
 router.register(r'diary-posts', views.DiaryPostViewSet)
 router.register(r'post-media', views.PostMediaViewSet)
+router.register(r'media-uploads', views.UploadSessionViewSet)
 router.register(r'comments', views.CommentViewSet)
 router.register(r'badges', views.BadgeViewSet)
 router.register(r'user-badges', views.UserBadgeViewSet)
@@ -1,22 +1,39 @@
-from math import radians, sin, cos, sqrt, asin
+import math
+import re
+from datetime import timedelta
 
-from django.db import models
-from rest_framework import viewsets, permissions, status, filters, parsers
+from django.db import transaction
+from rest_framework import mixins, viewsets, permissions, status, parsers
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from django.db.models import Count
+from django.db.models import Avg, Count, F, Max, Prefetch, Q, Sum
+from django.db.models import prefetch_related_objects
+from django.db.models.functions import Cos, Radians, Sin, Substr
 from django.utils import timezone
 from django.shortcuts import get_object_or_404
 
-from .models import Utente, Gruppo, GroupMembership, DiaryPost, PostMedia, Comment, Like, Badge, UserBadge
+from .models import (Utente, Gruppo, GroupMembership, DiaryPost, PostMedia, Comment, Like, Badge, UserBadge, ChatMessage,
+                     UserStats, GroupScore, UploadSession)
 from .serializers import (UserSerializer, TripGroupSerializer, GroupMembershipSerializer,
                           DiaryPostSerializer, PostMediaSerializer, CommentSerializer,
-                          LikeSerializer, BadgeSerializer, UserBadgeSerializer, GroupInvite, GroupInviteSerializer)
+                          LikeSerializer, BadgeSerializer, UserBadgeSerializer, GroupInvite, GroupInviteSerializer,
+                          DiaryPostSummarySerializer, ChatMessageSerializer, DynamicFieldsMixin, liked_post_ids, parse_list_param,
+                          sparse_fieldset_kwargs, UploadSessionSerializer)
 from .permissions import IsOwnerOrReadOnly, IsMemberOrReadOnly, IsGroupAdmin
+from . import membership_cache
+from .membership_cache import member_group_ids, request_is_admin, request_is_member
+from .pagination import KeysetPagination
+from .search_service import FullTextSearchFilter, fulltext_search, search_terms, visible_groups, visible_posts
 
 from rest_framework.views import APIView
 from rest_framework.permissions import AllowAny
 from .badge_service import BadgeService
+from .image_service import MAP_THUMBNAIL_SIZE, ImageService, rendition_url
+from .media_search_service import MediaSearchService, normalize_label, text_words
+from .upload_service import UploadError, UploadService, media_type_for
+from .activity_service import ActivityService, DAILY_SCORE_RETENTION_DAYS, media_counters, retention_start
+from .geo_service import (calculate_distance, nearby_filter, parse_bbox, bbox_filter,
+                          cluster_precision_for_zoom)
 
 class RegisterView(APIView):
     permission_classes = [AllowAny]
@@ -59,89 +76,225 @@ class RegisterView(APIView):
                            status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-class UserViewSet(viewsets.ModelViewSet):
-    queryset = Utente.objects.all()
-    serializer_class = UserSerializer
+class SparseFieldsetMixin:
+    """Passa ?fields= e ?expand= ai serializer che supportano gli sparse fieldset."""
 
-    @action(detail=False, methods=['get'])
-    def stats(self, request):
-        """Restituisce le statistiche dell'utente corrente."""
-        user = request.user
+    def get_serializer(self, *args, **kwargs):
+        if issubclass(self.get_serializer_class(), DynamicFieldsMixin):
+            for key, value in sparse_fieldset_kwargs(self.request).items():
+                kwargs.setdefault(key, value)
+        return super().get_serializer(*args, **kwargs)
 
-        # Calcola le statistiche
-        post_count = DiaryPost.objects.filter(author=user).count()
 
-        # Likes ricevuti sui post dell'utente
-        likes_count = Like.objects.filter(post__author=user).count()
+def post_list_queryset(queryset, request):
+    """Precarica solo le relazioni usate dalla rappresentazione compatta dei post."""
+    queryset = queryset.select_related('author').prefetch_related('media')
+    if 'comments' in (parse_list_param(request, 'expand') or ()):
+        queryset = queryset.prefetch_related('comments__author')
+    return queryset
 
-        # Commenti fatti dall'utente
-        comments_count = Comment.objects.filter(author=user).count()
 
-        return Response({
-            'postCount': post_count,
-            'likesCount': likes_count,
-            'commentsCount': comments_count
-        })
+# Chiavi della risposta di stats -> contatori di UserStats
+USER_STATS_FIELDS = {
+    'postCount': 'posts_count',
+    'likesCount': 'likes_received',
+    'commentsCount': 'comments_count',
+}
+USER_STATS_BATCH_LIMIT = 100
 
-    @action(detail=False, methods=['get'])
-    def leaderboard(self, request):
-        """Restituisce la classifica degli utenti più attivi."""
-        # Ottieni il parametro opzionale per il gruppo
-        group_id = request.query_params.get('group_id', None)
-
-        # Base query per ottenere utenti con conteggio like
-        queryset = Utente.objects.annotate(
-            post_count=Count('posts', distinct=True),
-            like_count=Count('posts__likes', distinct=True),
-            comment_count=Count('comments', distinct=True),
-            total_score=Count('posts', distinct=True) +
-                        (Count('posts__likes', distinct=True) * 2) +
-                        Count('comments', distinct=True)
+
+def user_stats_entry(row):
+    """Risposta di stats da una riga values() di UserStats (tutto a zero se manca)."""
+    return {key: row[field] if row else 0 for key, field in USER_STATS_FIELDS.items()}
+
+
+def leaderboard_window(window, group):
+    """
+    Intervallo di date (inizio, fine) di ?window=: "7d" sono gli ultimi 7
+    giorni, "trip" le date del viaggio del gruppo. Solleva ValueError, anche
+    per i viaggi iniziati prima della retention dei bucket giornalieri.
+    """
+    today = timezone.localdate()
+    if window == 'trip':
+        if group is None:
+            raise ValueError("La finestra 'trip' richiede group_id.")
+        if group.start_date < retention_start():
+            raise ValueError(
+                f"I punteggi giornalieri dei viaggi iniziati prima del {retention_start().isoformat()} "
+                f"non sono più disponibili: usa la classifica del gruppo senza window."
+            )
+        return group.start_date, group.end_date
+
+    match = re.fullmatch(r'(\d+)d', window)
+    days = int(match.group(1)) if match else 0
+    if not 1 <= days <= DAILY_SCORE_RETENTION_DAYS:
+        raise ValueError(f"Finestra non valida: usa 'trip' o da 1d a {DAILY_SCORE_RETENTION_DAYS}d.")
+    return today - timedelta(days=days - 1), today
+
+
+def leaderboard_scores(group_id=None, window=None):
+    """
+    Righe della classifica, con score, contatori e user_id: globale
+    (UserStats), del gruppo (GroupScore) o, con window, sommando i bucket
+    DailyScore dei giorni richiesti. Restituisce (queryset, errore).
+    """
+    group = None
+    if group_id:
+        try:
+            group = Gruppo.objects.get(id=group_id)
+        except (Gruppo.DoesNotExist, ValueError):
+            return None, ("Gruppo non trovato.", status.HTTP_404_NOT_FOUND)
+
+    if window:
+        try:
+            start, end = leaderboard_window(window, group)
+        except ValueError as e:
+            return None, (str(e), status.HTTP_400_BAD_REQUEST)
+
+        # Le condizioni sui bucket vanno nello stesso filter() per usare un solo join
+        conditions = {'daily_scores__day__range': (start, end)}
+        if group is not None:
+            conditions['daily_scores__group'] = group
+        buckets = Utente.objects.filter(**conditions)
+        if group is not None:
+            buckets = buckets.filter(memberships__group=group)
+        return buckets.annotate(
+            user_id=F('id'),
+            score=Sum('daily_scores__score'),
+            posts_count=Sum('daily_scores__posts_count'),
+            likes_received=Sum('daily_scores__likes_received'),
+            comments_count=Sum('daily_scores__comments_count')
+        ), None
+
+    if group is None:
+        return UserStats.objects.all(), None
+    return GroupScore.objects.filter(group=group, is_member=True), None
+
+
+def leaderboard_rank(scores, row):
+    """Posizione di row nell'ordine (score, user_id) decrescente, contando sull'indice chi la precede."""
+    return scores.filter(Q(score__gt=row.score) | Q(score=row.score, user_id__gt=row.user_id)).count() + 1
+
+
+def with_leaderboard_users(scores):
+    """Carica utenti e badge delle righe della classifica."""
+    if scores.model is Utente:
+        return scores.prefetch_related('badges__badge')
+    return scores.select_related('user').prefetch_related('user__badges__badge')
+
+
+def leaderboard_entry(row, rank, request):
+    user = row if isinstance(row, Utente) else row.user
+    return {
+        "rank": rank,
+        "id": user.id,
+        "username": user.username,
+        "profile_picture": request.build_absolute_uri(
+            user.profile_picture.url) if user.profile_picture else None,
+        "post_count": row.posts_count,
+        "like_count": row.likes_received,
+        "comment_count": row.comments_count,
+        "total_score": row.score,
+        "badges": [
+            {
+                "id": ub.badge.id,
+                "name": ub.badge.name,
+                "description": ub.badge.description,
+                "icon_url": request.build_absolute_uri(ub.badge.icon_url.url) if ub.badge.icon_url else None
+            } for ub in user.badges.all()
+        ]
+    }
+
+
+def media_search_response(request, groups):
+    """
+    Media dei gruppi indicati con tutte le etichette di ?label=monument,statue
+    e tutte le parole di ?q= (OCR e caption), dai più recenti e a pagine.
+    """
+    labels = [label for label in map(normalize_label, parse_list_param(request, 'label') or ()) if label]
+    words = text_words(request.query_params.get('q'))
+    if not labels and not words:
+        return Response(
+            {"detail": "Indica almeno un'etichetta (?label=) o un testo (?q=)."},
+            status=status.HTTP_400_BAD_REQUEST
         )
 
-        # Se specificato, filtra per gruppo
-        if group_id:
-            try:
-                group = Gruppo.objects.get(id=group_id)
-                queryset = queryset.filter(
-                    memberships__group=group
-                )
-            except Gruppo.DoesNotExist:
-                return Response(
-                    {"detail": "Gruppo non trovato."},
-                    status=status.HTTP_404_NOT_FOUND
-                )
+    media = MediaSearchService.search(labels, words, groups)
+    if 'media_type' in request.query_params:
+        media = media.filter(media_type=request.query_params['media_type'])
 
-        # Ordina per punteggio totale
-        queryset = queryset.order_by('-total_score')[:10]
+    paginator = KeysetPagination(fields=('id',))
+    page = paginator.paginate_queryset(media, request)
+    serializer = PostMediaSerializer(page, many=True, context={'request': request})
+    return paginator.get_paginated_response(serializer.data)
 
-        # Serializza i risultati
-        data = []
-        for user in queryset:
-            # Ottieni i badge dell'utente
-            user_badges = UserBadge.objects.filter(user=user)
-            badges = [
-                {
-                    "id": ub.badge.id,
-                    "name": ub.badge.name,
-                    "description": ub.badge.description,
-                    "icon_url": request.build_absolute_uri(ub.badge.icon_url.url) if ub.badge.icon_url else None
-                } for ub in user_badges
-            ]
 
-            data.append({
-                "id": user.id,
-                "username": user.username,
-                "profile_picture": request.build_absolute_uri(
-                    user.profile_picture.url) if user.profile_picture else None,
-                "post_count": user.post_count,
-                "like_count": user.like_count,
-                "comment_count": user.comment_count,
-                "total_score": user.total_score,
-                "badges": badges
-            })
+class UserViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
+    queryset = Utente.objects.all()
+    serializer_class = UserSerializer
 
-        return Response(data)
+    @action(detail=False, methods=['get'])
+    def stats(self, request):
+        """Restituisce le statistiche dell'utente corrente."""
+        row = UserStats.objects.filter(pk=request.user.pk).values(*USER_STATS_FIELDS.values()).first()
+        return Response(user_stats_entry(row))
+
+    @action(detail=False, methods=['get'], url_path='stats/batch')
+    def stats_batch(self, request):
+        """
+        Statistiche di più utenti in una sola query: ?ids=1,2,3 (al massimo
+        USER_STATS_BATCH_LIMIT). Gli id di utenti inesistenti vengono ignorati.
+        """
+        try:
+            user_ids = {int(user_id) for user_id in parse_list_param(request, 'ids') or ()}
+        except ValueError:
+            return Response({"detail": "ids deve essere una lista di id separati da virgola."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if not user_ids:
+            return Response({"detail": "Il parametro ids è obbligatorio."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(user_ids) > USER_STATS_BATCH_LIMIT:
+            return Response({"detail": f"Al massimo {USER_STATS_BATCH_LIMIT} utenti per richiesta."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        rows = UserStats.objects.filter(pk__in=user_ids).values('pk', *USER_STATS_FIELDS.values())
+        return Response({str(row['pk']): user_stats_entry(row) for row in rows})
+
+    @action(detail=False, methods=['get'])
+    def leaderboard(self, request):
+        """
+        Restituisce la classifica degli utenti più attivi a pagine di 10:
+        globale, del gruppo con ?group_id=, e su una finestra di date con
+        ?window=7d (ultimi N giorni) o ?window=trip (date del viaggio).
+        """
+        scores, error = leaderboard_scores(request.query_params.get('group_id'), request.query_params.get('window'))
+        if error:
+            detail, error_status = error
+            return Response({"detail": detail}, status=error_status)
+
+        paginator = KeysetPagination(fields=('score', 'user_id'))
+        paginator.page_size = 10
+        page = paginator.paginate_queryset(with_leaderboard_users(scores), request)
+
+        # Posizione del primo della pagina, le altre sono consecutive
+        first_rank = leaderboard_rank(scores, page[0]) if page else None
+        data = [leaderboard_entry(row, first_rank + offset, request) for offset, row in enumerate(page)]
+        return paginator.get_paginated_response(data)
+
+    @action(detail=False, methods=['get'], url_path='leaderboard/me')
+    def my_rank(self, request):
+        """Posizione e punteggio dell'utente corrente nella classifica (stessi parametri di leaderboard)."""
+        scores, error = leaderboard_scores(request.query_params.get('group_id'), request.query_params.get('window'))
+        if error:
+            detail, error_status = error
+            return Response({"detail": detail}, status=error_status)
+
+        row = with_leaderboard_users(scores.filter(user_id=request.user.id)).first()
+        if row is None:
+            return Response(
+                {"detail": "Non sei in questa classifica."},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(leaderboard_entry(row, leaderboard_rank(scores, row), request))
 
     def get_permissions(self):
         if self.action == 'create':
@@ -173,42 +326,71 @@ class UserViewSet(viewsets.ModelViewSet):
 
 # In triptales/views.py
 
-class TripGroupViewSet(viewsets.ModelViewSet):
-    queryset = Gruppo.objects.all()
+class TripGroupViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
+    # Contatori e ultima attività sono denormalizzati sul gruppo: una sola query per le liste
+    queryset = Gruppo.objects.select_related('created_by').order_by('-last_activity_at', '-id')
     serializer_class = TripGroupSerializer
     permission_classes = [permissions.IsAuthenticated]
-    filter_backends = [filters.SearchFilter]
-    search_fields = ['name', 'location']
+    # ?search= usa l'indice full-text (nome, luogo e descrizione), vedi search_service
+    filter_backends = [FullTextSearchFilter]
 
     # Aggiungi questo metodo alla classe TripGroupViewSet in triptales/views.py
 
     @action(detail=True, methods=['get'])
     def map_posts(self, request, pk=None):
         """
-        Restituisce tutti i post con geolocalizzazione per la mappa del gruppo
+        Restituisce i post con geolocalizzazione per la mappa del gruppo.
+        Con ?zoom= (e opzionalmente ?bbox=min_lon,min_lat,max_lon,max_lat)
+        agli zoom bassi restituisce cluster calcolati sulle celle geohash.
         """
         group = self.get_object()
 
         # Verifica che l'utente faccia parte del gruppo
-        if not group.memberships.filter(user=request.user).exists():
+        if not request_is_member(request, group.id):
             return Response(
                 {"detail": "You are not a member of this group."},
                 status=status.HTTP_403_FORBIDDEN
             )
 
+        try:
+            zoom = int(request.query_params['zoom']) if 'zoom' in request.query_params else None
+            bbox = parse_bbox(request.query_params['bbox']) if 'bbox' in request.query_params else None
+        except ValueError:
+            return Response(
+                {"detail": "Invalid zoom or bbox parameters."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
         # Ottieni i post con coordinate valide
         posts_with_location = DiaryPost.objects.filter(
             group=group,
-            is_chat_message=False,  # Esclude i messaggi chat
             latitude__isnull=False,
             longitude__isnull=False
-        ).select_related('author').prefetch_related('media', 'likes').order_by('-created_at')
+        )
+        if bbox:
+            posts_with_location = posts_with_location.filter(bbox_filter(bbox))
+
+        precision = cluster_precision_for_zoom(zoom) if zoom is not None else None
+        if precision is not None:
+            return Response({
+                'group_name': group.name,
+                'group_location': group.location,
+                'mode': 'clusters',
+                'precision': precision,
+                'clusters': self._map_clusters(request, posts_with_location, precision)
+            })
+
+        posts_with_location = list(posts_with_location.select_related('author').prefetch_related(
+            Prefetch('media', queryset=PostMedia.objects.filter(media_type='image').order_by('id'))
+        ).order_by('-created_at'))
+        liked_ids = liked_post_ids(request.user, [post.pk for post in posts_with_location])
 
         # Serializza i dati per la mappa
         map_data = []
         for post in posts_with_location:
-            # Prendi la prima immagine se disponibile
-            first_image = post.media.filter(media_type='image').first()
+            # Prendi la prima immagine se disponibile (già precaricata)
+            images = post.media.all()
+            first_image = images[0] if images else None
 
             map_data.append({
                 'id': post.id,
@@ -224,17 +406,56 @@ class TripGroupViewSet(viewsets.ModelViewSet):
                     'profile_picture': request.build_absolute_uri(
                         post.author.profile_picture.url) if post.author.profile_picture else None
                 },
-                'image_url': request.build_absolute_uri(first_image.media_url.url) if first_image else None,
-                'likes_count': post.likes.count(),
-                'user_has_liked': post.likes.filter(user=request.user).exists()
+                'image_url': request.build_absolute_uri(
+                    rendition_url(first_image, MAP_THUMBNAIL_SIZE)) if first_image else None,
+                'likes_count': post.likes_count,
+                'user_has_liked': post.pk in liked_ids
             })
 
         return Response({
             'group_name': group.name,
             'group_location': group.location,
+            'mode': 'posts',
             'posts': map_data
         })
 
+    def _map_clusters(self, request, posts, precision):
+        """Raggruppa i post per prefisso di geo_cell con un'unica GROUP BY in SQL."""
+        cells = posts.annotate(cell=Substr('geo_cell', 1, precision)).values('cell').order_by()
+        # Longitudine media sul cerchio (media dei vettori unitari): resta corretta vicino a ±180
+        clusters = cells.annotate(
+            count=Count('id'),
+            latitude=Avg('latitude'),
+            longitude_x=Avg(Cos(Radians('longitude'))),
+            longitude_y=Avg(Sin(Radians('longitude'))),
+            post_id=Max('id')
+        )
+
+        # Immagine rappresentativa: la più recente di ogni cella
+        media_ids = PostMedia.objects.filter(
+            post__in=posts,
+            media_type='image'
+        ).annotate(cell=Substr('post__geo_cell', 1, precision)).values('cell').order_by().annotate(
+            media_id=Max('id')
+        ).values_list('cell', 'media_id')
+        media_by_cell = dict(media_ids)
+        thumbnails = {
+            media.id: media for media in PostMedia.objects.filter(id__in=media_by_cell.values())
+        }
+
+        data = []
+        for cluster in clusters:
+            media = thumbnails.get(media_by_cell.get(cluster['cell']))
+            data.append({
+                'cell': cluster['cell'],
+                'count': cluster['count'],
+                'latitude': cluster['latitude'],
+                'longitude': math.degrees(math.atan2(cluster['longitude_y'], cluster['longitude_x'])),
+                'post_id': cluster['post_id'],
+                'image_url': request.build_absolute_uri(rendition_url(media, MAP_THUMBNAIL_SIZE)) if media else None
+            })
+        return data
+
     @action(detail=True, methods=['post'])
     def add_location_post(self, request, pk=None):
         """
@@ -243,7 +464,7 @@ class TripGroupViewSet(viewsets.ModelViewSet):
         group = self.get_object()
 
         # Verifica che l'utente faccia parte del gruppo
-        if not group.memberships.filter(user=request.user).exists():
+        if not request_is_member(request, group.id):
             return Response(
                 {"detail": "You are not a member of this group."},
                 status=status.HTTP_403_FORBIDDEN
@@ -269,29 +490,33 @@ class TripGroupViewSet(viewsets.ModelViewSet):
             )
 
         try:
-            # Crea il post
-            post = DiaryPost.objects.create(
-                group=group,
-                author=request.user,
-                title=title,
-                content=content,
-                latitude=float(latitude),
-                longitude=float(longitude),
-                location_name=location_name
-            )
-
-            # Se c'è un'immagine, aggiungila
-            if 'image' in request.FILES:
-                PostMedia.objects.create(
-                    post=post,
-                    media_type='image',
-                    media_url=request.FILES['image'],
+            with transaction.atomic():
+                # Crea il post
+                post = DiaryPost.objects.create(
+                    group=group,
+                    author=request.user,
+                    title=title,
+                    content=content,
                     latitude=float(latitude),
-                    longitude=float(longitude)
+                    longitude=float(longitude),
+                    location_name=location_name
                 )
-
-            # Verifica i badge dopo la creazione di un post con posizione
-            BadgeService.check_all_badges(request.user)
+                ActivityService.post_created(post)
+
+                # Se c'è un'immagine, aggiungila
+                if 'image' in request.FILES:
+                    media = PostMedia.objects.create(
+                        post=post,
+                        media_type='image',
+                        media_url=request.FILES['image'],
+                        latitude=float(latitude),
+                        longitude=float(longitude)
+                    )
+                    ActivityService.media_added(media)
+                    ImageService.schedule_renditions(media)
+
+            # Accoda la verifica dei badge dopo la creazione di un post con posizione
+            BadgeService.schedule_check(request.user.id)
 
             serializer = DiaryPostSerializer(post, context={'request': request})
             return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -309,26 +534,8 @@ class TripGroupViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['get'])
     def my(self, request):
-        """Restituisce i gruppi dell'utente corrente."""
-        user = request.user
-        # Ottieni tutti i gruppi di cui l'utente è membro
-        memberships = GroupMembership.objects.filter(user=user)
-        groups = []
-
-        for membership in memberships:
-            group = membership.group
-            # Trova l'ultimo post o messaggio nel gruppo
-            last_activity = DiaryPost.objects.filter(group=group).order_by('-created_at').first()
-
-            # Aggiungi campo lastActivityDate al gruppo
-            setattr(group, 'lastActivityDate',
-                    last_activity.created_at if last_activity else group.created_at)
-
-            # Aggiungi campo user_role al gruppo
-            setattr(group, 'user_role', membership.role)
-
-            groups.append(group)
-
+        """Restituisce i gruppi dell'utente corrente, dal più recentemente attivo."""
+        groups = self.get_queryset().filter(memberships__user=request.user)
         serializer = self.get_serializer(groups, many=True, context={'request': request})
         return Response(serializer.data)
 
@@ -344,6 +551,8 @@ class TripGroupViewSet(viewsets.ModelViewSet):
                 group=group,
                 role='admin'
             )
+            # member_count è stato incrementato dal segnale della membership
+            group.refresh_from_db(fields=['member_count'])
 
             # Log dell'operazione per debug
             print(f"Gruppo {group.id} creato da {self.request.user.username} con ruolo admin")
@@ -371,7 +580,7 @@ class TripGroupViewSet(viewsets.ModelViewSet):
         group = self.get_object()
 
         # Check if user is already a member
-        if GroupMembership.objects.filter(user=request.user, group=group).exists():
+        if request_is_member(request, group.id):
             return Response({"detail": "You are already a member of this group."},
                             status=status.HTTP_400_BAD_REQUEST)
 
@@ -408,6 +617,7 @@ class TripGroupViewSet(viewsets.ModelViewSet):
             pending_invite.status = 'accepted'
             pending_invite.save()
 
+        group.refresh_from_db(fields=['member_count'])
         serializer = GroupMembershipSerializer(membership)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
@@ -442,9 +652,25 @@ class TripGroupViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['get'])
     def posts(self, request, pk=None):
         group = self.get_object()
-        posts = DiaryPost.objects.filter(group=group).order_by('-created_at')
-        serializer = DiaryPostSerializer(posts, many=True, context={'request': request})
-        return Response(serializer.data)
+        posts = post_list_queryset(DiaryPost.objects.filter(group=group), request)
+
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(posts, request)
+        serializer = DiaryPostSummarySerializer(
+            page, many=True, context={'request': request}, **sparse_fieldset_kwargs(request)
+        )
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=True, methods=['get'], url_path='media/search')
+    def media_search(self, request, pk=None):
+        """Media del viaggio per etichetta o testo riconosciuto (es. ?label=monument&media_type=image)."""
+        group = self.get_object()
+        if not request_is_member(request, group.id):
+            return Response(
+                {"detail": "You are not a member of this group."},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        return media_search_response(request, [group.id])
 
     @action(detail=True, methods=['get'])
     def messages(self, request, pk=None):
@@ -453,24 +679,25 @@ class TripGroupViewSet(viewsets.ModelViewSet):
         """
         group = self.get_object()
         # Verifica che l'utente faccia parte del gruppo
-        if not group.memberships.filter(user=request.user).exists():
+        if not request_is_member(request, group.id):
             return Response(
                 {"detail": "You are not a member of this group."},
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        # Ottieni i messaggi di chat ordinati per data
-        messages = DiaryPost.objects.filter(
-            group=group,
-            is_chat_message=True
-        ).order_by('created_at')
+        # Messaggi di chat in ordine cronologico, prima pagina dai più recenti.
+        # L'ordine è created_at (ora di ricezione) e non l'id: i messaggi websocket
+        # vengono inseriti in batch dal buffer di ogni worker, dopo quelli REST.
+        messages = ChatMessage.objects.filter(group=group).select_related('author')
 
-        serializer = DiaryPostSerializer(
-            messages,
+        paginator = KeysetPagination(newest_first=False, start_from_newest=True)
+        page = paginator.paginate_queryset(messages, request)
+        serializer = ChatMessageSerializer(
+            page,
             many=True,
             context={'request': request}
         )
-        return Response(serializer.data)
+        return paginator.get_paginated_response(serializer.data)
 
     @action(detail=True, methods=['post'])
     def send_message(self, request, pk=None):
@@ -479,48 +706,45 @@ class TripGroupViewSet(viewsets.ModelViewSet):
         """
         group = self.get_object()
         # Verifica che l'utente faccia parte del gruppo
-        if not group.memberships.filter(user=request.user).exists():
+        if not request_is_member(request, group.id):
             return Response(
                 {"detail": "You are not a member of this group."},
                 status=status.HTTP_403_FORBIDDEN
             )
 
         content = request.data.get('content', '')
-        if not content:
+        image = request.FILES.get('image')
+        if not content and not image:
             return Response(
                 {"detail": "Message content is required."},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
         # Crea il messaggio
-        message = DiaryPost.objects.create(
+        message = ChatMessage.objects.create(
             group=group,
             author=request.user,
-            title="Chat message",
             content=content,
-            is_chat_message=True
+            image=image
         )
+        ActivityService.group_active(group.id, message.created_at)
 
-        serializer = DiaryPostSerializer(message, context={'request': request})
+        serializer = ChatMessageSerializer(message, context={'request': request})
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     @action(detail=False, methods=['get'])
     def search(self, request):
-        query = request.query_params.get('search', '')
-        if not query:
+        """Gruppi pubblici o dell'utente che corrispondono a ?search=, per rilevanza e a pagine."""
+        terms = search_terms(request.query_params.get('search'))
+        if not terms:
             return Response({"detail": "Parametro di ricerca mancante"}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Cerca i gruppi che corrispondono alla query
-        queryset = Gruppo.objects.filter(name__icontains=query)
-
-        # Filtra i gruppi: mostra solo quelli pubblici O quelli di cui l'utente è membro
-        user_memberships = GroupMembership.objects.filter(user=request.user).values_list('group', flat=True)
-        queryset = queryset.filter(
-            models.Q(is_private=False) | models.Q(id__in=user_memberships)
-        )
+        groups = fulltext_search(visible_groups(self.get_queryset(), request.user), terms)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        paginator = KeysetPagination(fields=('rank', 'id'))
+        page = paginator.paginate_queryset(groups, request)
+        serializer = self.get_serializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
     # Aggiungi al TripGroupViewSet in triptales/views.py
 
@@ -530,7 +754,7 @@ class TripGroupViewSet(viewsets.ModelViewSet):
         group = self.get_object()
 
         # Verifica che l'utente che invia l'invito sia membro del gruppo
-        if not GroupMembership.objects.filter(user=request.user, group=group).exists():
+        if not request_is_member(request, group.id):
             return Response(
                 {"detail": "Solo i membri del gruppo possono inviare inviti."},
                 status=status.HTTP_403_FORBIDDEN
@@ -559,7 +783,7 @@ class TripGroupViewSet(viewsets.ModelViewSet):
             )
 
         # Verifica che l'utente non sia già nel gruppo
-        if GroupMembership.objects.filter(user=user_to_invite, group=group).exists():
+        if membership_cache.is_member(user_to_invite.id, group.id):
             return Response(
                 {"detail": "L'utente è già membro del gruppo."},
                 status=status.HTTP_400_BAD_REQUEST
@@ -614,6 +838,7 @@ class TripGroupViewSet(viewsets.ModelViewSet):
             group=invite.group,
             role='member'
         )
+        invite.group.refresh_from_db(fields=['member_count'])
 
         return Response(GroupMembershipSerializer(membership).data)
 
@@ -634,7 +859,7 @@ class TripGroupViewSet(viewsets.ModelViewSet):
 
         return Response({"detail": "Invito rifiutato con successo."})
 
-class GroupMembershipViewSet(viewsets.ModelViewSet):
+class GroupMembershipViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = GroupMembership.objects.all()
     serializer_class = GroupMembershipSerializer
     permission_classes = [permissions.IsAuthenticated, IsGroupAdmin]
@@ -644,13 +869,7 @@ class GroupMembershipViewSet(viewsets.ModelViewSet):
         membership = self.get_object()
 
         # Check if user is admin of this group
-        requester_is_admin = GroupMembership.objects.filter(
-            user=request.user,
-            group=membership.group,
-            role='admin'
-        ).exists()
-
-        if not requester_is_admin:
+        if not request_is_admin(request, membership.group_id):
             return Response({"detail": "Only admins can promote members."},
                             status=status.HTTP_403_FORBIDDEN)
 
@@ -662,49 +881,19 @@ class GroupMembershipViewSet(viewsets.ModelViewSet):
 
 
 
-class DiaryPostViewSet(viewsets.ModelViewSet):
+class DiaryPostViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = DiaryPost.objects.all()
     serializer_class = DiaryPostSerializer
     permission_classes = [permissions.IsAuthenticated, IsMemberOrReadOnly]
 
+    # Azioni di lista che usano la rappresentazione compatta dei post
+    summary_actions = ('list', 'feed', 'my_posts', 'nearby', 'search')
 
-    @action(detail=True, methods=['post'])
-    def like(self, request, pk=None):
-        """Like/Unlike di un post"""
-        post = self.get_object()
+    def get_serializer_class(self):
+        if self.action in self.summary_actions:
+            return DiaryPostSummarySerializer
+        return DiaryPostSerializer
 
-        # Verifica se l'utente può vedere questo post (è membro del gruppo)
-        if not post.group.memberships.filter(user=request.user).exists():
-            return Response(
-                {"detail": "Non hai il permesso di interagire con questo post."},
-                status=status.HTTP_403_FORBIDDEN
-            )
-
-        # Controlla se l'utente ha già messo like
-        existing_like = Like.objects.filter(user=request.user, post=post).first()
-
-        if existing_like:
-            # Rimuovi il like (toggle)
-            existing_like.delete()
-            liked = False
-            message = "Like rimosso"
-        else:
-            # Aggiungi il like
-            Like.objects.create(user=request.user, post=post)
-            liked = True
-            message = "Like aggiunto"
-
-            # Verifica i badge per l'autore del post dopo aver ricevuto un like
-            BadgeService.check_all_badges(post.author)
-
-        # Conta i like totali
-        total_likes = post.likes.count()
-
-        return Response({
-            "liked": liked,
-            "total_likes": total_likes,
-            "message": message
-        }, status=status.HTTP_200_OK)
 
     @action(detail=True, methods=['post'])
     def add_comment(self, request, pk=None):
@@ -712,7 +901,7 @@ class DiaryPostViewSet(viewsets.ModelViewSet):
         post = self.get_object()
 
         # Verifica se l'utente può vedere questo post
-        if not post.group.memberships.filter(user=request.user).exists():
+        if not request_is_member(request, post.group_id):
             return Response(
                 {"detail": "Non hai il permesso di commentare questo post."},
                 status=status.HTTP_403_FORBIDDEN
@@ -726,14 +915,13 @@ class DiaryPostViewSet(viewsets.ModelViewSet):
             )
 
         # Crea il commento
-        comment = Comment.objects.create(
-            post=post,
-            author=request.user,
-            content=content
-        )
-
-        # Verifica badge per l'autore del commento
-        BadgeService.check_all_badges(request.user)
+        with transaction.atomic():
+            comment = Comment.objects.create(
+                post=post,
+                author=request.user,
+                content=content
+            )
+            ActivityService.comment_added(comment)
 
         serializer = CommentSerializer(comment, context={'request': request})
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -744,40 +932,76 @@ class DiaryPostViewSet(viewsets.ModelViewSet):
         post = self.get_object()
 
         # Verifica permessi
-        if not post.group.memberships.filter(user=request.user).exists():
+        if not request_is_member(request, post.group_id):
             return Response(
                 {"detail": "Non hai il permesso di vedere i commenti di questo post."},
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        comments = Comment.objects.filter(post=post).order_by('created_at')
-        serializer = CommentSerializer(comments, many=True, context={'request': request})
-        return Response(serializer.data)
+        comments = Comment.objects.filter(post=post).select_related('author')
+
+        paginator = KeysetPagination(newest_first=False)
+        page = paginator.paginate_queryset(comments, request)
+        serializer = CommentSerializer(
+            page, many=True, context={'request': request}, **sparse_fieldset_kwargs(request)
+        )
+        return paginator.get_paginated_response(serializer.data)
 
     def get_queryset(self):
         """Filtra i post in base all'utente e ai suoi gruppi"""
-        user = self.request.user
         # Mostra solo i post dei gruppi di cui l'utente è membro
-        user_groups = user.memberships.values_list('group', flat=True)
-        return DiaryPost.objects.filter(group__in=user_groups).order_by('-created_at')
+        user_groups = member_group_ids(self.request)
+        queryset = DiaryPost.objects.filter(group__in=user_groups).order_by('-created_at')
+        if self.action == 'list':
+            queryset = post_list_queryset(queryset, self.request)
+        return queryset
 
     def perform_create(self, serializer):
         """Crea un nuovo post con l'autore corrente"""
-        post = serializer.save(author=self.request.user)
-        # Verifica i badge dopo la creazione di un post
-        BadgeService.check_all_badges(self.request.user)
+        with transaction.atomic():
+            post = serializer.save(author=self.request.user)
+            ActivityService.post_created(post)
+        # Accoda la verifica dei badge dopo la creazione di un post
+        BadgeService.schedule_check(self.request.user.id)
         return post
 
+    def perform_update(self, serializer):
+        previous_location = serializer.instance.location_name
+        with transaction.atomic():
+            post = serializer.save()
+            ActivityService.post_updated(post, previous_location)
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            ActivityService.post_removed(instance)
+            instance.delete()
+
     @action(detail=False, methods=['get'])
     def my_posts(self, request):
         """Restituisce tutti i post dell'utente corrente"""
-        posts = DiaryPost.objects.filter(
-            author=request.user,
-            is_chat_message=False  # Escludi i messaggi di chat
-        ).order_by('-created_at')
+        posts = post_list_queryset(DiaryPost.objects.filter(author=request.user), request)
 
-        serializer = self.get_serializer(posts, many=True, context={'request': request})
-        return Response(serializer.data)
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(posts, request)
+        serializer = self.get_serializer(page, many=True, context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Post dei gruppi pubblici o dell'utente che corrispondono a ?search=
+        (titolo, contenuto e luogo), per rilevanza e a pagine.
+        """
+        terms = search_terms(request.query_params.get('search'))
+        if not terms:
+            return Response({"detail": "Parametro di ricerca mancante"}, status=status.HTTP_400_BAD_REQUEST)
+
+        posts = post_list_queryset(fulltext_search(visible_posts(DiaryPost.objects.all(), request.user), terms), request)
+
+        paginator = KeysetPagination(fields=('rank', 'id'))
+        page = paginator.paginate_queryset(posts, request)
+        serializer = self.get_serializer(page, many=True, context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
 
     @action(detail=False, methods=['get'])
     def nearby(self, request):
@@ -792,26 +1016,32 @@ class DiaryPostViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Filtra i post che hanno coordinate
-        posts_with_location = DiaryPost.objects.filter(
-            latitude__isnull=False,
-            longitude__isnull=False,
-            is_chat_message=False
-        )
+        if radius <= 0 or not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+            return Response(
+                {"error": "Coordinate o raggio non validi"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-        # Filtra per gruppi accessibili all'utente
-        user_groups = request.user.memberships.values_list('group', flat=True)
-        posts_with_location = posts_with_location.filter(group__in=user_groups)
+        # Prefiltro in SQL sui gruppi dell'utente, bounding box e celle geohash
+        user_groups = member_group_ids(request)
+        candidates = DiaryPost.objects.filter(
+            nearby_filter(latitude, longitude, radius),
+            group__in=user_groups
+        ).select_related('author')
 
-        # Calcola la distanza e filtra
+        # Distanza esatta solo sui candidati, calcolata una volta per post
         nearby_posts = []
-        for post in posts_with_location:
+        for post in candidates:
             distance = calculate_distance(latitude, longitude, post.latitude, post.longitude)
             if distance <= radius:
-                nearby_posts.append(post)
+                nearby_posts.append((distance, post))
 
         # Ordina per distanza (più vicini prima)
-        nearby_posts.sort(key=lambda p: calculate_distance(latitude, longitude, p.latitude, p.longitude))
+        nearby_posts.sort(key=lambda item: item[0])
+        nearby_posts = [post for _, post in nearby_posts]
+        prefetch_related_objects(nearby_posts, 'media')
+        if 'comments' in (parse_list_param(request, 'expand') or ()):
+            prefetch_related_objects(nearby_posts, 'comments__author')
 
         serializer = self.get_serializer(nearby_posts, many=True, context={'request': request})
         return Response(serializer.data)
@@ -822,31 +1052,37 @@ class DiaryPostViewSet(viewsets.ModelViewSet):
         post = self.get_object()
 
         # Verifica se l'utente può vedere questo post (è membro del gruppo)
-        if not post.group.memberships.filter(user=request.user).exists():
+        if not request_is_member(request, post.group_id):
             return Response(
                 {"detail": "Non hai il permesso di interagire con questo post."},
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        # Controlla se l'utente ha già messo like
-        existing_like = Like.objects.filter(user=request.user, post=post).first()
-
-        if existing_like:
-            # Rimuovi il like (toggle)
-            existing_like.delete()
-            liked = False
-            message = "Like rimosso"
-        else:
-            # Aggiungi il like
-            Like.objects.create(user=request.user, post=post)
-            liked = True
-            message = "Like aggiunto"
+        with transaction.atomic():
+            # Controlla se l'utente ha già messo like
+            existing_like = Like.objects.filter(user=request.user, post=post).first()
+
+            if existing_like:
+                # Rimuovi il like (toggle); con due richieste in contemporanea
+                # solo quella che lo cancella davvero aggiorna i contatori
+                if existing_like.delete()[0] == 1:
+                    ActivityService.like_removed(post, existing_like)
+                liked = False
+                message = "Like rimosso"
+            else:
+                # Aggiungi il like
+                Like.objects.create(user=request.user, post=post)
+                ActivityService.like_added(post)
+                liked = True
+                message = "Like aggiunto"
 
-            # Verifica i badge per l'autore del post dopo aver ricevuto un like
-            BadgeService.check_all_badges(post.author)
+        if liked:
+            # Accoda la verifica dei badge per l'autore del post dopo aver ricevuto un like
+            BadgeService.schedule_check(post.author_id)
 
-        # Conta i like totali
-        total_likes = post.likes.count()
+        # Like totali dal contatore aggiornato
+        post.refresh_from_db(fields=['likes_count'])
+        total_likes = post.likes_count
 
         return Response({
             "liked": liked,
@@ -857,53 +1093,47 @@ class DiaryPostViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['get'])
     def feed(self, request):
         """Feed personalizzato dell'utente con post dei suoi gruppi"""
-        user_groups = request.user.memberships.values_list('group', flat=True)
+        user_groups = member_group_ids(request)
 
-        # Ottieni post recenti dai gruppi dell'utente (non messaggi chat)
-        posts = DiaryPost.objects.filter(
-            group__in=user_groups,
-            is_chat_message=False
-        ).select_related('author', 'group').prefetch_related(
-            'media', 'likes', 'comments'
-        ).order_by('-created_at')[:20]  # Ultimi 20 post
+        # Post recenti dai gruppi dell'utente, una pagina alla volta
+        posts = post_list_queryset(DiaryPost.objects.filter(group__in=user_groups), request)
 
-        serializer = self.get_serializer(posts, many=True, context={'request': request})
-        return Response(serializer.data)
-
-
-def calculate_distance(lat1, lon1, lat2, lon2):
-    """
-    Calcola la distanza tra due punti geografici usando la formula di Haversine
-    Restituisce la distanza in chilometri
-    """
-    # Converti gradi in radianti
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-
-    # Formula di Haversine
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-    c = 2 * asin(sqrt(a))
-
-    # Raggio della Terra in km
-    r = 6371
-
-    return c * r
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(posts, request)
+        serializer = self.get_serializer(page, many=True, context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
 
 
 # Aggiorna anche il PostMediaViewSet per migliorare l'upload
-class PostMediaViewSet(viewsets.ModelViewSet):
+class PostMediaViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = PostMedia.objects.all()
     serializer_class = PostMediaSerializer
     permission_classes = [permissions.IsAuthenticated, IsOwnerOrReadOnly]
     parser_classes = [parsers.MultiPartParser, parsers.FormParser]
 
     def perform_create(self, serializer):
-        media = serializer.save()
-        # Verifica i badge dopo il caricamento di un media
-        BadgeService.check_all_badges(media.post.author)
+        with transaction.atomic():
+            media = serializer.save()
+            ActivityService.media_added(media)
+            MediaSearchService.index_media(media)
+            ImageService.schedule_renditions(media)
+        # Accoda la verifica dei badge dopo il caricamento di un media
+        BadgeService.schedule_check(media.post.author_id)
         return media
 
+    def perform_update(self, serializer):
+        previous_counters = media_counters(serializer.instance)
+        with transaction.atomic():
+            media = serializer.save()
+            ActivityService.media_updated(media, previous_counters)
+            MediaSearchService.index_media(media)
+        BadgeService.schedule_check(media.post.author_id)
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            instance.delete()
+            ActivityService.media_removed(instance)
+
     @action(detail=False, methods=['post'])
     def upload_media(self, request):
         """
@@ -925,7 +1155,7 @@ class PostMediaViewSet(viewsets.ModelViewSet):
             )
 
         # Verifica che l'utente sia l'autore del post o un membro del gruppo
-        if post.author != request.user and not post.group.memberships.filter(user=request.user).exists():
+        if post.author != request.user and not request_is_member(request, post.group_id):
             return Response(
                 {"detail": "Permesso negato."},
                 status=status.HTTP_403_FORBIDDEN
@@ -940,12 +1170,8 @@ class PostMediaViewSet(viewsets.ModelViewSet):
 
         # Determina il tipo di media
         file = request.FILES['media_file']
-        file_name = file.name.lower()
-        if file_name.endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp')):
-            media_type = 'image'
-        elif file_name.endswith(('.mp4', '.mov', '.avi', '.mkv')):
-            media_type = 'video'
-        else:
+        media_type = media_type_for(file.name)
+        if media_type is None:
             return Response(
                 {"detail": "Tipo di file non supportato. Usa immagini (jpg, png, gif) o video (mp4, mov, avi)."},
                 status=status.HTTP_400_BAD_REQUEST
@@ -970,14 +1196,23 @@ class PostMediaViewSet(viewsets.ModelViewSet):
                 else:
                     media_data[field] = request.data[field]
 
-        media = PostMedia.objects.create(**media_data)
+        with transaction.atomic():
+            media = PostMedia.objects.create(**media_data)
+            ActivityService.media_added(media)
+            MediaSearchService.index_media(media)
+            ImageService.schedule_renditions(media)
 
-        # Verifica i badge dopo il caricamento
-        BadgeService.check_all_badges(request.user)
+        # Accoda la verifica dei badge dell'autore del post dopo il caricamento
+        BadgeService.schedule_check(post.author_id)
 
         serializer = PostMediaSerializer(media, context={'request': request})
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """Media dei gruppi pubblici o dell'utente per etichetta (?label=) o testo riconosciuto (?q=)."""
+        return media_search_response(request, visible_groups(Gruppo.objects.all(), request.user).values('id'))
+
     @action(detail=True, methods=['post'])
     def process_ml_results(self, request, pk=None):
         """
@@ -994,6 +1229,7 @@ class PostMediaViewSet(viewsets.ModelViewSet):
 
         # Aggiorna con i risultati ML Kit
         ml_results = request.data.get('ml_results', {})
+        previous_counters = media_counters(media)
 
         if 'detected_objects' in ml_results:
             media.detected_objects = ml_results['detected_objects']
@@ -1004,31 +1240,138 @@ class PostMediaViewSet(viewsets.ModelViewSet):
         if 'caption' in ml_results:
             media.caption = ml_results['caption']
 
-        media.save()
+        with transaction.atomic():
+            media.save()
+            ActivityService.media_updated(media, previous_counters)
+            MediaSearchService.index_media(media)
 
-        # Verifica badge dopo il processing ML
-        BadgeService.check_all_badges(request.user)
+        # Accoda la verifica dei badge dopo il processing ML
+        BadgeService.schedule_check(request.user.id)
 
         serializer = self.get_serializer(media)
         return Response(serializer.data)
 
 
-class CommentViewSet(viewsets.ModelViewSet):
+class UploadSessionViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    """
+    Upload a blocchi riprendibili per i video grandi:
+    POST crea la sessione, PUT con Content-Range invia un blocco (corpo
+    binario), GET restituisce received_size per riprendere, POST finalize
+    crea il PostMedia e DELETE annulla.
+    """
+    queryset = UploadSession.objects.all()
+    serializer_class = UploadSessionSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(user=self.request.user).order_by('-created_at')
+
+    def create(self, request):
+        post_id = request.data.get('post_id')
+        if not post_id:
+            return Response(
+                {"detail": "Post ID è richiesto."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            post = DiaryPost.objects.get(id=post_id)
+        except (DiaryPost.DoesNotExist, ValueError):
+            return Response(
+                {"detail": "Post non trovato."},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        # Stessi permessi di upload_media
+        if post.author != request.user and not request_is_member(request, post.group_id):
+            return Response(
+                {"detail": "Permesso negato."},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        try:
+            total_size = int(request.data.get('total_size'))
+            latitude = request.data.get('latitude')
+            longitude = request.data.get('longitude')
+            latitude = float(latitude) if latitude not in (None, '') else None
+            longitude = float(longitude) if longitude not in (None, '') else None
+        except (TypeError, ValueError):
+            return Response(
+                {"detail": "total_size, latitude e longitude devono essere numeri."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            session = UploadService.create_session(
+                request.user, post, request.data.get('filename'), total_size, latitude, longitude
+            )
+        except UploadError as e:
+            return Response({"detail": str(e)}, status=e.status_code)
+
+        serializer = self.get_serializer(session)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def update(self, request, pk=None):
+        """Riceve un blocco: il corpo viene letto a pezzi da request.stream, mai tutto in memoria."""
+        session = self.get_object()
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+
+        try:
+            session = UploadService.write_chunk(
+                session, request.META.get('HTTP_CONTENT_RANGE'), request.stream, content_length
+            )
+        except UploadError as e:
+            return Response({"detail": str(e)}, status=e.status_code)
+
+        serializer = self.get_serializer(session)
+        return Response(serializer.data)
+
+    def destroy(self, request, pk=None):
+        UploadService.abort(self.get_object())
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=True, methods=['post'])
+    def finalize(self, request, pk=None):
+        """Crea il PostMedia dal file completo."""
+        session = self.get_object()
+        try:
+            media = UploadService.finalize(session)
+        except UploadError as e:
+            return Response({"detail": str(e)}, status=e.status_code)
+
+        BadgeService.schedule_check(session.post.author_id)
+
+        serializer = PostMediaSerializer(media, context={'request': request})
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class CommentViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = Comment.objects.all()
     serializer_class = CommentSerializer
     permission_classes = [permissions.IsAuthenticated, IsOwnerOrReadOnly]
 
     def perform_create(self, serializer):
-        serializer.save(author=self.request.user)
+        with transaction.atomic():
+            comment = serializer.save(author=self.request.user)
+            ActivityService.comment_added(comment)
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            # Solo la richiesta che cancella davvero il commento aggiorna i contatori
+            if Comment.objects.filter(pk=instance.pk).delete()[0] == 1:
+                ActivityService.comment_removed(instance)
 
 
-class BadgeViewSet(viewsets.ModelViewSet):
+class BadgeViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = Badge.objects.all()
     serializer_class = BadgeSerializer
     permission_classes = [permissions.IsAuthenticated]
 
 
-class UserBadgeViewSet(viewsets.ModelViewSet):
+class UserBadgeViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = UserBadge.objects.all()
     serializer_class = UserBadgeSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -1058,7 +1401,7 @@ class UserBadgeViewSet(viewsets.ModelViewSet):
 
 # Aggiungi questo nel file triptales/views.py
 
-class GroupInviteViewSet(viewsets.ModelViewSet):
+class GroupInviteViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     """ViewSet per gestire gli inviti ai gruppi."""
     queryset = GroupInvite.objects.all()
     serializer_class = GroupInviteSerializer